@@ -0,0 +1,202 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+# Schemas compiled from text in this session (e.g. the schema stored in an HDF5 file), keyed by SHA-256
+_compiled_texts = {}
+
+# Version of the CompiledSchema attributes, part of the cache file name so schemas pickled by older code are not reused
+SCHEMA_FORMAT = 1
+
+
+class CompiledSchema:
+    """
+    Class holding a JSON schema file parsed once, with the lookups used by the LAPS functions.
+
+    Attributes:
+    metadata (dict): The parsed JSON schema.
+    digest (str): The SHA-256 hex digest of the schema file content.
+    schema_json (str): The schema as stored by LAPS_2_HDF5_from_directory (json.dumps with indent=4).
+    datasets (list): The items of data['data']['datasets'].
+    dataset_headers (list): The header labels of each item of datasets, in the same order.
+    dataset_directories (dict): Directory name (e.g. 'Time_Series_1') -> dataset item.
+    header_arrays (dict): Directory name -> list of header labels ('type spec_a spec_b spec_c, unit').
+    devices (list): The names of the DAQ devices (daq.devices[].name).
+    directories (list): The directories LAPS_1 creates, relative to the target directory, '/'-separated,
+                        in creation order.
+
+    Methods:
+    entry_for_path(relative_path, os): Return the dataset item owning a file of the populated directory.
+    headers_for_path(relative_path, os): Return the header labels for a file of the populated directory.
+    """
+
+    def __init__(self, metadata, digest, json):
+        from LAPS_timeseries_format import dataset_directory_name, header_labels
+
+        self.metadata = metadata
+        self.digest = digest
+        self.schema_json = json.dumps(metadata, indent=4)
+        self.datasets = []
+        self.dataset_headers = []
+        self.dataset_directories = {}
+        self.header_arrays = {}
+        self.devices = []
+        self.directories = []
+
+        if not isinstance(metadata, dict):
+            return
+
+        # Same walk as LAPS_1_empty_dir_create_update, done once
+        for key, value in metadata.items():
+            self.directories.append(key)
+
+            if key == "data" and isinstance(value, dict) and "datasets" in value:
+                self.directories.append(key + "/datasets")
+                for dataset in value["datasets"]:
+                    labels = header_labels(dataset)
+                    self.datasets.append(dataset)
+                    self.dataset_headers.append(labels)
+                    directory = dataset_directory_name(dataset)
+                    if directory:
+                        self.directories.append(key + "/datasets/" + directory)
+                        self.dataset_directories.setdefault(directory, dataset)
+                        self.header_arrays.setdefault(directory, labels)
+
+            elif isinstance(value, dict) and "documents" in value:
+                self.directories.append(key + "/documents")
+
+            elif key == "daq" and isinstance(value, dict) and "devices" in value:
+                self.directories.append(key + "/devices")
+                for device in value.get("devices", []):
+                    device_name = device.get("name", "")
+                    if device_name:
+                        self.devices.append(device_name)
+                        self.directories.append(key + "/devices/" + device_name)
+                        self.directories.append(key + "/devices/" + device_name + "/documents")
+
+    def entry_for_path(self, relative_path, os):
+        """
+        Return the dataset item owning a file of the populated directory.
+
+        Parameters:
+        relative_path (str): Path of the file relative to the populated directory
+                             (e.g. 'data/datasets/Time_Series_1/test_1/file.txt').
+        os (module): The operating system module for path handling.
+
+        Returns:
+        dict or None: The dataset item, or None if the file is not inside a dataset folder.
+        """
+        parts = os.path.normpath(relative_path).replace(os.sep, '/').split('/')
+        if len(parts) < 4 or parts[0] != 'data' or parts[1] != 'datasets':
+            return None
+        return self.dataset_directories.get(parts[2])
+
+    def headers_for_path(self, relative_path, os):
+        """
+        Return the header labels of the dataset folder a file of the populated directory is in.
+
+        Parameters:
+        relative_path (str): Path of the file relative to the populated directory.
+        os (module): The operating system module for path handling.
+
+        Returns:
+        list: The header labels (empty if the folder has no headers).
+        """
+        parts = os.path.normpath(relative_path).replace(os.sep, '/').split('/')
+        if len(parts) < 4 or parts[0] != 'data' or parts[1] != 'datasets':
+            return []
+        return self.header_arrays.get(parts[2], [])
+
+
+def LAPS_0_compile_schema(scdir, json, os, cache=True, cache_dir=None):
+    """
+    Parse a JSON schema file once into a CompiledSchema that all LAPS functions accept in place of the path.
+
+    Parameters:
+    scdir (str): The path to the JSON schema file.
+    json (module): The JSON module to load and parse the JSON schema.
+    os (module): The operating system module for file operations.
+    cache (bool, optional): If True, the compiled schema is pickled and reused by later calls (and other processes)
+                            for the same schema content. Defaults to True.
+    cache_dir (str, optional): The cache directory. Defaults to ~/.cache/laps/schema.
+
+    Returns:
+    CompiledSchema: The compiled schema.
+
+    The cache is keyed by the SHA-256 hash of the schema file, so editing the schema always recompiles it,
+    and by SCHEMA_FORMAT, to be increased whenever CompiledSchema changes.
+
+    Usage example:
+    schema = LAPS_0_compile_schema('schema.json', json, os)
+    LAPS_1_empty_dir_create_update(schema, target_dir, json, os)
+    LAPS_2_HDF5_from_directory(schema, target_dir, hdf5_file, json, os, np, h5py)
+    """
+    import hashlib
+    import pickle
+
+    with open(scdir, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+
+    if cache:
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'laps', 'schema')
+        cache_path = os.path.join(cache_dir, digest + '-' + str(SCHEMA_FORMAT) + '.pickle')
+        try:
+            with open(cache_path, 'rb') as f:
+                schema = pickle.load(f)
+            if isinstance(schema, CompiledSchema) and schema.digest == digest:
+                return schema
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass
+
+    schema = CompiledSchema(json.loads(content.decode('utf-8')), digest, json)
+
+    # Save the compiled schema (replace atomically, keep working if the cache is not writable)
+    if cache:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path + '.tmp', 'wb') as f:
+                pickle.dump(schema, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError:
+            pass
+    return schema
+
+
+def compile_schema_text(text, json):
+    """
+    Compile a schema given as a JSON string (e.g. the 'Schema_json' attribute of an HDF5 file).
+
+    Parameters:
+    text (str): The JSON schema text.
+    json (module): The JSON module to parse the JSON schema.
+
+    Returns:
+    CompiledSchema: The compiled schema, reused for the same text within the session.
+    """
+    import hashlib
+
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    if digest not in _compiled_texts:
+        _compiled_texts[digest] = CompiledSchema(json.loads(text) if text else {}, digest, json)
+    return _compiled_texts[digest]
+
+
+def load_schema(schema, json, os):
+    """
+    Return a CompiledSchema for either a schema file path or an already compiled schema.
+
+    Parameters:
+    schema (str or CompiledSchema): The path to the JSON schema file, or the result of LAPS_0_compile_schema.
+    json (module): The JSON module to load and parse the JSON schema.
+    os (module): The operating system module for file operations.
+
+    Returns:
+    CompiledSchema: The compiled schema.
+    """
+    if isinstance(schema, (str, bytes, os.PathLike)):
+        return LAPS_0_compile_schema(schema, json, os)
+    return schema
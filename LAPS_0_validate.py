@@ -0,0 +1,555 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+# Validators compiled in this session, keyed by the SHA-256 of the LAPS schema file
+_validators = {}
+
+# The LAPS schema the experiment files are checked against, relative to this folder
+DEFAULT_LAPS_SCHEMA = 'Schema/laps.schema_new5.json'
+
+# Version of the compiled node format, part of the cache file name so older cached validators are not reused
+VALIDATOR_FORMAT = 1
+
+# JSON types; the other types of the schema (e.g. json-editor's 'info') only describe the form and accept anything
+JSON_TYPES = ('string', 'number', 'integer', 'boolean', 'object', 'array', 'null')
+
+
+class CompiledValidator:
+    """
+    Class holding a LAPS schema with its $ref resolved once, compiled for validating experiment files.
+
+    Attributes:
+    schema_path (str): The path to the LAPS schema (e.g. Schema/laps.schema_new5.json).
+    digest (str): The SHA-256 hex digest of the LAPS schema file.
+    dependencies (dict): The path of every schema file it references -> the SHA-256 hex digest of its content.
+    nodes (list): The compiled schema, node 0 being the root. A node only keeps the validation keywords
+                  ('types', 'enum', 'properties', 'required', 'items', 'one_of', ...), and every $ref is replaced
+                  by the index of the node it points to, so nothing is looked up while validating.
+
+    Methods:
+    validate(instance, max_errors): Return the errors of a parsed experiment file.
+
+    References like 'files/definitions.schema.json#/definitions/header' are resolved relative to the LAPS schema,
+    and, if that file does not exist, to the file of the same name next to it (as in the Schema folder).
+    Keywords next to a $ref extend the referenced schema (the properties are merged), as in json-editor,
+    the form editor the LAPS schema is written for.
+    """
+
+    def __init__(self, schema_path, json, os):
+        self.schema_path = schema_path
+        self.nodes = []
+        self.dependencies = {}
+        self._documents = {}
+        self._refs = {}
+        self._json = json
+        self._os = os
+        root = self._load(os.path.abspath(schema_path))
+        self.digest = self.dependencies.pop(os.path.abspath(schema_path))
+        self._compile([(root, os.path.abspath(schema_path))])
+        del self._documents, self._refs, self._json, self._os
+
+    def _load(self, path):
+        """
+        Read (once) and return a schema document, recording its hash as a dependency.
+        """
+        import hashlib
+
+        if path not in self._documents:
+            with open(path, 'rb') as f:
+                content = f.read()
+            self.dependencies[path] = hashlib.sha256(content).hexdigest()
+            self._documents[path] = self._json.loads(content.decode('utf-8'))
+        return self._documents[path]
+
+    def _resolve(self, reference, base):
+        """
+        Return (schema, file) of a $ref found in the file base.
+        """
+        os = self._os
+        location, _, pointer = reference.partition('#')
+        path = base
+        if location:
+            path = os.path.normpath(os.path.join(os.path.dirname(base), location))
+            if not os.path.exists(path):
+                path = os.path.join(os.path.dirname(base), os.path.basename(location))
+        target = self._load(path)
+        for part in pointer.strip('/').split('/') if pointer.strip('/') else []:
+            part = part.replace('~1', '/').replace('~0', '~')
+            target = target[int(part)] if isinstance(target, list) else target[part]
+        return target, path
+
+    def _compile(self, parts):
+        """
+        Compile a schema given as (schema, file) parts applied in order, and return the index of its node.
+        """
+        # Expand the references: the referenced schema comes first, the keywords next to $ref extend it
+        expanded = []
+        for schema, base in parts:
+            if not isinstance(schema, dict):
+                continue
+            if isinstance(schema.get('$ref'), str):
+                key = (schema['$ref'], base)
+                siblings = {name: value for name, value in schema.items() if name != '$ref'}
+                if key in self._refs and not set(siblings) & VALIDATION_KEYWORDS:
+                    return self._refs[key]  # a plain reference (or a recursive one) compiled already
+                target, path = self._resolve(schema['$ref'], base)
+                if not set(siblings) & VALIDATION_KEYWORDS:
+                    self._refs[key] = len(self.nodes)
+                    return self._compile([(target, path)])
+                expanded.append((target, path))
+                expanded.append((siblings, base))
+            else:
+                expanded.append((schema, base))
+
+        node = {}
+        index = len(self.nodes)
+        self.nodes.append(node)
+        properties = {}
+        for schema, base in expanded:
+            for name, value in schema.items():
+                if name == 'type':
+                    types = value if isinstance(value, list) else [value]
+                    node['types'] = None if any(t not in JSON_TYPES for t in types) else tuple(types)
+                elif name == 'enum' and isinstance(value, list):
+                    node['enum'] = value
+                elif name == 'properties' and isinstance(value, dict):
+                    for key, item in value.items():
+                        properties.setdefault(key, []).append((item, base))
+                elif name == 'required' and isinstance(value, list):
+                    node['required'] = tuple(value)
+                elif name == 'additionalProperties':
+                    node['additional'] = value if isinstance(value, bool) else self._compile([(value, base)])
+                elif name == 'items' and isinstance(value, dict):
+                    node['items'] = self._compile([(value, base)])
+                elif name in ('oneOf', 'anyOf', 'allOf') and isinstance(value, list):
+                    node[{'oneOf': 'one_of', 'anyOf': 'any_of', 'allOf': 'all_of'}[name]] = \
+                        [self._compile([(item, base)]) for item in value]
+                elif name in ('minimum', 'maximum', 'minLength', 'maxLength', 'minItems', 'maxItems') \
+                        and isinstance(value, (int, float)):
+                    node[name] = value
+                elif name == 'uniqueItems':
+                    node['unique'] = bool(value)
+                elif name == 'pattern' and isinstance(value, str):
+                    node['pattern'] = value
+        if properties:
+            node['properties'] = {key: self._compile(item) for key, item in properties.items()}
+
+        # Options told apart by a property with a single allowed value (e.g. the 'type' of a header or material,
+        # as json-editor writes them): the option is chosen by that value, so errors point into the right option
+        for name in ('one_of', 'any_of'):
+            options = node.get(name, [])
+            keys = set.intersection(*[set(self.nodes[option].get('properties', {})) for option in options]) \
+                if options else set()
+            for key in sorted(keys):
+                values = [self.nodes[self.nodes[option]['properties'][key]].get('enum') for option in options]
+                if all(value is not None and len(value) == 1 and isinstance(value[0], str) for value in values) \
+                        and len({value[0] for value in values}) == len(values):
+                    node['discriminator'] = (key, {value[0]: option for value, option in zip(values, options)})
+                    break
+        if node.get('types', ()) is None:
+            del node['types']
+        return index
+
+    def validate(self, instance, max_errors=100):
+        """
+        Validate a parsed experiment file against the LAPS schema, and check what the LAPS functions rely on.
+
+        Parameters:
+        instance (dict): The parsed experiment JSON.
+        max_errors (int, optional): Stop after this many errors. Defaults to 100.
+
+        Returns:
+        list: The errors as 'path: message' strings (e.g. "data.datasets[0].headers[2].header.unit: 'KN' is not
+              one of ..."), empty if the file is valid.
+        """
+        errors = []
+        self._check(0, instance, '', errors, max_errors)
+        for error in laps_errors(instance):
+            if len(errors) >= max_errors:
+                break
+            errors.append(error)
+        return errors
+
+    def _check(self, index, value, path, errors, max_errors):
+        """
+        Add the errors of a value against a compiled node to errors.
+        """
+        import re
+
+        if len(errors) >= max_errors:
+            return
+        node = self.nodes[index]
+        where = path or '(root)'
+
+        if 'types' in node and not any(_is_type(value, t) for t in node['types']):
+            errors.append(where + ': ' + _short(value) + ' is not of type ' + ' or '.join(node['types']))
+            return
+        if 'enum' in node and value not in node['enum']:
+            choices = ', '.join(_short(choice) for choice in node['enum'][:8])
+            errors.append(where + ': ' + _short(value) + ' is not one of ' + choices +
+                          (', ...' if len(node['enum']) > 8 else ''))
+
+        if isinstance(value, dict):
+            for name in node.get('required', ()):
+                if name not in value:
+                    errors.append(where + ': missing required property ' + repr(name))
+            properties = node.get('properties', {})
+            for name, item in value.items():
+                item_path = path + '.' + name if path else name
+                if name in properties:
+                    self._check(properties[name], item, item_path, errors, max_errors)
+                elif node.get('additional') is False:
+                    errors.append(where + ': unexpected property ' + repr(name))
+                elif isinstance(node.get('additional'), int) and not isinstance(node.get('additional'), bool):
+                    self._check(node['additional'], item, item_path, errors, max_errors)
+
+        elif isinstance(value, list):
+            if 'items' in node:
+                for i, item in enumerate(value):
+                    self._check(node['items'], item, path + '[' + str(i) + ']', errors, max_errors)
+            if len(value) < node.get('minItems', 0) or len(value) > node.get('maxItems', len(value)):
+                errors.append(where + ': ' + str(len(value)) + ' items, expected between ' +
+                              str(node.get('minItems', 0)) + ' and ' + str(node.get('maxItems', 'any')))
+            if node.get('unique'):
+                seen = []
+                for item in value:
+                    if item in seen:
+                        errors.append(where + ': duplicate item ' + _short(item))
+                        break
+                    seen.append(item)
+
+        elif isinstance(value, str):
+            if len(value) < node.get('minLength', 0) or len(value) > node.get('maxLength', len(value)):
+                errors.append(where + ': ' + _short(value) + ' has a length out of range')
+            if 'pattern' in node and not re.search(node['pattern'], value):
+                errors.append(where + ': ' + _short(value) + ' does not match ' + repr(node['pattern']))
+
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            if 'minimum' in node and value < node['minimum']:
+                errors.append(where + ': ' + str(value) + ' is less than the minimum ' + str(node['minimum']))
+            if 'maximum' in node and value > node['maximum']:
+                errors.append(where + ': ' + str(value) + ' is more than the maximum ' + str(node['maximum']))
+
+        for item in node.get('all_of', ()):
+            self._check(item, value, path, errors, max_errors)
+        if 'discriminator' in node and isinstance(value, dict) and node['discriminator'][0] in value:
+            key, options = node['discriminator']
+            if value[key] in options:
+                self._check(options[value[key]], value, path, errors, max_errors)
+            else:
+                choices = ', '.join(_short(choice) for choice in list(options)[:8])
+                errors.append((path + '.' + key if path else key) + ': ' + _short(value[key]) + ' is not one of ' +
+                              choices + (', ...' if len(options) > 8 else ''))
+            return
+        for name in ('one_of', 'any_of'):
+            if name not in node:
+                continue
+            # Validate against every option, keeping the errors of the closest one if none (or several) match
+            results = []
+            for item in node[name]:
+                option_errors = []
+                self._check(item, value, path, option_errors, max_errors)
+                results.append(option_errors)
+            matches = sum(not option_errors for option_errors in results)
+            if matches == 0:
+                closest = min(results, key=len)
+                errors.extend(closest[:max(max_errors - len(errors), 0)])
+            elif matches > 1 and name == 'one_of':
+                errors.append(where + ': matches ' + str(matches) + ' of the oneOf options, expected exactly one')
+
+
+# Keywords that change what a schema accepts (the others, e.g. 'title' or 'options', only describe the form)
+VALIDATION_KEYWORDS = {'type', 'enum', 'properties', 'required', 'additionalProperties', 'items', 'oneOf', 'anyOf',
+                       'allOf', 'minimum', 'maximum', 'minLength', 'maxLength', 'minItems', 'maxItems',
+                       'uniqueItems', 'pattern'}
+
+
+def _is_type(value, json_type):
+    """
+    Return True if a parsed JSON value is of a JSON schema type.
+    """
+    if json_type == 'string':
+        return isinstance(value, str)
+    if json_type == 'number':
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if json_type == 'integer':
+        return (isinstance(value, int) and not isinstance(value, bool)) or \
+            (isinstance(value, float) and value.is_integer())
+    if json_type == 'boolean':
+        return isinstance(value, bool)
+    if json_type == 'object':
+        return isinstance(value, dict)
+    if json_type == 'array':
+        return isinstance(value, list)
+    return value is None
+
+
+def _short(value):
+    """
+    Return a value as text for an error message, shortened.
+    """
+    text = repr(value)
+    return text if len(text) <= 60 else text[:57] + '...'
+
+
+def laps_errors(metadata):
+    """
+    Check what the LAPS functions rely on in an experiment file, beyond the LAPS schema.
+
+    Parameters:
+    metadata (dict): The parsed experiment JSON.
+
+    Returns:
+    list: The errors as 'path: message' strings. Dataset entries need a 'data' name and headers need the
+          'type', 'spec_a', 'spec_b', 'spec_c' and 'unit' strings (the column labels); dataset folder and device
+          names must be usable as folder names and must not repeat.
+    """
+    from LAPS_timeseries_format import dataset_directory_name
+
+    errors = []
+    if not isinstance(metadata, dict):
+        return ['(root): the experiment file must hold a JSON object']
+
+    # Function to check a name used as a folder name
+    def check_folder_name(path, name, seen, what):
+        if not isinstance(name, str) or not name or name in ('.', '..') or '/' in name or '\\' in name:
+            errors.append(path + ': ' + _short(name) + ' cannot be used as a folder name')
+        elif name in seen:
+            errors.append(path + ': the ' + what + ' folder ' + repr(name) + ' is also used by ' + seen[name])
+        else:
+            seen[name] = path
+
+    data = metadata.get('data')
+    datasets = data.get('datasets', []) if isinstance(data, dict) else []
+    folders = {}
+    for i, dataset in enumerate(datasets if isinstance(datasets, list) else []):
+        path = 'data.datasets[' + str(i) + ']'
+        if not isinstance(dataset, dict):
+            continue  # reported by the schema
+        if not isinstance(dataset.get('data'), str) or not dataset.get('data'):
+            errors.append(path + ".data: missing, so LAPS_1 cannot name the dataset folder")
+            continue
+        if not isinstance(dataset.get('index', ''), str):
+            errors.append(path + ".index: must be a string")
+            continue
+        check_folder_name(path, dataset_directory_name(dataset), folders, 'dataset')
+        for j, item in enumerate(dataset.get('headers', []) if isinstance(dataset.get('headers'), list) else []):
+            header = item.get('header') if isinstance(item, dict) else None
+            if header is None:
+                continue
+            if not isinstance(header, dict):
+                errors.append(path + '.headers[' + str(j) + '].header: must be an object')
+                continue
+            for name in ('type', 'spec_a', 'spec_b', 'spec_c', 'unit'):
+                if not isinstance(header.get(name), str):
+                    errors.append(path + '.headers[' + str(j) + '].header.' + name +
+                                  ': missing or not a string, so the column label cannot be built')
+
+    daq = metadata.get('daq')
+    devices = daq.get('devices', []) if isinstance(daq, dict) else []
+    names = {}
+    for i, device in enumerate(devices if isinstance(devices, list) else []):
+        if isinstance(device, dict) and device.get('name', ''):
+            check_folder_name('daq.devices[' + str(i) + '].name', device['name'], names, 'device')
+    return errors
+
+
+def LAPS_0_compile_validator(laps_schema=None, json=None, os=None, cache=True, cache_dir=None):
+    """
+    Compile the LAPS schema into a CompiledValidator, resolving its $ref once, and cache it on disk.
+
+    Parameters:
+    laps_schema (str, optional): The path to the LAPS schema. Defaults to Schema/laps.schema_new5.json next to
+                                 this file.
+    json (module): The JSON module to parse the schema files.
+    os (module): The operating system module for file operations.
+    cache (bool, optional): If True, the validator is pickled and reused by later calls (and other processes).
+                            Defaults to True.
+    cache_dir (str, optional): The cache directory. Defaults to ~/.cache/laps/validator.
+
+    Returns:
+    CompiledValidator: The compiled validator, also reused within the session.
+
+    The cache is keyed by the SHA-256 hash of the LAPS schema, and a cached validator is only used if the files
+    it references (definitions.schema.json) still have the same hash.
+
+    Usage example:
+    validator = LAPS_0_compile_validator(None, json, os)
+    errors = validator.validate(json.load(open('Paterson_Carrara_Test.json')))
+    """
+    import hashlib
+    import pickle
+
+    if laps_schema is None:
+        laps_schema = os.path.join(os.path.dirname(os.path.abspath(__file__)), *DEFAULT_LAPS_SCHEMA.split('/'))
+    with open(laps_schema, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+
+    # Function to check that the files a validator references did not change
+    def up_to_date(validator):
+        for path, dependency in validator.dependencies.items():
+            try:
+                with open(path, 'rb') as f:
+                    if hashlib.sha256(f.read()).hexdigest() != dependency:
+                        return False
+            except OSError:
+                return False
+        return True
+
+    validator = _validators.get(digest)
+    if validator is not None and up_to_date(validator):
+        return validator
+
+    if cache:
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'laps', 'validator')
+        cache_path = os.path.join(cache_dir, digest + '-' + str(VALIDATOR_FORMAT) + '.pickle')
+        try:
+            with open(cache_path, 'rb') as f:
+                validator = pickle.load(f)
+            if isinstance(validator, CompiledValidator) and validator.digest == digest and up_to_date(validator):
+                _validators[digest] = validator
+                return validator
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass
+
+    validator = CompiledValidator(laps_schema, json, os)
+    _validators[digest] = validator
+
+    # Save the validator (replace atomically, keep working if the cache is not writable)
+    if cache:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path + '.tmp', 'wb') as f:
+                pickle.dump(validator, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError:
+            pass
+    return validator
+
+
+def LAPS_0_validate(experiment_files, json, os, laps_schema=None, processes=1, max_errors=100, verbose=True):
+    """
+    Validate experiment JSON files against the LAPS schema, in parallel processes for large batches.
+
+    Parameters:
+    experiment_files (str or list): An experiment JSON file, a list of them, or a folder (every '.json' file in it
+                                    and its subfolders).
+    json (module): The JSON module to parse the files.
+    os (module): The operating system module for file operations.
+    laps_schema (str, optional): The path to the LAPS schema. Defaults to Schema/laps.schema_new5.json.
+    processes (int, optional): The number of worker processes; None for the number of CPUs. Defaults to 1
+                               (validate in this process, which is fastest for a few files).
+    max_errors (int, optional): The maximum number of errors kept per file. Defaults to 100.
+    verbose (bool, optional): If True, the errors of each invalid file and a summary are printed. Defaults to True.
+
+    Returns:
+    dict: Experiment file path -> list of errors ('path: message' strings, empty for a valid file).
+
+    Usage example:
+    errors = LAPS_0_validate('Test_input_output_data', json, os, processes=None)
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if isinstance(experiment_files, str) and os.path.isdir(experiment_files):
+        folder = experiment_files
+        experiment_files = []
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            experiment_files.extend(os.path.join(root, name) for name in sorted(files) if name.endswith('.json'))
+    elif isinstance(experiment_files, str):
+        experiment_files = [experiment_files]
+
+    validator = LAPS_0_compile_validator(laps_schema, json, os)
+    processes = processes or os.cpu_count() or 1
+    if processes > 1 and len(experiment_files) > 1:
+        chunk = max(1, len(experiment_files) // (4 * processes))
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(validator,)) as pool:
+            results = dict(zip(experiment_files, pool.map(_validate_file, experiment_files,
+                                                          [max_errors] * len(experiment_files), chunksize=chunk)))
+    else:
+        _init_worker(validator)
+        results = {path: _validate_file(path, max_errors) for path in experiment_files}
+
+    if verbose:
+        for path, errors in results.items():
+            if errors:
+                print(path)
+                for error in errors:
+                    print('      ', error)
+        print("Validated {} file(s): {} valid, {} invalid".format(
+            len(results), sum(not errors for errors in results.values()),
+            sum(bool(errors) for errors in results.values())))
+    return results
+
+
+# Validator of the worker process (set by _init_worker)
+_worker_validator = None
+
+
+def _init_worker(validator):
+    """
+    Keep the validator in the process, once, for _validate_file.
+    """
+    global _worker_validator
+    _worker_validator = validator
+
+
+def _validate_file(path, max_errors):
+    """
+    Parse and validate one experiment file with the validator of the process.
+    """
+    import json
+
+    try:
+        with open(path, 'rb') as f:
+            instance = json.loads(f.read().decode('utf-8'))
+    except (OSError, ValueError) as error:
+        return ['(file): ' + type(error).__name__ + ': ' + str(error)]
+    return _worker_validator.validate(instance, max_errors)
+
+
+def check_experiment(schema, validate, json, os):
+    """
+    Reject an experiment before LAPS_1 or LAPS_2 writes anything, if it is not valid (the 'validate' option).
+
+    Parameters:
+    schema (CompiledSchema): The experiment schema compiled by LAPS_0_compile_schema.
+    validate (bool or str): False to skip the check, True to check against the default LAPS schema,
+                            or the path to the LAPS schema to check against.
+    json (module): The JSON module to parse the schema files.
+    os (module): The operating system module for file operations.
+
+    Returns:
+    None
+
+    Raises:
+    ValueError: If the experiment is not valid, listing its first errors.
+    """
+    if not validate:
+        return
+    validator = LAPS_0_compile_validator(validate if isinstance(validate, str) else None, json, os)
+    errors = validator.validate(schema.metadata, max_errors=20)
+    if errors:
+        raise ValueError("The experiment JSON is not valid for the LAPS schema:\n    " + "\n    ".join(errors))
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import os
+    import sys
+
+    parser = argparse.ArgumentParser(description="Validate LAPS experiment JSON files against the LAPS schema.")
+    parser.add_argument('experiments', nargs='+', help="experiment JSON files, or folders holding them")
+    parser.add_argument('--schema', default=None, help="the LAPS schema (default: " + DEFAULT_LAPS_SCHEMA + ")")
+    parser.add_argument('--processes', type=int, default=1, help="number of worker processes (0: CPUs)")
+    parser.add_argument('--max-errors', type=int, default=100, help="errors kept per file (default: 100)")
+    args = parser.parse_args()
+
+    results = {}
+    for experiments in args.experiments:
+        results.update(LAPS_0_validate(experiments, json, os, laps_schema=args.schema,
+                                       processes=args.processes or None, max_errors=args.max_errors))
+    sys.exit(1 if any(results.values()) else 0)
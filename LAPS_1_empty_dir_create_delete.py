@@ -4,98 +4,76 @@
 
 ## !!! This will DELETE your data
 
-def LAPS_1_empty_dir_create_delete(schema_path, target_dir, json, os):
+def LAPS_1_empty_dir_create_delete(schema_path, target_dir, json, os, dry_run=False, background_delete=False,
+                                   progress=None, trace_file=None, validate=False):
     """
     Create an empty directory structure based on the provided JSON schema file.
     The directory structure will be created in a empty folder. 
     If this folder already exists, it will be DELETED and recreated.
 
     Parameters:
-    schema_path (str): The path to the JSON schema file that defines the directory structure.
+    schema_path (str or CompiledSchema): The path to the JSON schema file that defines the directory structure,
+                                         or the schema compiled by LAPS_0_compile_schema.
     target_dir (str): The path to the target directory where the empty directory structure will be created.
     json (module): The JSON module to load and parse the JSON schema.
     os (module): The operating system module for directory operations.
+    dry_run (bool, optional): If True, only print what would be deleted and created. Defaults to False.
+    background_delete (bool, optional): If True, the existing directory is renamed to a hidden sibling
+                                        ('.<name>.LAPS-deleting-<id>') and deleted in a background thread,
+                                        so the new structure is created without waiting. Defaults to False.
+    progress (callable, optional): Called with a dictionary at the start and the end
+                                   (see LAPS_instrumentation.LAPSTrace), e.g. LAPS_instrumentation.print_progress.
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
+    validate (bool or str, optional): If True (or the path to a LAPS schema), the experiment JSON is first checked
+                                      against the LAPS schema (Schema/laps.schema_new5.json by default, see
+                                      LAPS_0_validate), and a ValueError listing the errors is raised before
+                                      anything is deleted or created if it is not valid. Defaults to False.
 
     Returns:
-    None
+    dict: The plan made by LAPS_1_plan_directory.fresh_plan (the list of created directories).
 
     This function reads the JSON schema file, creates directories, and subdirectories based on the schema.
     It also handles the case where the target directory already exists, recursively deleting its contents before recreating it.
     The function is designed to create the empty structure for further data population.
     """
-
-    # Directory creation function
-    def create_directory(path):
-        """
-        Create a directory at the given path if it does not already exist.
-
-        Parameters:
-        path (str): The path to the directory that needs to be created.
-
-        Returns:
-        None
-        """
-        if not os.path.exists(path):
-            os.makedirs(path)
-
-    # Parse the JSON
-    with open(schema_path, 'r') as f:
-        json_data = json.load(f)
-
-    # Delete the target directory if it exists
-    if os.path.exists(target_dir):
-        # Recursively walk through the directory structure in reverse order
-        for root, dirs, files in os.walk(target_dir, topdown=False):
-            for file in files:
-                os.remove(os.path.join(root, file))      # remove files
-            for dir in dirs:
-                os.rmdir(os.path.join(root, dir))        # remove directories
-        os.rmdir(target_dir)                            # remove the target directory itself
-
-    # Create directories for the first tier of subfields within "object"
-    create_directory(target_dir)
-
-    if isinstance(json_data, dict):
-        for key, value in json_data.items():
-            sub_dir = os.path.join(target_dir, key)       # create a subdirectory path within the target directory
-            create_directory(sub_dir)                     # create the subdirectory
-
-            if key == "data" and isinstance(value, dict) and "datasets" in value:
-                datasets_dir = os.path.join(sub_dir, "datasets")
-                create_directory(datasets_dir)             # create the "datasets" subdirectory
-
-                if "datasets" in value:
-                    for dataset in value["datasets"]:
-                        data_value = dataset.get("data", "")
-                        dataset_id = dataset.get("index", "")
-                        if data_value:
-                            if dataset_id:
-                                dataset_subdir = os.path.join(datasets_dir, data_value.replace(" ", "_") + "_" + dataset_id)
-                            else:
-                                dataset_subdir = os.path.join(datasets_dir, data_value)
-                            create_directory(dataset_subdir)  # create subdirectories for datasets
-
-                            #print(dataset_subdir)             # print the dataset subdirectory path
-
-            elif isinstance(value, dict) and "documents" in value:
-                documents_dir = os.path.join(sub_dir, "documents")
-                create_directory(documents_dir)              # create the "documents" subdirectory
-            
-            # Add this part to handle the "daq" case
-            elif key == "daq" and isinstance(value, dict) and "devices" in value:
-                devices_dir = os.path.join(sub_dir, "devices")
-                create_directory(devices_dir)              # create the "devices" subdirectory
-
-                devices_value = value.get("devices", [])
-                for device in devices_value:
-                    device_name = device.get("name", "")
-                    if device_name:
-                        device_subdir = os.path.join(devices_dir, device_name)
-                        create_directory(device_subdir)       # create subdirectory for device name
-                    
-                        # Create "documents" subdirectory within the device's subdirectory
-                        device_documents_dir = os.path.join(device_subdir, "documents")
-                        create_directory(device_documents_dir)
-
-    print("Empty directory created successfully. Please populate it with data for further processing.")
-    print(target_dir)
\ No newline at end of file
+    import shutil
+    from LAPS_0_compile_schema import load_schema
+    from LAPS_0_validate import check_experiment
+    from LAPS_1_plan_directory import fresh_plan, apply_plan, print_plan, move_aside, remove_in_background
+    from LAPS_instrumentation import LAPSTrace, FS_METADATA, CPU
+
+    # Timing of the run, reported to progress and trace_file
+    with LAPSTrace('LAPS_1_empty_dir_create_delete', progress, trace_file, target_dir=target_dir) as trace:
+
+        # Parse the JSON (or reuse the compiled schema)
+        with trace.timer(CPU):
+            schema = load_schema(schema_path, json, os)
+            check_experiment(schema, validate, json, os)
+
+        # The whole schema is created in a fresh directory, so nothing has to be scanned
+        exists = os.path.lexists(target_dir)
+        plan = fresh_plan(schema)
+        if dry_run:
+            if exists:
+                print("Would DELETE:", target_dir)
+            print_plan(plan, target_dir)
+            trace.finish(dry_run=True)
+            return plan
+
+        # Delete the target directory if it exists
+        with trace.timer(FS_METADATA):
+            if exists:
+                if background_delete:
+                    # Free the path at once and delete the old contents while the new structure is created
+                    remove_in_background(move_aside(target_dir, os))
+                else:
+                    shutil.rmtree(target_dir)
+
+            # Create the target directory and the directories of the schema (datasets, documents, devices),
+            # in schema order
+            apply_plan(plan, target_dir, os)
+
+        trace.finish(created=len(plan['create']), deleted=exists)
+        print("Empty directory created successfully. Please populate it with data for further processing.")
+        print(target_dir)
+        return plan
@@ -2,87 +2,64 @@
 # Ekaterina Bolotskaya
 # 07/17/2023
 
-def LAPS_1_empty_dir_create_update(schema_path, target_dir, json, os):
+def LAPS_1_empty_dir_create_update(schema_path, target_dir, json, os, dry_run=False, progress=None, trace_file=None,
+                                   validate=False):
     """
     Update the directory structure based on the provided JSON schema file.
     If this folder already exists, it will be UPDATED. The folders that exist, but no longer correspond to the .json structure
     will be deleted if empty and kept if not empty.
 
     Parameters:
-    schema_path (str): The path to the JSON schema file that defines the directory structure.
+    schema_path (str or CompiledSchema): The path to the JSON schema file that defines the directory structure,
+                                         or the schema compiled by LAPS_0_compile_schema.
     target_dir (str): The path to the target directory where the directory structure will be created/updated.
     json (module): The JSON module to load and parse the JSON schema.
     os (module): The operating system module for directory operations.
+    dry_run (bool, optional): If True, only print what would be created, removed and kept. Defaults to False.
+    progress (callable, optional): Called with a dictionary at the start and the end
+                                   (see LAPS_instrumentation.LAPSTrace), e.g. LAPS_instrumentation.print_progress.
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
+    validate (bool or str, optional): If True (or the path to a LAPS schema), the experiment JSON is first checked
+                                      against the LAPS schema (Schema/laps.schema_new5.json by default, see
+                                      LAPS_0_validate), and a ValueError listing the errors is raised before
+                                      anything is created or removed if it is not valid. Defaults to False.
 
     Returns:
-    None
+    dict: The plan made by LAPS_1_plan_directory.plan_directory (the lists of created, removed and kept directories).
 
     This function reads the JSON schema file, creates directories, and subdirectories based on the schema.
     The function is designed to update the structure, preserving existing data.
+    The target directory is scanned once (os.scandir) and only the missing directories are created, with one
+    os.mkdir each, instead of testing every directory of the schema.
     """
-
-    # Directory creation function
-    def create_directory(path):
-        """
-        Create a directory at the given path if it does not already exist.
-
-        Parameters:
-        path (str): The path to the directory that needs to be created.
-
-        Returns:
-        None
-        """
-        if not os.path.exists(path):
-            os.makedirs(path)
-
-    # Parse the JSON
-    with open(schema_path, 'r') as f:
-        json_data = json.load(f)
-
-    # Create directories for the first tier of subfields within "object"
-    create_directory(target_dir)
-
-    if isinstance(json_data, dict):
-        for key, value in json_data.items():
-            sub_dir = os.path.join(target_dir, key)       # create a subdirectory path within the target directory
-            create_directory(sub_dir)                     # create the subdirectory
-
-            if key == "data" and isinstance(value, dict) and "datasets" in value:
-                datasets_dir = os.path.join(sub_dir, "datasets")
-                create_directory(datasets_dir)             # create the "datasets" subdirectory
-
-                if "datasets" in value:
-                    for dataset in value["datasets"]:
-                        data_value = dataset.get("data", "")
-                        dataset_id = dataset.get("index", "")
-                        if data_value:
-                            if dataset_id:
-                                dataset_subdir = os.path.join(datasets_dir, data_value.replace(" ", "_") + "_" + dataset_id)
-                            else:
-                                dataset_subdir = os.path.join(datasets_dir, data_value)
-                            create_directory(dataset_subdir)  # create subdirectories for datasets
-
-                            #print(dataset_subdir)             # print the dataset subdirectory path
-
-            elif isinstance(value, dict) and "documents" in value:
-                documents_dir = os.path.join(sub_dir, "documents")
-                create_directory(documents_dir)              # create the "documents" subdirectory
-            
-            # Add this part to handle the "daq" case
-            elif key == "daq" and isinstance(value, dict) and "devices" in value:
-                devices_dir = os.path.join(sub_dir, "devices")
-                create_directory(devices_dir)              # create the "devices" subdirectory
-
-                devices_value = value.get("devices", [])
-                for device in devices_value:
-                    device_name = device.get("name", "")
-                    if device_name:
-                        device_subdir = os.path.join(devices_dir, device_name)
-                        create_directory(device_subdir)       # create subdirectory for device name
-                    
-                        # Create "documents" subdirectory within the device's subdirectory
-                        device_documents_dir = os.path.join(device_subdir, "documents")
-                        create_directory(device_documents_dir)
-
-    print("Empty directory created successfully. Please populate it with data for further processing.")
-    print(target_dir)
\ No newline at end of file
+    from LAPS_0_compile_schema import load_schema
+    from LAPS_0_validate import check_experiment
+    from LAPS_1_plan_directory import plan_directory, apply_plan, print_plan
+    from LAPS_instrumentation import LAPSTrace, FS_METADATA, CPU
+
+    # Timing of the run, reported to progress and trace_file
+    with LAPSTrace('LAPS_1_empty_dir_create_update', progress, trace_file, target_dir=target_dir) as trace:
+
+        # Parse the JSON (or reuse the compiled schema)
+        with trace.timer(CPU):
+            schema = load_schema(schema_path, json, os)
+            check_experiment(schema, validate, json, os)
+
+        # Compare the schema directories (datasets, documents, devices) with the target directory, scanning it once
+        with trace.timer(FS_METADATA):
+            plan = plan_directory(schema, target_dir, os)
+        if dry_run:
+            print_plan(plan, target_dir)
+            trace.finish(dry_run=True)
+            return plan
+
+        # Create the missing directories in schema order, and remove the empty ones no longer in the schema
+        with trace.timer(FS_METADATA):
+            apply_plan(plan, target_dir, os)
+        trace.finish(created=len(plan['create']), removed=len(plan['remove']), kept=len(plan['keep']))
+        for path in plan['keep']:
+            print("Kept (not in the schema, not empty):", path)
+
+        print("Empty directory created successfully. Please populate it with data for further processing.")
+        print(target_dir)
+        return plan
@@ -0,0 +1,169 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+def plan_directory(schema, target_dir, os):
+    """
+    Compare the directory structure of a schema with what exists on disk, scanning the target only once.
+
+    Parameters:
+    schema (CompiledSchema): The schema compiled by LAPS_0_compile_schema.
+    target_dir (str): The path to the target directory.
+    os (module): The operating system module for directory operations.
+
+    Returns:
+    dict: The plan, with '/'-separated paths relative to target_dir:
+          'create_root' (bool): True if target_dir itself must be created.
+          'create' (list): The schema directories to create, parents first.
+          'remove' (list): The directories that are not in the schema and hold no files, children first.
+          'keep' (list): The directories that are not in the schema but hold files (left untouched).
+
+    Only the directories that hold schema directories (the root, 'data', 'data/datasets', 'daq/devices', ...)
+    are listed, once each, with os.scandir. Dataset and documents folders hold the user data and are not scanned;
+    a folder that is no longer in the schema is scanned only until its first file is found.
+    """
+    plan = {'create_root': False, 'create': [], 'remove': [], 'keep': []}
+    schema_directories = list(dict.fromkeys(schema.directories))  # once each, in order (a schema may repeat a folder)
+    wanted = set(schema_directories)
+    parents = {path.rpartition('/')[0] for path in schema_directories}
+
+    # Function to list the subdirectories of a directory (None if it does not exist)
+    def list_directories(path):
+        try:
+            with os.scandir(path) as entries:
+                return [entry for entry in entries if entry.is_dir()]
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    # Function to collect an unused directory tree bottom-up, or return None as soon as a file is found
+    def empty_tree(path):
+        found = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_symlink() or not entry.is_dir(follow_symlinks=False):
+                    return None
+                below = empty_tree(entry.path)
+                if below is None:
+                    return None
+                found.extend(below)
+        found.append(path)
+        return found
+
+    # Scan the root and every existing directory holding schema directories, parents first
+    existing = set()
+    for parent in [''] + [path for path in schema_directories if path in parents]:
+        if parent and parent not in existing:
+            continue  # not on disk, so neither are its subdirectories
+        directories = list_directories(os.path.join(target_dir, *parent.split('/')) if parent else target_dir)
+        if directories is None:
+            plan['create_root'] = not parent
+            continue
+        for entry in directories:
+            path = parent + '/' + entry.name if parent else entry.name
+            if path in wanted:
+                existing.add(path)
+                continue
+            tree = None if entry.is_symlink() else empty_tree(entry.path)
+            if tree is None:
+                plan['keep'].append(path)
+            else:
+                plan['remove'].extend(os.path.relpath(item, target_dir).replace(os.sep, '/') for item in tree)
+
+    plan['create'] = [path for path in schema_directories if path not in existing]
+    return plan
+
+
+def fresh_plan(schema):
+    """
+    Return the plan creating the directory structure of a schema in a directory that does not exist.
+
+    Parameters:
+    schema (CompiledSchema): The schema compiled by LAPS_0_compile_schema.
+
+    Returns:
+    dict: The plan, as returned by plan_directory.
+    """
+    return {'create_root': True, 'create': list(dict.fromkeys(schema.directories)), 'remove': [], 'keep': []}
+
+
+def apply_plan(plan, target_dir, os):
+    """
+    Apply a plan made by plan_directory, with one system call per directory created or removed.
+
+    Parameters:
+    plan (dict): The plan returned by plan_directory.
+    target_dir (str): The path to the target directory.
+    os (module): The operating system module for directory operations.
+
+    Returns:
+    None
+    """
+    if plan['create_root']:
+        os.makedirs(target_dir)
+    for path in plan['remove']:
+        os.rmdir(os.path.join(target_dir, *path.split('/')))
+    for path in plan['create']:
+        os.mkdir(os.path.join(target_dir, *path.split('/')))
+
+
+def print_plan(plan, target_dir):
+    """
+    Print a plan made by plan_directory.
+
+    Parameters:
+    plan (dict): The plan returned by plan_directory.
+    target_dir (str): The path to the target directory.
+
+    Returns:
+    None
+    """
+    print(target_dir + (' (to be created)' if plan['create_root'] else ''))
+    for path in plan['create']:
+        print('   create  ', path)
+    for path in plan['remove']:
+        print('   remove  ', path, '(empty, not in the schema)')
+    for path in plan['keep']:
+        print('   keep    ', path, '(not in the schema, holds data)')
+    if not (plan['create_root'] or plan['create'] or plan['remove'] or plan['keep']):
+        print('   nothing to do')
+
+
+def move_aside(target_dir, os):
+    """
+    Rename a directory to a hidden sibling so it can be deleted later, leaving its path free at once.
+
+    Parameters:
+    target_dir (str): The path to the directory.
+    os (module): The operating system module for directory operations.
+
+    Returns:
+    str: The new path of the directory.
+
+    The sibling is in the same parent directory, so the rename does not move any data, even on network shares.
+    """
+    import uuid
+
+    parent, name = os.path.split(os.path.abspath(target_dir))
+    aside = os.path.join(parent, '.' + name + '.LAPS-deleting-' + uuid.uuid4().hex)
+    os.rename(target_dir, aside)
+    return aside
+
+
+def remove_in_background(path):
+    """
+    Delete a directory tree in a background thread.
+
+    Parameters:
+    path (str): The path to the directory.
+
+    Returns:
+    threading.Thread: The started thread. It is not a daemon thread, so Python waits for the deletion
+                      to finish before exiting.
+    """
+    import shutil
+    import threading
+
+    thread = threading.Thread(target=shutil.rmtree, args=(path,), kwargs={'ignore_errors': True},
+                              name='LAPS-delete')
+    thread.start()
+    return thread
@@ -2,100 +2,350 @@
 # Ekaterina Bolotskaya
 # 07/17/2023
 
-def LAPS_2_HDF5_from_directory(scdir, data_folder, hdf5_file, json, os, np, h5py):
+def LAPS_2_HDF5_from_directory(scdir, data_folder, hdf5_file, json, os, np, h5py,
+                               timeseries=False, block_size=None, update=False, workers=1, dedup=False,
+                               filters=None, progress=None, trace_file=None, validate=False):
     """
     Convert the populated directory structure into HDF5 format for storage or exchange.
     The function will generate an HDF5 file, containing the data from the directory structure.
 
     Parameters:
-    scdir (str): The path to the JSON schema file that defines the directory structure.
+    scdir (str or CompiledSchema): The path to the JSON schema file that defines the directory structure,
+                                   or the schema compiled by LAPS_0_compile_schema.
     data_folder (str): The path to the populated directory.
     hdf5_file (str): The output HDF5 file path where the data will be stored in HDF5 format.
     json (module): The JSON module to load and parse the JSON schema.
     os (module): The operating system module for file and directory operations.
     np (module): The NumPy module for numerical operations.
     h5py (module): The h5py module for working with HDF5 files.
+    timeseries (bool, optional): If True, .txt files inside a dataset folder whose schema entry has 'headers'
+                                 (e.g. Time_Series_1) are stored as chunked, compressed 2-D float datasets
+                                 with one column per header. Defaults to False (all files stored as binary).
+    block_size (int, optional): If given, files are copied into chunked 1-D uint8 datasets block_size bytes at a time,
+                                so the memory used does not grow with the file size (time series parsed in
+                                timeseries mode are still read whole). Defaults to None (each file read at once).
+    update (bool, optional): If True and the HDF5 file exists, only datasets whose source file changed
+                             (size, modification time and content hash) are rewritten, datasets of deleted files
+                             are removed, and the schema metadata is refreshed. Defaults to False (the HDF5 file
+                             is deleted and rebuilt).
+    workers (int, optional): The number of threads that read, hash and parse files in parallel while a single
+                             writer (the calling thread) stores them in the HDF5 file in directory order.
+                             The result is the same as with one worker. Defaults to 1.
+    dedup (bool, optional): If True, each unique file content is stored once in the '.LAPS/blobs' group and every
+                            path with that content is a hard link to it. Defaults to False.
+    filters (str or dict, optional): The compression policy: 'default' (LAPS_filter_policy.DEFAULT_POLICY) or
+                                     a dictionary mapping 'numeric' (time series stored as matrices), file extensions
+                                     (e.g. '.txt') or dataset types (e.g. 'Imaging') and '*' to a filter spec
+                                     ('none', 'lzf', 'gzip:6', 'shuffle+gzip:4', ...). Files with a compressing
+                                     spec are stored as chunked 1-D uint8 datasets with automatic chunk sizes.
+                                     Defaults to None (files stored uncompressed, time series as 'shuffle+gzip:4').
+    progress (callable, optional): Called with a dictionary for the start, every file written and the end
+                                   (see LAPS_instrumentation.LAPSTrace), e.g. LAPS_instrumentation.print_progress.
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
+    validate (bool or str, optional): If True (or the path to a LAPS schema), the experiment JSON is first checked
+                                      against the LAPS schema (Schema/laps.schema_new5.json by default, see
+                                      LAPS_0_validate), and a ValueError listing the errors is raised before
+                                      anything is written if it is not valid. Defaults to False.
 
     Returns:
-    None
+    dict: For each filter spec used, the number of files written, their size ('bytes'), their size in the
+          HDF5 file ('stored_bytes') and the time spent writing them ('seconds'). With filters, it is also printed.
 
     This function reads the populated directory structure and converts it into HDF5 format.
     The directory structure is recursively traversed, and datasets are created in the HDF5 file
     based on the files present in the directories. The data is read from files and stored in the HDF5 file
-    as binary datasets. The function handles various file extensions such as .csv, .txt, .xls, .xlsx, .jpg, .jpeg, .png, etc.
-    The JSON schema is also saved as an attribute of the root group in the HDF5 file.
+    as binary datasets (uncompressed files as contiguous 1-D uint8 datasets, which LAPS_3 extracts by byte offset).
+    The function handles various file extensions such as .csv, .txt, .xls, .xlsx, .jpg, .jpeg, .png, etc.
+    The JSON schema is also saved in the HDF5 file, as a compressed dataset with its key fields (experiment project,
+    apparatus and sample names, dataset fields, headers and units, device names) copied to the attributes of the
+    matching groups (see LAPS_metadata.write_metadata).
+    In timeseries mode the preamble lines and the text formatting are kept as attributes of the dataset,
+    so LAPS_3_create_directory_from_HDF5 writes the original file back byte-for-byte. Files that cannot be
+    reproduced exactly from the parsed numbers are stored as binary datasets as usual.
+    The size, modification time and SHA-256 hash of each source file are stored as attributes of its dataset
+    (and, for time series stored as matrices, the hash of the values), and the list of files and directories with
+    their sizes and hashes as the manifest '.LAPS/manifest', so LAPS_verify can check the HDF5 file without
+    extracting it.
+    In update mode, the derived channels saved by LAPS_4_derive_channels are kept, except those of deleted files.
+    Note that HDF5 does not shrink the file when datasets are removed in update mode; use h5repack to compact it.
+    With dedup, linked paths share one dataset and therefore one set of attributes; the modification time
+    of the last file written is kept, so update mode may rehash identical files to confirm they are unchanged.
     """
+    import time
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from LAPS_0_compile_schema import load_schema
+    from LAPS_0_validate import check_experiment
+    from LAPS_instrumentation import LAPSTrace, FS_READ, FS_METADATA, HDF5_WRITE, HDF5_METADATA, CPU
+    from LAPS_timeseries_format import TIMESERIES_LAYOUT, parse_timeseries_text, write_timeseries_dataset
+    from LAPS_stream_copy import write_file_to_dataset, write_bytes_to_dataset
+    from LAPS_filter_policy import load_policy, policy_spec, filter_options, auto_chunk_size, print_filter_report
+    from LAPS_source_tracking import file_sha256, new_hasher, record_source, source_unchanged, update_matrix_hash
+    from LAPS_dedup import INTERNAL_GROUP, blob_group, find_blob, remove_unreferenced_blobs
+    from LAPS_metadata import write_metadata
+    from LAPS_verify import write_manifest
+    from LAPS_4_derived_channels import remove_orphaned_channels
 
-    # Open JSON file and load metadata
-    with open(scdir, 'r') as f:
-        metadata = json.load(f)  # load metadata from the JSON file
-
-    # Remove HDF5 file if it exists
-    if os.path.exists(hdf5_file):
-        os.remove(hdf5_file)  # delete the HDF5 file if it exists
-
-    # Function to create nested groups based on directory structure
-    def create_nested_groups(f, path):
-        """
-        Recursively create nested groups in the HDF5 file based on the directory structure.
-        """
-        groups = path.split(os.sep)
-        for group_name in groups:
-            if group_name:
-                if group_name not in f:  # create a new group if it doesn't exist
-                    f.create_group(group_name)
-                f = f[group_name]
-
-    # Open HDF5 file in append mode
-    with h5py.File(hdf5_file, 'a') as f:
-        # Save metadata JSON as an attribute of the root group
-        metadata_str = json.dumps(metadata, indent=4)
-        f.attrs['Schema_json'] = metadata_str
-
-        # Loop through each directory and subdirectory
-        for root, dirs, files in os.walk(data_folder):
-            group_path = os.path.relpath(root, data_folder)
-            create_nested_groups(f, group_path)
-            group = f
-            if group_path != '.':
-                groups = group_path.split(os.sep)
-                for sub_group_name in groups:
-                    group = group[sub_group_name]
-
-            for file_name in files:
-                file_path = os.path.join(root, file_name)
-
-                # Skip non-regular files
-                if not os.path.isfile(file_path):
-                    continue
-
-                # Get the file extension
-                extension = os.path.splitext(file_name)[1]
-
-                # Check if dataset already exists and delete it
-                if file_name in group:
-                    del group[file_name]
-
-                if extension in [".csv", ".txt", ".xls", ".xlsx"]:
-                    # Read the file as binary
-                    with open(file_path, "rb") as file:
-                        binary_data = file.read()
-                    binary_data_vla = np.asarray(binary_data)
-                    group.create_dataset(file_name, data=binary_data_vla)
-
-                elif extension in [".jpg", ".jpeg", ".png"]:
-                    # Read the image file as binary
-                    with open(file_path, 'rb') as img_f:
-                        binary_data = img_f.read()  # read the image as python binary
-                    binary_data_vla = np.asarray(binary_data)
-                    group.create_dataset(file_name, data=binary_data_vla)
+    # Timing and counters of the run, reported to progress and trace_file
+    with LAPSTrace('LAPS_2_HDF5_from_directory', progress, trace_file, data_folder=data_folder,
+                   hdf5_file=hdf5_file) as trace:
 
+        # Open JSON file and load metadata (or reuse the compiled schema)
+        with trace.timer(CPU):
+            schema = load_schema(scdir, json, os)
+            check_experiment(schema, validate, json, os)
+
+        # Compression policy (None keeps the original uncompressed layout)
+        policy = load_policy(filters) if filters else None
+        filter_stats = {}
+
+        # Remove HDF5 file if it exists (unless it is updated in place)
+        if os.path.exists(hdf5_file) and not update:
+            os.remove(hdf5_file)  # delete the HDF5 file if it exists
+
+        # Function to hash a file already read into memory
+        def sha256_of(binary_data):
+            """
+            Return the SHA-256 hex digest of the given bytes.
+            """
+            with trace.timer(CPU):
+                hasher = new_hasher()
+                hasher.update(binary_data)
+                return hasher.hexdigest()
+
+        # Function to read and convert a file (runs in the worker threads, no HDF5 access)
+        def prepare_file(task):
+            """
+            Read, hash and (in timeseries mode) parse a file before it is written to the HDF5 file.
+
+            Returns a tuple (kind, payload, digest, seconds): kind is 'timeseries' (payload = (parsed, labels,
+            hash of the matrix values)),
+            'bytes' (payload = file content) or 'stream' (the writer copies the file block by block).
+            """
+            group_path, file_name, file_path, extension, stat = task
+            start = time.perf_counter()
+
+            # Store time series as a numeric matrix if the schema describes its columns
+            if timeseries and extension == ".txt":
+                labels = schema.headers_for_path(os.path.join(group_path, file_name), os)
+                if labels:
+                    with trace.timer(FS_READ):
+                        with open(file_path, "rb") as file:
+                            binary_data = file.read()
+                    with trace.timer(CPU):
+                        parsed = parse_timeseries_text(binary_data, len(labels), np)
+                    if parsed is not None:
+                        digest = sha256_of(binary_data)
+                        with trace.timer(CPU):
+                            data_hasher = new_hasher()
+                            update_matrix_hash(data_hasher, parsed['matrix'], np)
+                        return 'timeseries', (parsed, labels, data_hasher.hexdigest()), digest, \
+                            time.perf_counter() - start
+
+            # Large files are streamed by the writer instead of being held in memory
+            # (hashed beforehand if the hash decides whether they need to be written at all)
+            if block_size:
+                digest = None
+                if dedup:
+                    with trace.timer(FS_READ):
+                        digest = file_sha256(file_path, block_size)
+                return 'stream', None, digest, time.perf_counter() - start
+
+            # Read the file as binary
+            with trace.timer(FS_READ):
+                with open(file_path, "rb") as file:
+                    binary_data = file.read()
+            digest = sha256_of(binary_data)
+            return 'bytes', binary_data, digest, time.perf_counter() - start
+
+        # Function to write a prepared file (runs in the calling thread only, h5py writes stay serialized)
+        def store_file(group, task, prepared):
+            """
+            Create the dataset of a file prepared by prepare_file.
+            """
+            group_path, file_name, file_path, extension, stat = task
+            kind, payload, digest, prepare_seconds = prepared
+            start = time.perf_counter()
+
+            # Pick the filters of the file from the policy
+            if policy is not None:
+                entry = schema.entry_for_path(os.path.join(group_path, file_name), os)
+                spec = policy_spec(policy, extension, entry.get('data') if entry else None, kind == 'timeseries')
+                options = filter_options(spec)
+            else:
+                spec = 'shuffle+gzip:4' if kind == 'timeseries' else 'none'
+                options = None
+
+            # Check if dataset already exists and delete it
+            if file_name in group:
+                del group[file_name]
+
+            # Identical content is stored once and linked to every path
+            if dedup:
+                dataset = find_blob(group.file, digest)
+                target_group, target_name = blob_group(group.file), digest
+            else:
+                dataset = None
+                target_group, target_name = group, file_name
+
+            written = dataset is None
+            write_start = time.perf_counter()
+            trace.add_time(HDF5_METADATA, write_start - start)
+
+            if dataset is not None:
+                pass  # content already stored
+
+            elif kind == 'timeseries':
+                parsed, labels = payload[:2]
+                if policy is not None:
+                    dataset = write_timeseries_dataset(target_group, target_name, parsed, labels,
+                                                       **(options or {'compression': None, 'compression_opts': None,
+                                                                      'shuffle': False}))
                 else:
-                    # Read other file types as binary
-                    with open(file_path, "rb") as file:
-                        binary_data = file.read()
-                    binary_data_vla = np.asarray(binary_data)
-                    group.create_dataset(file_name, data=binary_data_vla)
-
-    print("HDF5 created successfully.")
-    print(hdf5_file)
\ No newline at end of file
+                    dataset = write_timeseries_dataset(target_group, target_name, parsed, labels)
+
+            elif kind == 'stream':
+                # Stream the file into a chunked uint8 dataset block by block
+                hasher = new_hasher()
+                dataset = write_file_to_dataset(target_group, target_name, file_path, block_size, os, np, hasher,
+                                                options, auto_chunk_size(stat.st_size) if options else None, trace)
+                digest = hasher.hexdigest()
+                write_start = time.perf_counter()  # the copy already added its reading, writing and hashing times
+
+            elif options is not None:
+                # Compressed files are chunked, so they are stored as 1-D uint8 datasets
+                dataset = write_bytes_to_dataset(target_group, target_name, payload, np,
+                                                 auto_chunk_size(len(payload)), options)
+
+            else:
+                # Uncompressed files are contiguous 1-D uint8 datasets, so LAPS_3 can copy them by byte offset
+                dataset = write_bytes_to_dataset(target_group, target_name, payload, np)
+
+            trace.add_time(HDF5_WRITE, time.perf_counter() - write_start)
+
+            # Count the file in the statistics of its filter spec
+            stored_bytes = dataset.id.get_storage_size() if written else 0
+            if written:
+                item = filter_stats.setdefault(spec, {'files': 0, 'bytes': 0, 'stored_bytes': 0, 'seconds': 0.0})
+                item['files'] += 1
+                item['bytes'] += stat.st_size
+                item['stored_bytes'] += stored_bytes
+                item['seconds'] += time.perf_counter() - start
+
+            with trace.timer(HDF5_METADATA):
+                if dedup:
+                    group[file_name] = dataset  # hard link from the file path to the blob
+                record_source(dataset, stat, digest,
+                              payload[2] if kind == 'timeseries'
+                              and dataset.attrs.get('LAPS_layout') == TIMESERIES_LAYOUT else None)
+            trace.file_done(os.path.normpath(os.path.join(group_path, file_name)).replace(os.sep, '/'),
+                            prepare_seconds + time.perf_counter() - start, stat.st_size, stored_bytes)
+
+        # Function to create nested groups based on directory structure
+        def create_nested_groups(f, path):
+            """
+            Recursively create nested groups in the HDF5 file based on the directory structure.
+            """
+            groups = path.split(os.sep)
+            for group_name in groups:
+                if group_name:
+                    if group_name not in f:  # create a new group if it doesn't exist
+                        f.create_group(group_name)
+                    f = f[group_name]
+
+        # Open HDF5 file in append mode
+        with h5py.File(hdf5_file, 'a') as f:
+            # Paths of the groups and datasets that correspond to the current directory content
+            seen = set()
+            # Files to (re)write, in directory order: (group, task)
+            pending_files = []
+
+            # Loop through each directory and subdirectory
+            walk = os.walk(data_folder)
+            while True:
+                with trace.timer(FS_METADATA):
+                    root, dirs, files = next(walk, (None, None, None))
+                if root is None:
+                    break
+                group_path = os.path.relpath(root, data_folder)
+                with trace.timer(HDF5_METADATA):
+                    create_nested_groups(f, group_path)
+                    group = f
+                    if group_path != '.':
+                        groups = group_path.split(os.sep)
+                        for sub_group_name in groups:
+                            group = group[sub_group_name]
+                        seen.add(group.name)
+
+                for file_name in files:
+                    file_path = os.path.join(root, file_name)
+
+                    # Skip non-regular files
+                    with trace.timer(FS_METADATA):
+                        if not os.path.isfile(file_path):
+                            continue
+
+                        # Get the file extension
+                        extension = os.path.splitext(file_name)[1]
+                        stat = os.stat(file_path)
+                    seen.add(group.name.rstrip('/') + '/' + file_name)
+
+                    # Keep the dataset if its source file did not change since the last run
+                    with trace.timer(HDF5_METADATA):
+                        if update and file_name in group and isinstance(group[file_name], h5py.Dataset) \
+                                and source_unchanged(group[file_name], stat, file_path):
+                            continue
+
+                    pending_files.append((group, (group_path, file_name, file_path, extension, stat)))
+            trace.files_total = len(pending_files)
+
+            # Read files (in parallel if requested) and write them in order
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    in_flight = deque()  # bounded window of files read ahead of the writer
+                    for group, task in pending_files:
+                        in_flight.append((group, task, pool.submit(prepare_file, task)))
+                        if len(in_flight) >= 2 * workers:
+                            group, task, future = in_flight.popleft()
+                            store_file(group, task, future.result())
+                    while in_flight:
+                        group, task, future = in_flight.popleft()
+                        store_file(group, task, future.result())
+            else:
+                for group, task in pending_files:
+                    store_file(group, task, prepare_file(task))
+
+            # Drop the datasets and groups whose files and directories no longer exist
+            if update:
+                stale = []
+
+                def collect_stale(group, path):
+                    # Follow links rather than objects, so every hard-linked path is checked
+                    for name, item in group.items():
+                        item_path = path + '/' + name
+                        if item_path == '/' + INTERNAL_GROUP:
+                            continue
+                        if item_path not in seen:
+                            stale.append(item_path)
+                        elif isinstance(item, h5py.Group):
+                            collect_stale(item, item_path)
+
+                with trace.timer(HDF5_METADATA):
+                    collect_stale(f, '')
+                    for name in stale:
+                        del f[name]
+                    remove_unreferenced_blobs(f, h5py)
+                    remove_orphaned_channels(f, h5py)
+
+            # Save the schema JSON and its key fields as attributes of the matching groups,
+            # and the manifest of the stored files and directories (see LAPS_verify)
+            with trace.timer(HDF5_METADATA):
+                write_metadata(f, schema, np, h5py)
+                write_manifest(f, json, np, h5py)
+
+        trace.finish(filters=filter_stats)
+        if filters:
+            print_filter_report(filter_stats)
+        print("HDF5 created successfully.")
+        print(hdf5_file)
+        return filter_stats
\ No newline at end of file
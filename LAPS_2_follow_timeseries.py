@@ -0,0 +1,327 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+def LAPS_2_follow_timeseries(scdir, data_folder, file_path, hdf5_file, json, os, np, h5py, poll_interval=1.0,
+                             idle_timeout=None, stop=None, progress=None, trace_file=None):
+    """
+    Follow a time series file while the acquisition software appends rows to it, appending each new row
+    to a numeric dataset of an HDF5 file that can be read (and plotted) at the same time.
+
+    Parameters:
+    scdir (str or CompiledSchema): The path to the JSON schema file, or the schema compiled by LAPS_0_compile_schema.
+    data_folder (str): The path to the populated directory.
+    file_path (str): The path to the time series file, inside a dataset folder with headers (e.g. Time_Series_1).
+                     It does not have to exist yet.
+    hdf5_file (str): The HDF5 file to write to. It is created if it does not exist; an existing file must have been
+                     created by this function (SWMR needs the latest HDF5 file format).
+    json (module): The JSON module to load and parse the JSON schema.
+    os (module): The operating system module for file and directory operations.
+    np (module): The NumPy module for numerical operations.
+    h5py (module): The h5py module for working with HDF5 files.
+    poll_interval (float, optional): Seconds between two checks of the file size. Defaults to 1.0.
+    idle_timeout (float, optional): Stop when the file has not grown for this many seconds.
+                                    Defaults to None (only stop, or Ctrl+C / interrupting the kernel, stops).
+    stop (callable, optional): Called between checks; following stops when it returns True.
+    progress (callable, optional): Called with a dictionary at the start, after every append ('step' events with
+                                   'rows') and at the end (see LAPS_instrumentation.LAPSTrace).
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
+
+    Returns:
+    dict: 'path' (the dataset path in the HDF5 file), 'rows' (rows stored), 'bytes' (bytes of the file read)
+          and 'layout' ('timeseries', or 'bytes' if the file could not be stored as a numeric matrix).
+
+    Only the bytes appended since the last check are read and parsed. Complete rows are appended to a dataset
+    of the same layout as LAPS_2_HDF5_from_directory with timeseries=True (unlimited rows, chunked by column) and
+    flushed, with the file in SWMR (single writer, multiple readers) mode, so
+    LAPS_4_plot_timeseries_from_HDF5(..., live=True) can refresh the plot from it while the test runs.
+    When following stops, the rest of the file (a last row without line ending, or the lines after the numeric
+    block) is stored so LAPS_3 writes the file back byte-for-byte, and the source attributes are recorded:
+    a later LAPS_2_HDF5_from_directory(..., update=True) into the same HDF5 file adds the other files of the
+    directory and keeps this dataset without parsing the file again. A file whose rows cannot be reproduced from
+    the parsed numbers is stored as a binary dataset when following stops, as LAPS_2 does.
+
+    Usage example:
+    # While the test runs (one process or notebook)
+    LAPS_2_follow_timeseries(schema, 'Experiment', 'Experiment/data/datasets/Time_Series_1/run.txt', 'live.h5',
+                             json, os, np, h5py, idle_timeout=600)
+    # At the same time (another process or notebook)
+    LAPS_4_plot_timeseries_from_HDF5('live.h5', 'data/datasets/Time_Series_1/run.txt', json, os, np, h5py, live=True)
+    """
+    import time
+    from LAPS_0_compile_schema import load_schema
+    from LAPS_timeseries_format import write_timeseries_dataset
+    from LAPS_stream_copy import write_file_to_dataset
+    from LAPS_source_tracking import new_hasher, record_source, update_matrix_hash
+    from LAPS_metadata import write_metadata
+    from LAPS_verify import write_manifest
+    from LAPS_instrumentation import LAPSTrace, FS_READ, HDF5_WRITE, HDF5_METADATA, CPU
+
+    # Timing and counters of the run, reported to progress and trace_file
+    with LAPSTrace('LAPS_2_follow_timeseries', progress, trace_file, files_total=1, file_path=file_path,
+                   hdf5_file=hdf5_file) as trace:
+
+        # Find the headers of the file from its dataset folder
+        with trace.timer(CPU):
+            schema = load_schema(scdir, json, os)
+        relative_path = os.path.relpath(file_path, data_folder).replace(os.sep, '/')
+        labels = schema.headers_for_path(relative_path, os)
+        if not labels:
+            raise ValueError("Not a file of a dataset folder with headers in the schema: " + relative_path)
+        group_path, file_name = relative_path.rsplit('/', 1)
+
+        # SWMR can only be started on files in the latest format
+        if os.path.exists(hdf5_file):
+            with h5py.File(hdf5_file, 'r') as f:
+                superblock = f.id.get_create_plist().get_version()[0]
+            if superblock < 3:
+                raise ValueError("Cannot follow into " + hdf5_file + ": it was not created by LAPS_2_follow_timeseries "
+                                 "(SWMR needs the latest HDF5 file format); use a new HDF5 file")
+
+        tail = TimeseriesTail(len(labels), np)
+        hasher = new_hasher()
+        data_hasher = new_hasher()  # hash of the matrix values, updated as rows are appended
+        state = {'handle': None, 'offset': 0, 'rows': 0}
+
+        # Function to read what was appended to the file since the last call
+        def read_new():
+            with trace.timer(FS_READ):
+                if state['handle'] is None:
+                    if not os.path.exists(file_path):
+                        return b''
+                    state['handle'] = open(file_path, 'rb')
+                if os.fstat(state['handle'].fileno()).st_size < state['offset']:
+                    raise IOError("File was truncated while followed: " + file_path)
+                state['handle'].seek(state['offset'])
+                data = state['handle'].read()
+            with trace.timer(CPU):
+                hasher.update(data)
+            state['offset'] += len(data)
+            return data
+
+        # Function to append rows to the dataset and make them visible to the readers
+        def append_rows(dataset, rows):
+            with trace.timer(HDF5_WRITE):
+                n_rows = dataset.shape[0]
+                dataset.resize(n_rows + len(rows), axis=0)
+                dataset[n_rows:] = rows
+                dataset.flush()
+            with trace.timer(CPU):
+                update_matrix_hash(data_hasher, rows, np)
+            state['rows'] += len(rows)
+
+        f = h5py.File(hdf5_file, 'a', libver='latest')
+        dataset = None
+        try:
+            # Groups, metadata and the removal of an earlier copy must be done before SWMR starts
+            with trace.timer(HDF5_METADATA):
+                group = f.require_group(group_path)
+                write_metadata(f, schema, np, h5py)
+                if file_name in group:
+                    del group[file_name]
+
+            # Poll the file, appending complete rows as they arrive
+            idle_since = time.monotonic()
+            try:
+                while True:
+                    data = read_new()
+                    if data:
+                        idle_since = time.monotonic()
+                        with trace.timer(CPU):
+                            rows = tail.feed(data)
+                        if dataset is None and len(rows):
+                            with trace.timer(HDF5_WRITE):
+                                parsed = dict(tail.parsed, matrix=rows, trailer='', final_newline=True)
+                                dataset = write_timeseries_dataset(group, file_name, parsed, labels, resizable=True)
+                                f.swmr_mode = True
+                            with trace.timer(CPU):
+                                update_matrix_hash(data_hasher, rows, np)
+                            state['rows'] = len(rows)
+                        elif len(rows):
+                            append_rows(dataset, rows)
+                        trace.step(len(data), rows=state['rows'])
+                    elif (stop is not None and stop()) or \
+                            (idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout):
+                        break
+                    else:
+                        time.sleep(poll_interval)
+            except KeyboardInterrupt:
+                pass
+
+            # The last bytes: a row without line ending, or the end of the trailer
+            read_new()
+            with trace.timer(CPU):
+                rows = tail.finish()
+            if dataset is not None and len(rows):
+                append_rows(dataset, rows)
+        finally:
+            f.close()
+            if state['handle'] is not None:
+                state['handle'].close()
+
+        # Complete the dataset outside SWMR mode (attributes can only be added then)
+        layout = 'timeseries'
+        stored_bytes = 0
+        with h5py.File(hdf5_file, 'a', libver='latest') as f:
+            group = f[group_path]
+            with trace.timer(HDF5_METADATA):
+                if dataset is not None and not tail.failed:
+                    dataset = group[file_name]
+                    dataset.attrs['trailer'] = tail.trailer
+                    dataset.attrs['final_newline'] = tail.final_newline
+                    stat = os.stat(file_path)
+                    if stat.st_size == state['offset']:  # otherwise LAPS_2 with update=True parses it again
+                        record_source(dataset, stat, hasher.hexdigest(), data_hasher.hexdigest())
+                    stored_bytes = dataset.id.get_storage_size()
+                elif os.path.exists(file_path):
+                    # Not a reproducible numeric matrix: store the file as it is
+                    layout = 'bytes'
+                    state['rows'] = 0
+                    if file_name in group:
+                        del group[file_name]
+                    stat = os.stat(file_path)
+                    file_hasher = new_hasher()
+                    dataset = write_file_to_dataset(group, file_name, file_path, 1048576, os, np, file_hasher)
+                    record_source(dataset, stat, file_hasher.hexdigest())
+                    stored_bytes = dataset.id.get_storage_size()
+                write_manifest(f, json, np, h5py)
+
+        trace.file_done(relative_path, trace.elapsed(), 0, stored_bytes)
+        trace.finish(rows=state['rows'], layout=layout)
+        print("Time series followed:", state['rows'], "rows" if layout == 'timeseries' else "(stored as a binary file)")
+        print(hdf5_file)
+        return {'path': relative_path, 'rows': state['rows'], 'bytes': state['offset'], 'layout': layout}
+
+
+class TimeseriesTail:
+    """
+    Class parsing a time series text file incrementally, as it is written, into rows of numbers.
+
+    Attributes:
+    n_columns (int): The number of data columns (the number of headers in the schema).
+    parsed (dict or None): The format found at the first data row ('preamble', 'delimiter', 'newline', 'formats'),
+                           as returned by LAPS_timeseries_format.parse_timeseries_text.
+    ended (bool): True once a line that is not a data row was found (the rest of the file is the trailer).
+    failed (bool): True if the rows cannot be reproduced byte-for-byte from the parsed numbers.
+    trailer (str): The text after the numeric block (complete after finish()).
+    final_newline (bool): Whether the last data row ends with a line ending (known after finish()).
+
+    Methods:
+    feed(data): Parse the bytes appended to the file and return the new complete rows.
+    finish(): Parse the last bytes of the file (a row without line ending) and return the rows found.
+
+    The result is the same as parsing the finished file with parse_timeseries_text: the numeric block
+    starts at the first line with n_columns numbers, every row must be formatted like the first one,
+    and it ends at the first line that is not such a row.
+    """
+
+    def __init__(self, n_columns, np):
+        self.n_columns = n_columns
+        self.parsed = None
+        self.ended = False
+        self.failed = False
+        self.trailer = ''
+        self.final_newline = True
+        self._np = np
+        self._preamble = ''
+        self._pending = ''  # text after the last complete line
+        self._row_format = None
+
+    def _is_numeric(self, line):
+        """
+        Return True if a line holds exactly n_columns numbers (the test of parse_timeseries_text).
+        """
+        tokens = line.split()
+        if len(tokens) != self.n_columns:
+            return False
+        try:
+            [float(token) for token in tokens]
+        except ValueError:
+            return False
+        return True
+
+    def _row(self, body):
+        """
+        Return the numbers of a data row (without its line ending), or None if it is not formatted as the first row.
+        """
+        tokens = body.split(self.parsed['delimiter'])
+        if len(tokens) != self.n_columns:
+            return None
+        try:
+            values = [float(token) for token in tokens]
+            if self._row_format % tuple(values) != body:
+                return None
+        except (ValueError, TypeError, OverflowError):
+            return None  # e.g. a nan or inf in a '%d' column
+        return values
+
+    def _lines(self, lines):
+        """
+        Parse complete lines and return the rows found.
+        """
+        from LAPS_timeseries_format import parse_timeseries_text
+
+        rows = []
+        for line in lines:
+            if self.ended or self.failed:
+                self.trailer += line
+            elif self.parsed is None:
+                if not self._is_numeric(line):
+                    self._preamble += line
+                    continue
+                # The first data row gives the delimiter, line ending and column formats
+                parsed = parse_timeseries_text((self._preamble + line).encode('latin-1'), self.n_columns, self._np)
+                if parsed is None or parsed['trailer']:
+                    self.failed = True
+                    continue
+                self.parsed = {key: parsed[key] for key in ('preamble', 'delimiter', 'newline', 'formats')}
+                self._row_format = parsed['delimiter'].join(parsed['formats'])
+                rows.append(parsed['matrix'][0].tolist())
+            else:
+                newline = self.parsed['newline']
+                row = self._row(line[:-len(newline)]) if line.endswith(newline) else None
+                if row is None:
+                    self.ended = True
+                    self.trailer += line
+                else:
+                    rows.append(row)
+        return self._np.array(rows, dtype=self._np.float64).reshape(-1, self.n_columns)
+
+    def feed(self, data):
+        """
+        Parse the bytes appended to the file.
+
+        Parameters:
+        data (bytes): The new bytes.
+
+        Returns:
+        numpy.array: The new complete rows (n x n_columns, possibly empty).
+        """
+        text = self._pending + data.decode('latin-1')
+        complete = text.rfind('\n') + 1
+        self._pending = text[complete:]
+        return self._lines(text[:complete].splitlines(True))
+
+    def finish(self):
+        """
+        Parse the last bytes of the file, once it is no longer written.
+
+        Returns:
+        numpy.array: The last row if the file ends with a data row without line ending, otherwise no rows.
+        """
+        lines = self._pending.splitlines(True)
+        self._pending = ''
+        rows = self._lines(lines[:-1])
+        if lines:
+            last = lines[-1]
+            row = None
+            if self.parsed is not None and not (self.ended or self.failed) and not last.endswith(('\r', '\n')):
+                row = self._row(last)
+            if row is not None:
+                self.final_newline = False
+                rows = self._np.vstack([rows, self._np.array([row], dtype=self._np.float64)])
+            else:
+                rows = self._np.vstack([rows, self._lines([last])])
+        if self.parsed is None:
+            self.failed = True  # no data row at all
+        return rows
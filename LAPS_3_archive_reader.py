@@ -0,0 +1,197 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+import io
+
+
+class LAPSDatasetFile(io.RawIOBase):
+    """
+    Read-only, seekable binary file object over a dataset stored as a 1-D uint8 array.
+
+    Attributes:
+    dataset (h5py.Dataset): The dataset holding the file bytes.
+    size (int): The file size in bytes.
+
+    Reads go straight to the requested byte range of the dataset, so only the chunks covering it are read.
+    """
+
+    def __init__(self, dataset, np):
+        self.dataset = dataset
+        self.size = int(dataset.shape[0])
+        self._np = np
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence: " + str(whence))
+        if position < 0:
+            raise ValueError("Negative seek position: " + str(position))
+        self._position = position
+        return position
+
+    def readinto(self, buffer):
+        n = min(len(buffer), max(self.size - self._position, 0))
+        if n == 0:
+            return 0
+        target = self._np.frombuffer(buffer, dtype=self._np.uint8)
+        self.dataset.read_direct(target, self._np.s_[self._position:self._position + n], self._np.s_[0:n])
+        self._position += n
+        return n
+
+
+class LAPSArchiveReader:
+    """
+    Class to read files from a LAPS HDF5 file in-process, without extracting them to disk.
+
+    Attributes:
+    hdf5_file (str): The path to the HDF5 file created by LAPS_2_HDF5_from_directory.
+    file (h5py.File): The open HDF5 file.
+
+    Methods:
+    open(path): Return a seekable, read-only binary file object for a file of the archive.
+    listdir(path): List the entries of a directory of the archive.
+    stat(path): Return the size and type of an entry without reading its data.
+    exists(path), isdir(path), isfile(path): Test an entry.
+    close(): Close the HDF5 file.
+
+    Paths are relative to the directory root and use '/' (e.g. 'data/datasets/Imaging_1/Carr7.jpg').
+    Files streamed in blocks (LAPS_2_HDF5_from_directory with block_size) are read range by range.
+    Files stored as one binary scalar, and time series stored as numeric matrices, can only be read whole
+    by HDF5, so they are loaded (or formatted back to text) into memory when opened.
+    With swmr=True, the HDF5 file is opened for reading while LAPS_2_follow_timeseries writes to it.
+
+    Usage example:
+    with LAPSArchiveReader('data.h5', h5py, np) as archive:
+        image = PIL.Image.open(archive.open('data/datasets/Imaging_1/Carr7.jpg'))
+    """
+
+    def __init__(self, hdf5_file, h5py, np, swmr=False):
+        self.hdf5_file = hdf5_file
+        self._h5py = h5py
+        self._np = np
+        self.file = h5py.File(hdf5_file, "r", swmr=swmr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close the HDF5 file. File objects returned by open() can no longer be read afterwards.
+        """
+        self.file.close()
+
+    def _item(self, path):
+        """
+        Return the group or dataset at a relative path, or raise FileNotFoundError.
+        """
+        from LAPS_dedup import INTERNAL_GROUP
+
+        path = path.strip('/')
+        if path.split('/')[0] == INTERNAL_GROUP:
+            raise FileNotFoundError(path)
+        if not path:
+            return self.file
+        item = self.file.get(path)
+        if item is None:
+            raise FileNotFoundError(path)
+        return item
+
+    def open(self, path, buffering=io.DEFAULT_BUFFER_SIZE):
+        """
+        Open a file of the archive for reading.
+
+        Parameters:
+        path (str): The path of the file relative to the directory root.
+        buffering (int, optional): The read buffer size; 0 returns the unbuffered raw file object.
+
+        Returns:
+        file object: A seekable, read-only binary file object.
+        """
+        from LAPS_stream_copy import BYTES_LAYOUT
+        from LAPS_timeseries_format import TIMESERIES_LAYOUT, write_timeseries_file
+
+        item = self._item(path)
+        if not isinstance(item, self._h5py.Dataset):
+            raise IsADirectoryError(path)
+
+        layout = item.attrs.get("LAPS_layout")
+        if layout == BYTES_LAYOUT:
+            raw = LAPSDatasetFile(item, self._np)
+            return io.BufferedReader(raw, buffering) if buffering else raw
+        if layout == TIMESERIES_LAYOUT:
+            file = io.BytesIO()
+            write_timeseries_file(item, file)
+            file.seek(0)
+            return file
+        data = item[()]
+        return io.BytesIO(data.tobytes() if hasattr(data, 'tobytes') else bytes(data))
+
+    def listdir(self, path=''):
+        """
+        List the names of the files and directories in a directory of the archive.
+
+        Parameters:
+        path (str, optional): The directory path relative to the directory root. Defaults to the root.
+
+        Returns:
+        list: The entry names.
+        """
+        from LAPS_dedup import INTERNAL_GROUP
+
+        item = self._item(path)
+        if not isinstance(item, self._h5py.Group):
+            raise NotADirectoryError(path)
+        return [name for name in item if not (item.name == '/' and name == INTERNAL_GROUP)]
+
+    def stat(self, path):
+        """
+        Return information on a file or directory of the archive without reading its data.
+
+        Parameters:
+        path (str): The path relative to the directory root.
+
+        Returns:
+        dict: The keys 'size' (file size in bytes, 0 for directories), 'is_dir' and 'mtime_ns'
+              (modification time of the source file, if recorded by LAPS_2_HDF5_from_directory).
+        """
+        from LAPS_source_tracking import MTIME_ATTR
+        from LAPS_3_create_directory_from_HDF5 import dataset_file_size
+
+        item = self._item(path)
+        if isinstance(item, self._h5py.Group):
+            return {'size': 0, 'is_dir': True, 'mtime_ns': None}
+        mtime_ns = item.attrs.get(MTIME_ATTR)
+        return {'size': dataset_file_size(item), 'is_dir': False,
+                'mtime_ns': int(mtime_ns) if mtime_ns is not None else None}
+
+    def exists(self, path):
+        try:
+            self._item(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def isdir(self, path):
+        return self.exists(path) and isinstance(self._item(path), self._h5py.Group)
+
+    def isfile(self, path):
+        return self.exists(path) and isinstance(self._item(path), self._h5py.Dataset)
@@ -2,7 +2,8 @@
 # Ekaterina Bolotskaya
 # 07/17/2023
 
-def LAPS_3_create_directory_from_HDF5(hdf5_file, output_directory, schema_file_path, json, os, np, h5py):
+def LAPS_3_create_directory_from_HDF5(hdf5_file, output_directory, schema_file_path, json, os, np, h5py,
+                                      block_size=1048576, progress=None, trace_file=None):
     """
     Recreate the original directory structure from the HDF5 file.
     The function will recreate the directory structure and populate it with the data stored in the HDF5 file.
@@ -15,69 +16,173 @@ def LAPS_3_create_directory_from_HDF5(hdf5_file, output_directory, schema_file_p
     os (module): The operating system module for file and directory operations.
     np (module): The NumPy module for numerical operations.
     h5py (module): The h5py module for working with HDF5 files.
+    block_size (int, optional): The number of bytes copied at a time from datasets written in blocks
+                                (LAPS_2_HDF5_from_directory with block_size). Defaults to 1048576.
+    progress (callable, optional): Called with a dictionary for the start, every file written and the end
+                                   (see LAPS_instrumentation.LAPSTrace), e.g. LAPS_instrumentation.print_progress.
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
 
     Returns:
     None
 
     This function reads the HDF5 file, recreates the directory structure, and populates it with the data stored in the HDF5 file.
     It recursively processes groups and datasets in the HDF5 file and creates the corresponding directory structure and files on the disk.
-    The metadata JSON is retrieved from the attribute of the root group in the HDF5 file and saved to a separate JSON file.
+    The metadata JSON is retrieved from the HDF5 file (see LAPS_metadata.read_schema_json) and saved to a separate JSON file.
+    Time series stored as numeric matrices (LAPS_2_HDF5_from_directory with timeseries=True) are written back
+    to their original text. Deduplicated files are hard links to one stored copy, so every path is restored.
     """
+    from LAPS_dedup import INTERNAL_GROUP
+    from LAPS_metadata import read_schema_json
+    from LAPS_instrumentation import LAPSTrace, FS_METADATA, HDF5_METADATA, FS_WRITE
 
-    # Function to create nested directories based on group structure
-    def create_nested_directories(path):
-        """
-        Recursively create nested directories based on the group structure.
-        """
-        if not os.path.exists(path):
-            os.makedirs(path)
-
-    # Recursive function to handle groups and datasets
-    def process_group(group, group_path):
-        """
-        Recursively process groups and datasets.
-        """
-        create_nested_directories(group_path)
-
-        for name, item in group.items():
-            if isinstance(item, h5py.Dataset):
-                dataset_name = name
-                _, extension = os.path.splitext(dataset_name)
-                file_path = os.path.join(group_path, dataset_name)
-
-                if extension in [".csv", ".txt", ".xls", ".xlsx"]:
-                    data = item[()]
-                    with open(file_path, "wb") as file:
-                        file.write(data)  # write the dataset data to a file
-
-                elif extension in [".jpg", ".jpeg", ".png"]:
-                    data = item[()]
-                    with open(file_path, "wb") as file:
-                        file.write(data.tobytes())  # write the image data to a file
-
-                else:
-                    data = item[()]
-                    with open(file_path, "wb") as file:
-                        file.write(data)  # write the data to a file
-
-            elif isinstance(item, h5py.Group):
-                sub_group_path = os.path.join(group_path, name)
-                process_group(item, sub_group_path)  # recursively process the sub-group
-
-    # Open HDF5 file in read mode
-    with h5py.File(hdf5_file, "r") as f:
-        # Retrieve the metadata JSON from the attribute
-        metadata_str = f.attrs.get("Schema_json", "")  # get the metadata JSON as a string from the attribute
-        metadata = json.loads(metadata_str)  # convert the metadata JSON string to a dictionary
-
-        # Recreate the directory structure
-        for group_name, group in f.items():
-            group_path = os.path.join(output_directory, group_name)
-            process_group(group, group_path)  # process each group in the HDF5 file
-
-    # Write the metadata JSON to a file next to the Recreated_Directory
-    with open(schema_file_path, "w") as schema_file:
-        json.dump(metadata, schema_file, indent=4)  # write the metadata dictionary to a JSON file
-
-    print("Directory recreated successfully.")
-    print(output_directory)
\ No newline at end of file
+    # Timing and counters of the run, reported to progress and trace_file
+    with LAPSTrace('LAPS_3_create_directory_from_HDF5', progress, trace_file, hdf5_file=hdf5_file,
+                   output_directory=output_directory) as trace:
+
+        # Function to create nested directories based on group structure
+        def create_nested_directories(path):
+            """
+            Recursively create nested directories based on the group structure.
+            """
+            with trace.timer(FS_METADATA):
+                if not os.path.exists(path):
+                    os.makedirs(path)
+
+        # Recursive function to handle groups and datasets
+        def process_group(group, group_path):
+            """
+            Recursively process groups and datasets.
+            """
+            create_nested_directories(group_path)
+
+            with trace.timer(HDF5_METADATA):
+                items = list(group.items())
+            for name, item in items:
+                if isinstance(item, h5py.Dataset):
+                    dataset_name = name
+                    file_path = os.path.join(group_path, dataset_name)
+
+                    write_dataset_file(item, file_path, os, np, block_size, trace)
+
+                elif isinstance(item, h5py.Group):
+                    sub_group_path = os.path.join(group_path, name)
+                    process_group(item, sub_group_path)  # recursively process the sub-group
+
+        # Open HDF5 file in read mode
+        with h5py.File(hdf5_file, "r") as f:
+            # Retrieve the metadata JSON
+            with trace.timer(HDF5_METADATA):
+                metadata_str = read_schema_json(f)  # get the metadata JSON as a string
+            metadata = json.loads(metadata_str)  # convert the metadata JSON string to a dictionary
+
+            # Recreate the directory structure
+            for group_name, group in f.items():
+                if group_name == INTERNAL_GROUP:
+                    continue  # LAPS bookkeeping (e.g. deduplicated blobs), not part of the directory
+                group_path = os.path.join(output_directory, group_name)
+                process_group(group, group_path)  # process each group in the HDF5 file
+
+        # Write the metadata JSON to a file next to the Recreated_Directory
+        with trace.timer(FS_WRITE):
+            with open(schema_file_path, "w") as schema_file:
+                json.dump(metadata, schema_file, indent=4)  # write the metadata dictionary to a JSON file
+
+        trace.finish()
+        print("Directory recreated successfully.")
+        print(output_directory)
+
+
+def write_dataset_file(item, file_path, os, np, block_size=1048576, trace=None):
+    """
+    Write one dataset of a LAPS HDF5 file back to the file it was created from.
+
+    Parameters:
+    item (h5py.Dataset): The dataset to extract.
+    file_path (str): The path of the file to write.
+    os (module): The operating system module for file operations.
+    np (module): The NumPy module for numerical operations.
+    block_size (int, optional): The number of bytes copied at a time from datasets written in blocks.
+                                Defaults to 1048576.
+    trace (LAPSTrace, optional): If given, the file and its timing are counted in it.
+
+    Returns:
+    None
+
+    Files stored uncompressed in one contiguous block (and the binary scalars of older LAPS versions) are copied
+    from their byte offset in the HDF5 file with copy_file_range, sendfile or mmap (LAPS_stream_copy.copy_raw_bytes),
+    without going through NumPy or Python bytes.
+    """
+    import time
+    from contextlib import nullcontext
+    from LAPS_timeseries_format import TIMESERIES_LAYOUT, write_timeseries_file
+    from LAPS_stream_copy import BYTES_LAYOUT, write_dataset_to_file, raw_byte_range, copy_raw_bytes
+    from LAPS_instrumentation import HDF5_READ, HDF5_METADATA, FS_WRITE, CPU
+
+    timer = trace.timer if trace is not None else lambda category: nullcontext()
+    start = time.perf_counter()
+    _, extension = os.path.splitext(file_path)
+    with timer(HDF5_METADATA):
+        layout = item.attrs.get("LAPS_layout")
+        byte_range = raw_byte_range(item)
+
+    if byte_range is not None:
+        with timer(FS_WRITE):
+            with open(file_path, "wb") as file:
+                copy_raw_bytes(item.file.filename, byte_range[0], byte_range[1], file, os,
+                               block_size)  # copy the stored bytes file to file, outside Python
+
+    elif layout == TIMESERIES_LAYOUT:
+        with timer(CPU):
+            with open(file_path, "wb") as file:
+                write_timeseries_file(item, file)  # format the matrix back to the original text
+
+    elif layout == BYTES_LAYOUT:
+        with open(file_path, "wb") as file:
+            write_dataset_to_file(item, file, block_size, np, trace)  # copy the bytes block by block
+
+    elif extension in [".csv", ".txt", ".xls", ".xlsx"]:
+        with timer(HDF5_READ):
+            data = item[()]
+        with timer(FS_WRITE):
+            with open(file_path, "wb") as file:
+                file.write(data)  # write the dataset data to a file
+
+    elif extension in [".jpg", ".jpeg", ".png"]:
+        with timer(HDF5_READ):
+            data = item[()]
+        with timer(FS_WRITE):
+            with open(file_path, "wb") as file:
+                file.write(data.tobytes())  # write the image data to a file
+
+    else:
+        with timer(HDF5_READ):
+            data = item[()]
+        with timer(FS_WRITE):
+            with open(file_path, "wb") as file:
+                file.write(data)  # write the data to a file
+
+    if trace is not None:
+        trace.file_done(item.name.lstrip('/'), time.perf_counter() - start, item.id.get_storage_size(),
+                        os.path.getsize(file_path))
+
+
+def dataset_file_size(item):
+    """
+    Return the size in bytes of the file a dataset of a LAPS HDF5 file extracts to, without reading its data.
+
+    Parameters:
+    item (h5py.Dataset): The dataset.
+
+    Returns:
+    int: The file size in bytes.
+    """
+    from LAPS_source_tracking import SIZE_ATTR
+    from LAPS_stream_copy import BYTES_LAYOUT
+
+    if SIZE_ATTR in item.attrs:
+        return int(item.attrs[SIZE_ATTR])  # recorded by LAPS_2 from the source file
+    if item.attrs.get("LAPS_layout") == BYTES_LAYOUT:
+        return int(item.shape[0])
+    if item.shape == ():
+        return int(item.dtype.itemsize)  # a file stored as one binary scalar
+    return int(item.size * item.dtype.itemsize)
@@ -0,0 +1,108 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+def LAPS_3_extract_selected_from_HDF5(hdf5_file, output_directory, json, os, np, h5py,
+                                      patterns=None, data_type=None, index=None, device=None,
+                                      list_only=False, block_size=1048576, progress=None, trace_file=None):
+    """
+    Extract selected files from the HDF5 file instead of recreating the whole directory structure.
+
+    Parameters:
+    hdf5_file (str): The path to the HDF5 file created by LAPS_2_HDF5_from_directory.
+    output_directory (str): The path to the output directory; selected files keep their relative paths.
+    json (module): The JSON module to parse the metadata JSON from the HDF5 attribute.
+    os (module): The operating system module for file and directory operations.
+    np (module): The NumPy module for numerical operations.
+    h5py (module): The h5py module for working with HDF5 files.
+    patterns (list, optional): Glob patterns on paths relative to the directory root
+                               (e.g. 'data/datasets/Imaging_1/*', '*.xlsx'); '*' also matches '/'.
+    data_type (str, optional): Select the dataset folders whose schema entry has this 'data' value (e.g. 'Imaging').
+    index (str or int, optional): Select the dataset folders whose schema entry has this 'index' (combined with
+                                  data_type); the schema stores it as a string, so 1 and '1' are the same.
+    device (str, optional): Select the folder of the DAQ device with this name (daq.devices[].name).
+    list_only (bool, optional): If True, nothing is written; the selected files and their sizes are only listed.
+                                Defaults to False.
+    block_size (int, optional): The number of bytes copied at a time from datasets written in blocks.
+                                Defaults to 1048576.
+    progress (callable, optional): Called with a dictionary for the start, every file extracted and the end
+                                   (see LAPS_instrumentation.LAPSTrace), e.g. LAPS_instrumentation.print_progress.
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
+
+    Returns:
+    list: One dictionary per selected file with the keys 'path' (relative path) and 'size' (bytes).
+
+    A file is selected if it matches any of the given filters; without filters every file is selected.
+    Only the groups that can contain a selected file are visited, and no dataset data is read in list_only mode.
+    """
+    from fnmatch import fnmatchcase
+    from LAPS_dedup import INTERNAL_GROUP
+    from LAPS_0_compile_schema import compile_schema_text
+    from LAPS_metadata import read_schema_json
+    from LAPS_3_create_directory_from_HDF5 import dataset_file_size, write_dataset_file
+    from LAPS_instrumentation import LAPSTrace, HDF5_METADATA
+
+    patterns = list(patterns or [])
+    selected = []
+    with LAPSTrace('LAPS_3_extract_selected_from_HDF5', progress, trace_file, hdf5_file=hdf5_file,
+                   output_directory=output_directory, list_only=list_only) as trace:
+
+        with h5py.File(hdf5_file, "r") as f:
+            # Translate the schema-level filters into folder patterns
+            if data_type is not None or index is not None or device is not None:
+                schema = compile_schema_text(read_schema_json(f), json)
+                if data_type is not None or index is not None:
+                    for directory, entry in schema.dataset_directories.items():
+                        if (data_type is None or entry.get('data') == data_type) and \
+                                (index is None or str(entry.get('index')) == str(index)):
+                            patterns.append('data/datasets/' + directory + '/*')
+                if device is not None and device in schema.devices:
+                    patterns.append('daq/devices/' + device + '/*')
+                if not patterns:
+                    trace.finish()
+                    return selected  # the filters match nothing in this schema
+
+            # The literal part of each pattern decides which groups can hold a match
+            prefixes = []
+            for pattern in patterns:
+                literal = pattern
+                for wildcard in '*?[':
+                    literal = literal.split(wildcard)[0]
+                prefixes.append(literal)
+
+            def may_contain_match(group_path):
+                if not patterns:
+                    return True
+                return any(prefix.startswith(group_path + '/') or group_path.startswith(prefix) for prefix in prefixes)
+
+            def is_selected(path):
+                return not patterns or any(fnmatchcase(path, pattern) for pattern in patterns)
+
+            # Recursive function to visit the groups that may hold selected files
+            def visit_group(group, group_path):
+                with trace.timer(HDF5_METADATA):
+                    items = list(group.items())
+                for name, item in items:
+                    item_path = group_path + '/' + name if group_path else name
+                    if isinstance(item, h5py.Group):
+                        if item_path != INTERNAL_GROUP and may_contain_match(item_path):
+                            visit_group(item, item_path)
+                    elif isinstance(item, h5py.Dataset) and is_selected(item_path):
+                        with trace.timer(HDF5_METADATA):
+                            selected.append({'path': item_path, 'size': dataset_file_size(item)})
+                        if not list_only:
+                            file_path = os.path.join(output_directory, *item_path.split('/'))
+                            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                            write_dataset_file(item, file_path, os, np, block_size, trace)
+
+            visit_group(f, '')
+
+        trace.finish(selected=len(selected))
+        if list_only:
+            for entry in selected:
+                print(entry['size'], entry['path'])
+            print(len(selected), "files,", sum(entry['size'] for entry in selected), "bytes.")
+        else:
+            print("Selected files extracted successfully.")
+            print(output_directory)
+        return selected
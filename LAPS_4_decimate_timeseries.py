@@ -0,0 +1,104 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+class TimeseriesPyramid:
+    """
+    Class holding a multi-resolution min/max pyramid of the columns of a time series matrix.
+
+    Attributes:
+    data_matrix (numpy.array): The matrix containing time series data (rows are time steps).
+    factor (int): The number of buckets of one level merged into a bucket of the next level.
+
+    Methods:
+    select(columns, start, stop, max_points): Return the row indices to plot for a row window.
+
+    Level L of a column keeps, for every bucket of factor**L consecutive rows, the rows holding the minimum
+    and the maximum of that column. Drawing these rows in order keeps the envelope of the signal
+    (spikes are never dropped), while the number of points only depends on the window and not on the record length.
+    Levels are built from the level below, so building a column pyramid costs one pass over the column.
+    """
+
+    def __init__(self, data_matrix, np, factor=8):
+        self.data_matrix = data_matrix
+        self.factor = factor
+        self._np = np
+        self._levels = {}  # column -> list of (min_rows, max_rows) per level, level 1 first
+
+    def _build(self, column):
+        """
+        Build (once) and return the levels of one column.
+        """
+        if column in self._levels:
+            return self._levels[column]
+        np = self._np
+        values = np.asarray(self.data_matrix[:, column])
+        n_rows = len(values)
+        levels = []
+
+        # Each level is built from the one below, starting from the raw rows; a last, partial bucket is merged on its own
+        rows = np.arange(n_rows)
+        min_rows, max_rows = rows, rows
+        while len(min_rows) > self.factor:
+            n_full = len(min_rows) // self.factor * self.factor
+            min_groups = min_rows[:n_full].reshape(-1, self.factor)
+            max_groups = max_rows[:n_full].reshape(-1, self.factor)
+            pick = np.arange(len(min_groups))
+            new_min = min_groups[pick, np.argmin(values[min_groups], axis=1)]
+            new_max = max_groups[pick, np.argmax(values[max_groups], axis=1)]
+            if n_full < len(min_rows):
+                tail_min, tail_max = min_rows[n_full:], max_rows[n_full:]
+                new_min = np.append(new_min, tail_min[np.argmin(values[tail_min])])
+                new_max = np.append(new_max, tail_max[np.argmax(values[tail_max])])
+            min_rows, max_rows = new_min, new_max
+            levels.append((min_rows, max_rows))
+
+        self._levels[column] = levels
+        return levels
+
+    def select(self, columns, start=0, stop=None, max_points=2000):
+        """
+        Return the sorted row indices to plot for a window of rows.
+
+        Parameters:
+        columns (list): The column indices whose envelope must be kept (e.g. the x and y columns).
+        start (int, optional): The first row of the window. Defaults to 0.
+        stop (int, optional): The row after the last row of the window. Defaults to the number of rows.
+        max_points (int, optional): The maximum number of rows returned per column. Defaults to 2000.
+
+        Returns:
+        numpy.array: The row indices, using the finest level whose points in the window fit in max_points.
+                     They are all within [start, stop) and include start and stop - 1.
+
+        Only the buckets lying entirely inside the window are taken from the level; the rows of the window in
+        the partly covered buckets at either end (fewer than one bucket each) get their minimum and maximum
+        computed exactly, so the envelope matches the window rather than the bucket boundaries.
+        """
+        np = self._np
+        n_rows = len(self.data_matrix)
+        stop = n_rows if stop is None else min(stop, n_rows)
+        start = max(0, min(start, stop))
+        if stop - start <= max_points:
+            return np.arange(start, stop)
+
+        selected = [np.array([start, stop - 1])]
+        for column in columns:
+            levels = self._build(column)
+            if not levels:
+                return np.arange(start, stop)
+            for level, (min_rows, max_rows) in enumerate(levels):
+                bucket = self.factor ** (level + 1)
+                if 2 * ((stop - start) // bucket + 2) <= max_points:
+                    break  # the finest level that fits (otherwise the coarsest one)
+            first, last = -(-start // bucket), stop // bucket  # the buckets inside the window
+            if first < last:
+                selected.append(min_rows[first:last])
+                selected.append(max_rows[first:last])
+                edges = [(start, first * bucket), (last * bucket, stop)]
+            else:
+                edges = [(start, stop)]
+            for edge_start, edge_stop in edges:
+                if edge_start < edge_stop:
+                    values = np.asarray(self.data_matrix[edge_start:edge_stop, column])
+                    selected.append(edge_start + np.array([np.argmin(values), np.argmax(values)]))
+        return np.unique(np.concatenate(selected))
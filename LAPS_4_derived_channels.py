@@ -0,0 +1,653 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+import ast
+import re
+
+from LAPS_dedup import INTERNAL_GROUP
+
+# Group holding the derived channels written by LAPS_4_derive_channels, one group per time series path
+# (e.g. '.LAPS/derived/data/datasets/Time_Series_1/Paterson#5_ExampleData.txt/<channel>')
+DERIVED_GROUP = INTERNAL_GROUP + '/derived'
+
+# Layout of a derived channel dataset (1-D float column, one value per row of its time series)
+DERIVED_LAYOUT = 'derived'
+
+# NumPy functions allowed in channel expressions, besides rate(y, x) and first(x)
+FUNCTION_NAMES = ('abs', 'sqrt', 'exp', 'log', 'log10', 'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan',
+                  'arctan2', 'minimum', 'maximum', 'where', 'radians', 'degrees')
+
+# Expression syntax allowed in channel expressions: arithmetic, comparisons (for where) and function calls
+ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Load, ast.Constant,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.FloorDiv, ast.USub, ast.UAdd,
+                 ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+
+def preamble_constants(preamble):
+    """
+    Return the numeric 'name: value' lines of a time series preamble.
+
+    Parameters:
+    preamble (str): The text before the first data row (e.g. 'Length mm: 20.00000000' lines).
+
+    Returns:
+    dict: Name -> float (e.g. {'Length mm': 20.0, 'Diameter mm': 10.0}). Lines whose value is not a number
+          (e.g. 'Date: 5/26/2021 11:09:51 AM') are skipped.
+    """
+    constants = {}
+    for line in preamble.splitlines():
+        name, separator, value = line.partition(':')
+        if not separator or not name.strip():
+            continue
+        try:
+            constants[' '.join(name.split())] = float(value)
+        except ValueError:
+            pass
+    return constants
+
+
+def read_preamble(file, n_columns):
+    """
+    Read the preamble of a time series file: the lines before the first row of n_columns numbers.
+
+    Parameters:
+    file (file object): A seekable binary file object positioned at the start of the time series.
+    n_columns (int): The number of columns (the number of headers in the JSON schema).
+
+    Returns:
+    str: The preamble text. The file is put back at its start position.
+    """
+    start = file.tell()
+    lines = []
+    for line in iter(file.readline, b''):
+        values = line.split()
+        if len(values) == n_columns:
+            try:
+                [float(value) for value in values]
+                break
+            except ValueError:
+                pass
+        lines.append(line)
+    file.seek(start)
+    return b''.join(lines).decode('latin-1')
+
+
+def _normalize(label):
+    """
+    Return a label with its whitespace collapsed, to compare header labels written with or without spaces.
+    """
+    return ' '.join(label.replace(',', ' , ').split())
+
+
+def compile_channels(channels, header_array, constants):
+    """
+    Compile channel expressions, resolving the names they refer to.
+
+    Parameters:
+    channels (dict or list): Channel name -> expression, or a list of (name, expression) pairs, in the order
+                             they are computed (a channel can use the channels before it).
+    header_array (list): The header labels of the time series columns.
+    constants (dict): Constant name -> value (e.g. from preamble_constants).
+
+    Returns:
+    list: One dictionary per channel with the keys 'name', 'expression', 'code', 'references'
+          (placeholder -> ('column', index), ('channel', index) or ('constant', value)), 'inputs' (the names
+          referred to), 'constants' (the constants used, name -> value), 'halo' (the rows needed on each side
+          of a block) and 'firsts' (the compiled arguments of first()).
+
+    Raises:
+    ValueError: If an expression is not valid or refers to an unknown or ambiguous name.
+
+    In an expression, '{name}' refers to an earlier channel, a header label (e.g. '{Load Axial Internal , KN}',
+    or without its unit if that is unambiguous, '{Load Axial Internal}') or a constant ('{Length mm}');
+    spaces around the comma before the unit do not matter.
+    rate(y, x) is the derivative dy/dx (numpy.gradient) and first(x) the value of x in the first row.
+    """
+    items = list(channels.items()) if isinstance(channels, dict) else [tuple(item) for item in channels]
+    labels = {_normalize(label): j for j, label in enumerate(header_array)}
+    short_labels = {}
+    for label, j in labels.items():
+        short_labels.setdefault(label.rsplit(' , ', 1)[0], []).append(j)
+    constants = {' '.join(str(name).split()): float(value) for name, value in constants.items()}
+
+    compiled = []
+    for name, expression in items:
+        # Function to resolve one '{name}' reference
+        def resolve(reference):
+            key = _normalize(reference)
+            for k, channel in enumerate(compiled):
+                if key in (_normalize(channel['name']), _normalize(channel['name']).rsplit(' , ', 1)[0]):
+                    return 'channel', k
+            if key in labels:
+                return 'column', labels[key]
+            if len(short_labels.get(key, ())) == 1:
+                return 'column', short_labels[key][0]
+            if len(short_labels.get(key, ())) > 1:
+                raise ValueError("Channel '{}': '{{{}}}' matches several headers: {}".format(
+                    name, reference, ', '.join(header_array[j] for j in short_labels[key])))
+            if ' '.join(reference.split()) in constants:
+                return 'constant', constants[' '.join(reference.split())]
+            raise ValueError("Channel '{}': unknown name '{{{}}}' (not an earlier channel, a header or a constant)"
+                             .format(name, reference))
+
+        compiled.append(compile_expression(str(name), str(expression), resolve))
+    return compiled
+
+
+def compile_expression(name, expression, resolve):
+    """
+    Compile one channel expression (see compile_channels).
+
+    Parameters:
+    name (str): The channel name, for the error messages.
+    expression (str): The expression.
+    resolve (callable): Returns the reference of a '{name}' placeholder.
+
+    Returns:
+    dict: The compiled channel (see compile_channels).
+    """
+    references = {}
+    inputs = []
+    constants = {}
+
+    # Function to replace a '{name}' placeholder with a variable
+    def placeholder(match):
+        reference = resolve(match.group(1))
+        for variable, known in references.items():
+            if known == reference:
+                return variable
+        variable = '_v' + str(len(references))
+        references[variable] = reference
+        inputs.append(' '.join(match.group(1).split()))
+        if reference[0] == 'constant':
+            constants[inputs[-1]] = reference[1]
+        return variable
+
+    text = re.sub(r'\{([^{}]+)\}', placeholder, expression)
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError as error:
+        raise ValueError("Channel '{}': invalid expression {!r} ({})".format(name, expression, error.msg))
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError("Channel '{}': {} is not allowed in an expression".format(name, type(node).__name__))
+        if isinstance(node, ast.Constant) and (isinstance(node.value, bool) or
+                                               not isinstance(node.value, (int, float))):
+            raise ValueError("Channel '{}': only numbers are allowed as constants".format(name))
+        if isinstance(node, ast.Call):
+            function = node.func.id if isinstance(node.func, ast.Name) else None
+            if function not in FUNCTION_NAMES + ('rate', 'first') or node.keywords:
+                raise ValueError("Channel '{}': unknown function in {!r}".format(name, expression))
+        if isinstance(node, ast.Name) and node.id not in references and \
+                node.id not in FUNCTION_NAMES + ('rate', 'first', 'pi'):
+            raise ValueError("Channel '{}': unknown name '{}' (write columns and constants as '{{name}}')"
+                             .format(name, node.id))
+
+    # Function to compile a (sub)expression, evaluating its first() calls separately
+    def compile_node(node):
+        firsts = {}
+
+        class ReplaceFirst(ast.NodeTransformer):
+            def visit_Call(self, call):
+                if isinstance(call.func, ast.Name) and call.func.id == 'first':
+                    if len(call.args) != 1:
+                        raise ValueError("Channel '{}': first() takes one argument".format(name))
+                    variable = '_f' + str(len(firsts))
+                    firsts[variable] = compile_node(call.args[0])
+                    return ast.copy_location(ast.Name(id=variable, ctx=ast.Load()), call)
+                return self.generic_visit(call)
+
+        body = ReplaceFirst().visit(ast.Expression(body=node))
+        ast.fix_missing_locations(body)
+        used = {item.id for item in ast.walk(body) if isinstance(item, ast.Name)}
+        return {'code': compile(body, '<' + name + '>', 'eval'), 'halo': rate_depth(body.body),
+                'references': {variable: reference for variable, reference in references.items()
+                               if variable in used},
+                'firsts': firsts}
+
+    channel = compile_node(tree.body)
+    channel.update(name=name, expression=expression, inputs=inputs, constants=constants)
+    return channel
+
+
+def rate_depth(node):
+    """
+    Return how deeply rate() calls are nested in an expression: the rows needed on each side of a block.
+    """
+    depth = max([rate_depth(child) for child in ast.iter_child_nodes(node)] or [0])
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'rate':
+        depth += 1
+    return depth
+
+
+class DerivedMatrix:
+    """
+    Class adding derived channels to a time series matrix, as extra columns computed block by block.
+
+    Attributes:
+    matrix (numpy.array or HDF5ColumnMatrix): The time series matrix.
+    header_array (list): The header labels followed by the derived channel names.
+    channels (list): The compiled channels (see compile_channels).
+    shape (tuple): The shape of the matrix with the derived columns.
+    stored (set): The derived channels whose values were given by set_column rather than computed.
+
+    Methods:
+    blocks(k, block_rows): Yield (start, values) blocks of the derived channel k.
+    set_column(k, values): Use stored values (e.g. an HDF5 dataset) for the derived channel k.
+    refresh(): Reload a matrix that is still growing; the derived columns are computed again.
+
+    Supports m[rows, j] like the matrix: derived columns are computed (once) when first indexed,
+    in blocks of block_rows rows with NumPy, so expressions never loop over rows in Python.
+    Blocks are extended by the rows rate() needs on each side, so the result does not depend on the block size.
+    """
+
+    def __init__(self, matrix, header_array, channels, np, block_rows=1048576):
+        self.matrix = matrix
+        self.channels = channels
+        self.header_array = list(header_array) + [channel['name'] for channel in channels]
+        self._n_raw = len(header_array)
+        self._np = np
+        self._block_rows = block_rows
+        self._columns = {}
+        self._firsts = {}
+        self.stored = set()
+        self._functions = {name: getattr(np, 'absolute' if name == 'abs' else name) for name in FUNCTION_NAMES}
+        self._functions.update(rate=self._rate, pi=np.pi, __builtins__={})
+
+    @property
+    def shape(self):
+        return (len(self.matrix), len(self.header_array))
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def refresh(self):
+        """
+        Reload the shape of a matrix that is still being appended to, and drop the derived columns if it grew.
+
+        Returns:
+        int: The number of rows.
+        """
+        old_rows = len(self.matrix)
+        n_rows = self.matrix.refresh()
+        if n_rows != old_rows:
+            self._columns = {}
+            self._firsts = {}
+            self.stored = set()
+        return n_rows
+
+    def set_column(self, k, values):
+        """
+        Use stored values for the derived channel k instead of computing them.
+        """
+        self._columns[k] = values
+        self.stored.add(k)
+
+    def _rate(self, y, x):
+        """
+        Return the derivative dy/dx over a block (central differences, one-sided at the ends).
+        """
+        np = self._np
+        y = np.asarray(y, dtype=np.float64)
+        if y.ndim == 0 or y.size < 2:
+            return np.full(y.shape, np.nan)
+        return np.gradient(y, x) if np.ndim(x) == 0 else np.gradient(y, np.asarray(x, dtype=np.float64))
+
+    def _evaluate(self, compiled, start, stop, key):
+        """
+        Evaluate a compiled (sub)expression over the rows start to stop.
+        """
+        np = self._np
+        n_rows = len(self.matrix)
+        low, high = max(start - compiled['halo'], 0), min(stop + compiled['halo'], n_rows)
+        namespace = dict(self._functions)
+        for variable, (kind, value) in compiled['references'].items():
+            if kind == 'column':
+                namespace[variable] = np.asarray(self.matrix[low:high, value], dtype=np.float64)
+            elif kind == 'channel':
+                namespace[variable] = np.asarray(self._column(value)[low:high], dtype=np.float64)
+            else:
+                namespace[variable] = value
+        for variable, first in compiled['firsts'].items():
+            if (key, variable) not in self._firsts:
+                values = self._evaluate(first, 0, min(n_rows, 1), key + (variable,))
+                self._firsts[(key, variable)] = float(values[0]) if len(values) else np.nan
+            namespace[variable] = self._firsts[(key, variable)]
+        with np.errstate(all='ignore'):
+            values = eval(compiled['code'], namespace)
+        values = np.broadcast_to(np.asarray(values, dtype=np.float64), (high - low,))
+        return values[start - low:stop - low]
+
+    def blocks(self, k, block_rows=None):
+        """
+        Yield (start, values) for consecutive blocks of rows of the derived channel k (0 for the first channel).
+        """
+        block_rows = block_rows or self._block_rows
+        n_rows = len(self.matrix)
+        for start in range(0, n_rows, block_rows):
+            yield start, self._evaluate(self.channels[k], start, min(start + block_rows, n_rows), (k,))
+
+    def _column(self, k):
+        """
+        Compute (once) and return the full derived channel k.
+        """
+        if k not in self._columns:
+            column = self._np.empty(len(self.matrix), dtype=self._np.float64)
+            for start, values in self.blocks(k):
+                column[start:start + len(values)] = values
+            self._columns[k] = column
+        elif not isinstance(self._columns[k], self._np.ndarray):
+            self._columns[k] = self._np.asarray(self._columns[k][()], dtype=self._np.float64)
+        return self._columns[k]
+
+    def __getitem__(self, key):
+        rows, column = key
+        if column < self._n_raw:
+            return self.matrix[rows, column]
+        return self._column(column - self._n_raw)[rows]
+
+
+def _channel_dataset_name(name):
+    """
+    Return the dataset name of a channel (HDF5 names cannot hold '/').
+    """
+    return name.replace('%', '%25').replace('/', '%2F')
+
+
+def LAPS_4_derive_channels(hdf5_file, dataset_path, channels, json, os, np, h5py, constants=None,
+                           block_rows=1048576, progress=None, trace_file=None):
+    """
+    Compute derived channels of a time series stored in an HDF5 file and save them in the file next to the raw data.
+
+    Parameters:
+    hdf5_file (str): The path to the HDF5 file created by LAPS_2_HDF5_from_directory.
+    dataset_path (str): The path of the time series file inside the archive
+                        (e.g. 'data/datasets/Time_Series_1/Paterson#5_ExampleData.txt').
+    channels (dict or list): Channel name -> expression, or a list of (name, expression) pairs, computed in order
+                             (see compile_channels), e.g.
+                             {'Stress Axial, MPa': '{Load Axial Internal} * 1000 / (pi * ({Diameter mm} / 2) ** 2)',
+                              'Strain Axial, %': '100 * ({Displacement Axial External Low Gain (Coarse)} - first('
+                                                 '{Displacement Axial External Low Gain (Coarse)})) / {Length mm}',
+                              'Strain Rate Axial, 1/s': 'rate({Strain Axial}, {Time Relative Differential, sec}) / 100'}
+    json (module): The JSON module to parse the schema and the stored constants.
+    os (module): The operating system module for path operations.
+    np (module): The NumPy module for numerical operations.
+    h5py (module): The h5py module for working with HDF5 files.
+    constants (dict, optional): Constants added to (or replacing) the 'name: value' lines of the preamble of the
+                                time series (e.g. {'Length mm': 19.95}). Defaults to None.
+    block_rows (int, optional): The number of rows computed at a time. Defaults to 1048576.
+    progress (callable, optional): Called with a dictionary at the start, for every channel and at the end
+                                   (see LAPS_instrumentation.LAPSTrace), e.g. LAPS_instrumentation.print_progress.
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
+
+    Returns:
+    dict: Channel name -> 'computed' or 'unchanged' (stored already, with the same expression, constants and source).
+
+    Each channel is a compressed 1-D float dataset in '.LAPS/derived/<dataset_path>/', with the provenance
+    attributes 'name', 'expression', 'inputs' (the names it refers to), 'constants' (JSON of the constants used),
+    'source' (dataset_path), 'source_rows', 'source_sha256' (the hash of the source file, if recorded) and 'created'.
+    The channels are computed block by block, channels using earlier ones read them back from the file,
+    so the memory used does not grow with the record length. Stored channels are offered in the dropdowns of
+    LAPS_4_plot_timeseries_from_HDF5 next to the headers; they are not extracted by LAPS_3, and LAPS_2 update
+    removes those of deleted time series.
+
+    Usage example:
+    LAPS_4_derive_channels('data.h5', 'data/datasets/Time_Series_1/Paterson#5_ExampleData.txt',
+                           {'Stress Axial, MPa': '{Load Axial Internal} * 1000 / (pi * ({Diameter mm} / 2) ** 2)'},
+                           json, os, np, h5py)
+    """
+    import time
+    from LAPS_source_tracking import HASH_ATTR
+    from LAPS_instrumentation import LAPSTrace, HDF5_READ, HDF5_WRITE, HDF5_METADATA, CPU
+
+    dataset_path = dataset_path.replace(os.sep, '/').strip('/')
+    with LAPSTrace('LAPS_4_derive_channels', progress, trace_file, hdf5_file=hdf5_file,
+                   dataset_path=dataset_path) as trace:
+        string_dtype = h5py.string_dtype()
+        status = {}
+        with h5py.File(hdf5_file, 'a') as f:
+            with trace.timer(HDF5_READ):
+                header_array = time_series_headers(f, dataset_path, json, os)
+                matrix, preamble = load_time_series(f, dataset_path, len(header_array), np)
+            with trace.timer(CPU):
+                result = derived_matrix(matrix, header_array, channels, preamble, constants, np, json, f, dataset_path)
+            names = [channel['name'] for channel in result.channels]
+            declared = set(name for name, expression in (channels.items() if isinstance(channels, dict) else channels))
+            trace.files_total = len(declared)
+            digest = f[dataset_path].attrs.get(HASH_ATTR, '')
+            digest = digest.decode('utf-8') if isinstance(digest, bytes) else str(digest)
+
+            with trace.timer(HDF5_METADATA):
+                group = f.require_group(DERIVED_GROUP + '/' + dataset_path)
+            n_rows = len(result)
+            for k, channel in enumerate(result.channels):
+                if channel['name'] not in declared:
+                    continue  # stored earlier and not declared again: left as it is
+                start = time.perf_counter()
+                if k in result.stored:
+                    status[channel['name']] = 'unchanged'
+                    trace.file_done(channel['name'], time.perf_counter() - start)
+                    continue
+
+                # Write the channel block by block, then let the channels using it read it from the file
+                name = _channel_dataset_name(channel['name'])
+                with trace.timer(HDF5_METADATA):
+                    if name in group:
+                        del group[name]
+                    dataset = group.create_dataset(name, shape=(n_rows,), dtype=np.float64,
+                                                   chunks=(max(min(n_rows, 16384), 1),), shuffle=True,
+                                                   compression='gzip', compression_opts=4)
+                blocks = result.blocks(k, block_rows)
+                while True:
+                    with trace.timer(CPU):
+                        block = next(blocks, None)
+                    if block is None:
+                        break
+                    with trace.timer(HDF5_WRITE):
+                        dataset[block[0]:block[0] + len(block[1])] = block[1]
+                with trace.timer(HDF5_METADATA):
+                    attrs = dataset.attrs
+                    attrs['LAPS_layout'] = DERIVED_LAYOUT
+                    attrs['name'] = channel['name']
+                    attrs['expression'] = channel['expression']
+                    attrs['inputs'] = np.array(channel['inputs'], dtype=string_dtype)
+                    attrs['constants'] = json.dumps(channel['constants'], sort_keys=True)
+                    attrs['source'] = dataset_path
+                    attrs['source_rows'] = n_rows
+                    attrs['source_sha256'] = digest
+                    attrs['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                result.set_column(k, dataset)
+                status[channel['name']] = 'computed'
+                trace.file_done(channel['name'], time.perf_counter() - start, 0, n_rows * 8)
+
+            with trace.timer(HDF5_METADATA):
+                group.attrs['channels'] = np.array(names, dtype=string_dtype)
+        trace.finish()
+        for name, state in status.items():
+            print('      ', name + ':', state)
+        return status
+
+
+def stored_channels(f, dataset_path, json):
+    """
+    Return the derived channels stored for a time series of an HDF5 file.
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+    dataset_path (str): The path of the time series file inside the archive.
+    json (module): The JSON module to parse the 'constants' attributes.
+
+    Returns:
+    list: One dictionary per channel, in the order they were computed, with the keys 'name', 'expression',
+          'inputs', 'constants', 'source_rows', 'source_sha256' and 'dataset' (the h5py.Dataset).
+    """
+    path = DERIVED_GROUP + '/' + dataset_path.strip('/')
+    if path not in f:
+        return []
+    group = f[path]
+    names = [str(name) for name in group.attrs.get('channels', [])]
+    channels = []
+    for name in names:
+        dataset_name = _channel_dataset_name(name)
+        if dataset_name not in group:
+            continue
+        dataset = group[dataset_name]
+        attrs = dataset.attrs
+        channels.append({'name': name, 'expression': str(attrs['expression']),
+                         'inputs': [str(item) for item in attrs.get('inputs', [])],
+                         'constants': json.loads(attrs.get('constants', '{}')),
+                         'source_rows': int(attrs.get('source_rows', -1)),
+                         'source_sha256': str(attrs.get('source_sha256', '')), 'dataset': dataset})
+    return channels
+
+
+def load_time_series(f, dataset_path, n_columns, np):
+    """
+    Return the matrix and the preamble of a time series stored in an open HDF5 file.
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+    dataset_path (str): The path of the time series file inside the archive.
+    n_columns (int): The number of columns (the number of headers of its dataset folder).
+    np (module): The NumPy module for numerical operations.
+
+    Returns:
+    tuple: (matrix, preamble): an HDF5ColumnMatrix for time series stored as numeric matrices (columns are read
+           when used), otherwise the matrix parsed in memory from the stored file.
+    """
+    import io
+    from LAPS_stream_copy import BYTES_LAYOUT
+    from LAPS_timeseries_format import TIMESERIES_LAYOUT, _attr_str
+    from LAPS_3_archive_reader import LAPSDatasetFile
+    from LAPS_4_load_timeseries import parse_timeseries_file
+    from LAPS_4_plot_timeseries_from_HDF5 import HDF5ColumnMatrix
+
+    item = f[dataset_path]
+    layout = item.attrs.get('LAPS_layout')
+    if layout == TIMESERIES_LAYOUT:
+        return HDF5ColumnMatrix(item, np), _attr_str(item.attrs['preamble'])
+    if layout == BYTES_LAYOUT:
+        file = io.BufferedReader(LAPSDatasetFile(item, np))
+    else:
+        data = item[()]
+        file = io.BytesIO(data.tobytes() if hasattr(data, 'tobytes') else bytes(data))
+    with file:
+        preamble = read_preamble(file, n_columns)
+        return parse_timeseries_file(file, n_columns, np), preamble
+
+
+def time_series_headers(f, dataset_path, json, os):
+    """
+    Return the header labels of a time series stored in an HDF5 file.
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+    dataset_path (str): The path of the time series file inside the archive.
+    json (module): The JSON module to parse the schema stored in older HDF5 files.
+    os (module): The operating system module for path operations.
+
+    Returns:
+    list: The labels, from the 'headers' attribute of the dataset folder group, or for older HDF5 files from the
+          schema embedded in the file, or else from the 'headers' attribute of a numeric time series dataset.
+    """
+    from LAPS_0_compile_schema import compile_schema_text
+    from LAPS_metadata import read_schema_json, headers_for_path
+
+    header_array = headers_for_path(f, dataset_path)
+    if header_array is None:
+        header_array = compile_schema_text(read_schema_json(f), json).headers_for_path(dataset_path, os)
+    if not header_array and 'headers' in f[dataset_path].attrs:
+        header_array = [label.decode('utf-8') if isinstance(label, bytes) else str(label)
+                        for label in f[dataset_path].attrs['headers']]
+    return header_array
+
+
+def derived_matrix(matrix, header_array, derived, preamble, constants, np, json=None, f=None, dataset_path=None):
+    """
+    Return the time series matrix with its derived channels, reusing the stored ones that are up to date.
+
+    Parameters:
+    matrix (numpy.array or HDF5ColumnMatrix): The time series matrix.
+    header_array (list): The header labels of the matrix columns.
+    derived (dict or list): The channels to add (see compile_channels); may be None.
+    preamble (str): The preamble of the time series, for its constants (see preamble_constants).
+    constants (dict): Constants added to (or replacing) those of the preamble; may be None.
+    np (module): The NumPy module for numerical operations.
+    json (module, optional): The JSON module, to read the channels stored in f.
+    f (h5py.File, optional): The open HDF5 file holding the time series, to add its stored channels.
+    dataset_path (str, optional): The path of the time series file inside the archive.
+
+    Returns:
+    DerivedMatrix: The matrix with the stored channels (in the order they were computed), then the new ones.
+                   A channel declared in derived replaces the stored channel of the same name. Stored values
+                   are used only if the expression, the inputs, the constants and the source (number of rows
+                   and source hash) are unchanged, as well as those of the channels it uses.
+    """
+    from LAPS_source_tracking import HASH_ATTR
+
+    stored = stored_channels(f, dataset_path, json) if f is not None else []
+    items = {channel['name']: channel['expression'] for channel in stored}
+    items.update(derived.items() if isinstance(derived, dict) else [tuple(item) for item in derived or []])
+    values = preamble_constants(preamble)
+    values.update(constants or {})
+    channels = compile_channels(items, header_array, values)
+    result = DerivedMatrix(matrix, header_array, channels, np)
+
+    if stored:
+        digest = f[dataset_path].attrs.get(HASH_ATTR, '')
+        digest = digest.decode('utf-8') if isinstance(digest, bytes) else str(digest)
+        by_name = {channel['name']: channel for channel in stored}
+        reused = set()
+        for k, channel in enumerate(channels):
+            previous = by_name.get(channel['name'])
+            if previous is None or previous['expression'] != channel['expression'] \
+                    or previous['inputs'] != channel['inputs'] or previous['constants'] != channel['constants'] \
+                    or previous['source_rows'] != len(matrix) or previous['source_sha256'] != digest:
+                continue
+            if all(index in reused for kind, index in channel_dependencies(channel) if kind == 'channel'):
+                result.set_column(k, previous['dataset'])
+                reused.add(k)
+    return result
+
+
+def channel_dependencies(compiled):
+    """
+    Return the ('column', index) and ('channel', index) references of a compiled channel, including in first().
+    """
+    references = set(reference for reference in compiled['references'].values() if reference[0] != 'constant')
+    for first in compiled['firsts'].values():
+        references |= channel_dependencies(first)
+    return references
+
+
+def remove_orphaned_channels(f, h5py):
+    """
+    Delete the derived channels of time series that are no longer in the HDF5 file.
+
+    Parameters:
+    f (h5py.File): The HDF5 file open for writing.
+    h5py (module): The h5py module for working with HDF5 files.
+
+    Returns:
+    int: The number of time series whose channels were removed.
+    """
+    if DERIVED_GROUP not in f:
+        return 0
+    orphans = []
+
+    def collect(name, item):
+        if isinstance(item, h5py.Group) and 'channels' in item.attrs and name not in f:
+            orphans.append(name)
+
+    f[DERIVED_GROUP].visititems(lambda name, item: collect(name, item))
+    for name in orphans:
+        del f[DERIVED_GROUP + '/' + name]
+        # Remove the groups left empty
+        parent = (DERIVED_GROUP + '/' + name).rsplit('/', 1)[0]
+        while parent != DERIVED_GROUP and len(f[parent]) == 0:
+            del f[parent]
+            parent = parent.rsplit('/', 1)[0]
+    if len(f[DERIVED_GROUP]) == 0:
+        del f[DERIVED_GROUP]
+    return len(orphans)
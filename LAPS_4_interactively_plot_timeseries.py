@@ -2,24 +2,43 @@
 # Ekaterina Bolotskaya
 # 07/17/2023
 
-def LAPS_4_interactively_plot_timeseries(scdir, ts_dir, json, os, np):
+def LAPS_4_interactively_plot_timeseries(scdir, ts_dir, json, os, np, cache=True, max_points=2000,
+                                         progress=None, trace_file=None, derived=None, constants=None):
     """
     This function selectively prints out fields from a JSON schema file (original or recreated),
     gets header arrays from the schema, reads time series data from the specified .txt file,
     and then interactively plots the time series data.
 
     Parameters:
-    scdir (str): The path to the JSON schema file (original or recreated).
+    scdir (str or CompiledSchema): The path to the JSON schema file (original or recreated),
+                                   or the schema compiled by LAPS_0_compile_schema.
     ts_dir (str): The path to the .txt file containing time series data.
     json (module): The 'json' module for JSON file handling.
     os (module): The 'os' module for operating system-related functions.
     np (module): The 'numpy' module for numerical computing.
+    cache (bool, optional): If True, the parsed data is cached as a .npy file (see LAPS_4_load_timeseries),
+                            so reopening the same time series is nearly instant. Defaults to True.
+    max_points (int, optional): The maximum number of points drawn per column. Longer records are decimated
+                                with a min/max pyramid (see LAPS_4_decimate_timeseries). Defaults to 2000.
+    progress (callable, optional): Called with a dictionary at the start and the end of loading the data
+                                   (see LAPS_instrumentation.LAPSTrace), e.g. LAPS_instrumentation.print_progress.
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
+    derived (dict or list, optional): Derived channels to compute, channel name -> expression over the headers
+                                      and the preamble constants (see LAPS_4_derived_channels), e.g.
+                                      {'Stress, MPa': '{Load Axial Internal} * 1000 / (pi * {Diameter mm} ** 2 / 4)'}.
+                                      They are offered in the dropdowns after the headers. Defaults to None.
+    constants (dict, optional): Constants added to (or replacing) those of the preamble (e.g. {'Length mm': 19.95}).
+                                Defaults to None.
 
     Returns:
     None
 
     This function creates an interactive plot to visualize time series data stored in the 'ts_dir' file.
-    Users can select the data columns to be plotted against each other using a dropdown menu.
+    Users can select the data columns to be plotted against each other using a dropdown menu,
+    and the window of rows to be plotted using a slider. Only the minimum and maximum of each column per bucket
+    of rows are drawn when the window holds more than max_points rows, so redrawing does not slow down
+    with the record length. With an interactive matplotlib backend (e.g. ipympl), zooming in on a
+    monotonic x-axis (such as time) redraws the window at the finest resolution that fits.
 
     The 'scdir' parameter should contain the path to the JSON schema file ('.json') that defines the structure
     of the data being plotted. The schema file is used to identify the headers of the data columns.
@@ -39,14 +58,13 @@ def LAPS_4_interactively_plot_timeseries(scdir, ts_dir, json, os, np):
     """
 
     # Import required libraries
-    import ipywidgets as widgets
-    from IPython.display import display, clear_output, HTML
-    import matplotlib.pyplot as plt
+    from LAPS_0_compile_schema import load_schema
+    from LAPS_4_load_timeseries import LAPS_4_load_timeseries
+    from LAPS_4_derived_channels import read_preamble, derived_matrix
 
-    # Open the JSON file
-    with open(scdir) as f:
-        # Load the data from the file
-        data = json.load(f)
+    # Open the JSON file (or reuse the compiled schema)
+    schema = load_schema(scdir, json, os)
+    data = schema.metadata
 
     ## Print selected fields
     # Function to selectively print fields from the JSON schema
@@ -85,124 +103,192 @@ def LAPS_4_interactively_plot_timeseries(scdir, ts_dir, json, os, np):
     # Print dataset information and headers if available
     if 'datasets' in data['data']:
         print('Datasets:')
-        for item in data['data']['datasets']:
+        for item, labels in zip(schema.datasets, schema.dataset_headers):
             print('   ', item['data'])
             if item['data'] == 'Time_Series' and 'headers' in item:
-                ts_path = item['path']
-                for it2 in item['headers']:
-                    if 'header' in item['headers'][k]:
-                        print('      ', item['headers'][k]['header']['type'],
-                              item['headers'][k]['header']['spec_a'],
-                              item['headers'][k]['header']['spec_b'],
-                              item['headers'][k]['header']['spec_c'], ', ',
-                              item['headers'][k]['header']['unit'])
-                        header_array.append(item['headers'][k]['header']['type'] +
-                                            ' ' + item['headers'][k]['header']['spec_a'] +
-                                            ' ' + item['headers'][k]['header']['spec_b'] +
-                                            ' ' + item['headers'][k]['header']['spec_c'] +
-                                            ', ' + item['headers'][k]['header']['unit'])
-                    k += 1
+                for header in item['headers']:
+                    if 'header' in header:
+                        print('      ', header['header']['type'], header['header']['spec_a'],
+                              header['header']['spec_b'], header['header']['spec_c'], ', ',
+                              header['header']['unit'])
+                header_array.extend(labels)  # labels are built once by LAPS_0_compile_schema
+                k += len(item['headers'])
             else:
                 print('      No headers')
     else:
         print('No datasets')
 
-    # Read data from the provided time series data file
-    with open(ts_dir, "r") as file:
-        # Initialize an empty list to store the data
-        data = []
-        # Loop over each line in the file
-        for line in file:
-            # Strip any leading or trailing whitespace from the line
-            line = line.strip()
-            # Split the line by whitespace
-            values = line.split()
-            # Check if the line has the required number of values
-            if len(values) == k:
-                # Try to convert each value to a float
-                try:
-                    row = list(map(float, values))
-                    # Append the row to the data list
-                    data.append(row)
-                except ValueError:
-                    # Ignore lines with non-numeric values
-                    pass
-        # Convert the data list to a matrix
-        matrix = np.array(data)
-
-    class PlotGUI:
+    # Read data from the provided time series data file (memory-mapped from the cache if it was loaded before)
+    matrix = LAPS_4_load_timeseries(ts_dir, k, json, os, np, cache=cache, progress=progress,
+                                    trace_file=trace_file)
+
+    # Add the derived channels, computed (in blocks of rows) when plotted
+    if derived:
+        with open(ts_dir, 'rb') as file:
+            preamble = read_preamble(file, k)
+        matrix = derived_matrix(matrix, header_array, derived, preamble, constants, np)
+        header_array = matrix.header_array
+
+    # Create an instance of PlotGUI to enable interactive plotting
+    plot_gui = PlotGUI(matrix, header_array, max_points, np)
+
+
+class PlotGUI:
+    """
+    Class to create an interactive GUI for plotting time series data.
+
+    Attributes:
+    data_matrix (numpy.array): The matrix containing time series data.
+    header_array (list): List of strings containing header names for plotting.
+    pyramid (TimeseriesPyramid): The min/max pyramid used to decimate the plotted columns.
+    max_points (int): The maximum number of points drawn per column.
+    np (module): The 'numpy' module for numerical computing (constructor argument).
+    live (bool): If True, a Refresh button reloads a data_matrix that is still growing (constructor argument).
+
+    Methods:
+    plot(event): Function to handle the plot button click event and plot the selected data.
+    zoom(ax): Function to redraw the plotted window when the x-axis limits change.
+    refresh(event): Function to reload a growing data_matrix and redraw the plot.
+    """
+
+    def __init__(self, data_matrix, header_array, max_points, np, live=False):
+        import ipywidgets as widgets
+        from IPython.display import display
+        from LAPS_4_decimate_timeseries import TimeseriesPyramid
+
+        self.data_matrix = data_matrix
+        self.header_array = header_array
+        self.pyramid = TimeseriesPyramid(data_matrix, np)
+        self._np = np
+        self.max_points = max_points
+        self._monotonic = {}  # column index -> whether the column never decreases
+        self._indices = None  # (x, y) column indices of the current plot
+
+        # Create GUI elements
+        self.x_dropdown = widgets.Dropdown(options=self.header_array, description='X-axis:',
+                                           layout=widgets.Layout(width='auto'))
+        self.y_dropdown = widgets.Dropdown(options=self.header_array, description='Y-axis:',
+                                           layout=widgets.Layout(width='auto'))
+        self.rows_slider = widgets.IntRangeSlider(value=[0, len(self.data_matrix)], min=0,
+                                                  max=len(self.data_matrix), description='Rows:',
+                                                  layout=widgets.Layout(width='auto'))
+        self.plot_button = widgets.Button(description='Plot',
+                                           layout=widgets.Layout(width='auto', button_color='red'))
+        self.refresh_button = widgets.Button(description='Refresh', layout=widgets.Layout(width='auto'))
+        self.output = widgets.Output()
+
+        # Set default selections
+        self.x_dropdown.value = self.header_array[0]
+        self.y_dropdown.value = self.header_array[0]
+
+        # Register event handlers
+        self.plot_button.on_click(self.plot)
+        self.refresh_button.on_click(self.refresh)
+
+        # Display the GUI elements
+        buttons = [self.plot_button, self.refresh_button] if live else [self.plot_button]
+        display(widgets.VBox([self.x_dropdown, self.y_dropdown, self.rows_slider] + buttons + [self.output]))
+
+    def plot(self, event):
         """
-        Class to create an interactive GUI for plotting time series data.
+        Function to handle the plot button click event and plot the selected data.
 
-        Attributes:
-        data_matrix (numpy.array): The matrix containing time series data.
-        header_array (list): List of strings containing header names for plotting.
+        Parameters:
+        event: The event object representing the click event on the plot button.
 
-        Methods:
-        plot(event): Function to handle the plot button click event and plot the selected data.
+        Returns:
+        None
+
+        This function retrieves the selected x-axis and y-axis labels from the dropdown menus,
+        extracts the corresponding data columns from the data_matrix for the selected rows
+        (decimated to at most max_points per column), and plots them using matplotlib.
         """
 
-        def __init__(self, data_matrix, header_array):
-            self.data_matrix = data_matrix
-            self.header_array = header_array
-
-            # Create GUI elements
-            self.x_dropdown = widgets.Dropdown(options=self.header_array, description='X-axis:',
-                                               layout=widgets.Layout(width='auto'))
-            self.y_dropdown = widgets.Dropdown(options=self.header_array, description='Y-axis:',
-                                               layout=widgets.Layout(width='auto'))
-            self.plot_button = widgets.Button(description='Plot',
-                                               layout=widgets.Layout(width='auto', button_color='red'))
-            self.output = widgets.Output()
-
-            # Set default selections
-            self.x_dropdown.value = self.header_array[0]
-            self.y_dropdown.value = self.header_array[0]
-        
-            # Register event handlers
-            self.plot_button.on_click(self.plot)
-
-            # Display the GUI elements
-            display(widgets.VBox([self.x_dropdown, self.y_dropdown, self.plot_button, self.output]))
-
-        def plot(self, event):
-            """
-            Function to handle the plot button click event and plot the selected data.
-
-            Parameters:
-            event: The event object representing the click event on the plot button.
-
-            Returns:
-            None
-
-            This function retrieves the selected x-axis and y-axis labels from the dropdown menus,
-            extracts the corresponding data columns from the data_matrix, and plots them using matplotlib.
-            """
-
-            with self.output:
-                # Clear previous output
-                clear_output()
-
-                # Get selected x and y labels
-                x_label = self.x_dropdown.value
-                y_label = self.y_dropdown.value
-
-                # Get corresponding column indices
-                x_index = self.header_array.index(x_label)
-                y_index = self.header_array.index(y_label)
-
-                # Get data for x and y axes
-                x_data = self.data_matrix[:, x_index]
-                y_data = self.data_matrix[:, y_index]
-
-                # Plot the data
-                plt.figure(figsize=(10, 5))
-                plt.plot(x_data, y_data, '-')
-                plt.xlabel(x_label)
-                plt.ylabel(y_label)
-                plt.grid(True)
-                plt.tight_layout()
-                plt.show()
+        from IPython.display import clear_output
+        import matplotlib.pyplot as plt
+
+        with self.output:
+            # Clear previous output
+            clear_output()
+
+            # Get selected x and y labels
+            x_label = self.x_dropdown.value
+            y_label = self.y_dropdown.value
+
+            # Get corresponding column indices
+            x_index = self.header_array.index(x_label)
+            y_index = self.header_array.index(y_label)
+
+            # Get data for x and y axes (envelope of both columns over the selected rows)
+            start, stop = self.rows_slider.value
+            rows = self.pyramid.select([x_index, y_index], start, stop, self.max_points)
+            x_data = self.data_matrix[rows, x_index]
+            y_data = self.data_matrix[rows, y_index]
+
+            # Plot the data
+            plt.figure(figsize=(10, 5))
+            self._line, = plt.plot(x_data, y_data, '-')
+            self._indices = (x_index, y_index)
+            plt.xlabel(x_label)
+            plt.ylabel(y_label)
+            plt.grid(True)
+            plt.tight_layout()
+            plt.gca().callbacks.connect('xlim_changed', self.zoom)
+            plt.show()
+
+    def zoom(self, ax):
+        """
+        Function to redraw the plotted window at the finest resolution that fits when the x-axis limits change.
 
-    # Create an instance of PlotGUI to enable interactive plotting
-    plot_gui = PlotGUI(matrix, header_array)
+        Parameters:
+        ax: The matplotlib axes whose limits changed.
+
+        Returns:
+        None
+
+        The visible x range is converted to a window of rows, which is only possible if the x column
+        never decreases (e.g. time); otherwise the plot is left unchanged.
+        """
+        np = self._np
+        x_index, y_index = self._indices
+        if x_index not in self._monotonic:
+            column = self.data_matrix[:, x_index]
+            self._monotonic[x_index] = bool(np.all(column[1:] >= column[:-1]))
+        if not self._monotonic[x_index]:
+            return
+        x_low, x_high = ax.get_xlim()
+        column = self.data_matrix[:, x_index]
+        start = max(int(np.searchsorted(column, x_low, side='left')) - 1, 0)
+        stop = int(np.searchsorted(column, x_high, side='right')) + 1
+        rows = self.pyramid.select([x_index, y_index], start, stop, self.max_points)
+        self._line.set_data(self.data_matrix[rows, x_index], self.data_matrix[rows, y_index])
+        ax.figure.canvas.draw_idle()
+
+    def refresh(self, event=None):
+        """
+        Function to reload a data_matrix that is still growing (a time series followed by LAPS_2_follow_timeseries)
+        and redraw the current plot.
+
+        Parameters:
+        event: The event object representing the click event on the refresh button.
+
+        Returns:
+        None
+
+        The plotted columns are read again from the HDF5 file and their pyramid is rebuilt; the time series
+        file is not parsed again. If the row window ended at the last row, it is extended to the new last row.
+        """
+        from LAPS_4_decimate_timeseries import TimeseriesPyramid
+
+        old_rows = len(self.data_matrix)
+        n_rows = self.data_matrix.refresh()
+        if n_rows == old_rows:
+            return
+        self.pyramid = TimeseriesPyramid(self.data_matrix, self._np)
+        self._monotonic = {}
+        start, stop = self.rows_slider.value
+        self.rows_slider.max = n_rows
+        if stop == old_rows:
+            self.rows_slider.value = [start, n_rows]
+        if self._indices is not None:
+            self.plot(event)
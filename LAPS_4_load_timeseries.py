@@ -0,0 +1,191 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+def LAPS_4_load_timeseries(ts_dir, n_columns, json, os, np, cache=True, cache_dir=None, block_size=16777216,
+                           progress=None, trace_file=None):
+    """
+    Load the numeric rows of a time series .txt file into a float matrix, with an on-disk cache.
+
+    Parameters:
+    ts_dir (str): The path to the .txt file containing time series data.
+    n_columns (int): The number of columns (the number of headers in the JSON schema).
+    json (module): The 'json' module for the cache index file.
+    os (module): The 'os' module for operating system-related functions.
+    np (module): The 'numpy' module for numerical computing.
+    cache (bool, optional): If True, the matrix is saved as a .npy file and memory-mapped on the next call.
+                            Defaults to True.
+    cache_dir (str, optional): The cache directory. Defaults to ~/.cache/laps/timeseries
+                               (not next to the data, so the cache is never ingested by LAPS_2).
+    block_size (int, optional): The number of bytes parsed at a time. Defaults to 16777216.
+    progress (callable, optional): Called with a dictionary at the start and the end
+                                   (see LAPS_instrumentation.LAPSTrace), e.g. LAPS_instrumentation.print_progress.
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
+
+    Returns:
+    numpy.array: The matrix with one row per data line (read-only memory map when taken from the cache).
+
+    The file is parsed by parse_timeseries_file. The cache is keyed by the file size, modification time and SHA-256 hash: size and time are compared
+    first, and the file is only hashed if the time changed (e.g. a copied file) to check the content.
+    """
+    import hashlib
+    import time
+    from LAPS_source_tracking import file_sha256
+    from LAPS_instrumentation import LAPSTrace, FS_READ, FS_WRITE, FS_METADATA
+
+    with LAPSTrace('LAPS_4_load_timeseries', progress, trace_file, files_total=1, ts_dir=ts_dir) as trace:
+        start = time.perf_counter()
+        with trace.timer(FS_METADATA):
+            stat = os.stat(ts_dir)
+
+        # Look up the cache entry of this file
+        if cache:
+            if cache_dir is None:
+                cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'laps', 'timeseries')
+            key = hashlib.sha256(os.path.abspath(ts_dir).encode('utf-8')).hexdigest()
+            npy_path = os.path.join(cache_dir, key + '.npy')
+            index_path = os.path.join(cache_dir, key + '.json')
+            try:
+                with open(index_path, 'r') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+            if entry and entry.get('n_columns') == n_columns and entry.get('size') == stat.st_size \
+                    and os.path.exists(npy_path):
+                digest = None
+                if entry.get('mtime_ns') != stat.st_mtime_ns:
+                    digest = file_sha256(ts_dir, block_size)
+                if digest is None or digest == entry.get('sha256'):
+                    if digest is not None:
+                        entry['mtime_ns'] = stat.st_mtime_ns
+                        with open(index_path, 'w') as f:
+                            json.dump(entry, f)
+                    with trace.timer(FS_READ):
+                        matrix = np.load(npy_path, mmap_mode='r')
+                    trace.file_done(ts_dir, time.perf_counter() - start)
+                    trace.finish(cached=True)
+                    return matrix
+
+        hasher = hashlib.sha256()
+        with open(ts_dir, 'rb') as file:
+            matrix = parse_timeseries_file(file, n_columns, np, block_size, hasher, trace)
+        trace.file_done(ts_dir, time.perf_counter() - start, stat.st_size)
+
+        # Save the matrix and its index entry (replace atomically, keep working if the cache is not writable)
+        if cache:
+            try:
+                with trace.timer(FS_WRITE):
+                    os.makedirs(cache_dir, exist_ok=True)
+                    np.save(npy_path + '.tmp.npy', matrix)
+                    os.replace(npy_path + '.tmp.npy', npy_path)
+                    with open(index_path, 'w') as f:
+                        json.dump({'path': os.path.abspath(ts_dir), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                   'sha256': hasher.hexdigest(), 'n_columns': n_columns}, f)
+                matrix = np.load(npy_path, mmap_mode='r')
+            except OSError:
+                pass
+        trace.finish(cached=False)
+        return matrix
+
+
+def parse_timeseries_file(file, n_columns, np, block_size=16777216, hasher=None, trace=None):
+    """
+    Parse the numeric rows of a time series from a binary file object.
+
+    Parameters:
+    file (file object): A seekable binary file object positioned at the start of the time series.
+    n_columns (int): The number of columns (the number of headers in the JSON schema).
+    np (module): The 'numpy' module for numerical computing.
+    block_size (int, optional): The number of bytes parsed at a time. Defaults to 16777216.
+    hasher (hashlib object, optional): If given, it is updated with every byte of the file.
+    trace (LAPSTrace, optional): If given, the time spent reading and parsing is added to its timers.
+
+    Returns:
+    numpy.array: The matrix with one row per data line.
+
+    A line is a data row if it holds exactly n_columns numbers, as in LAPS_4_interactively_plot_timeseries.
+    Everything before the first data row is skipped; the rest is parsed block by block with NumPy's C parser
+    into a preallocated array, and only blocks that contain other lines fall back to line-by-line parsing.
+    """
+    import time
+    import warnings
+    from LAPS_instrumentation import FS_READ, CPU
+
+    # Function to parse line by line, keeping the lines with exactly n_columns numbers
+    def parse_lines(text):
+        rows = []
+        for line in text.splitlines():
+            values = line.split()
+            if len(values) == n_columns:
+                try:
+                    rows.append([float(value) for value in values])
+                except ValueError:
+                    pass  # ignore lines with non-numeric values
+        return np.array(rows, dtype=np.float64).reshape(-1, n_columns)
+
+    # Function to check that every line of a block holds exactly n_columns fields (a matching total is not enough:
+    # a long line next to a short or blank one would shift every later row)
+    def fields_per_line_ok(block, n_lines):
+        if block.count(b'\r') != block.count(b'\r\n'):
+            return False  # a lone carriage return ends a line for parse_lines
+        data = np.frombuffer(block, dtype=np.uint8)
+        space = (data == 32) | ((data >= 9) & (data <= 13))
+        starts = ~space
+        starts[1:] &= space[:-1]
+        line_of = np.cumsum(data == 10)
+        counts = np.bincount(line_of[starts], minlength=n_lines)
+        return len(counts) == n_lines and bool(np.all(counts == n_columns))
+
+    # Skip the preamble up to the first data row
+    start = file.tell()
+    while True:
+        line = file.readline()
+        if not line or len(parse_lines(line.decode('latin-1'))):
+            break
+        if hasher is not None:
+            hasher.update(line)
+        start += len(line)
+    end = file.seek(0, 2)
+    file.seek(start)
+
+    # Preallocate from the size of the first data row, growing if the estimate is short
+    row_bytes = max(len(line), 1)
+    matrix = np.empty((int((end - start) / row_bytes * 1.05) + 1, n_columns), dtype=np.float64)
+    n_rows = 0
+
+    times = [0.0, 0.0]  # reading, parsing
+    while True:
+        begin = time.perf_counter()
+        block = file.read(block_size)
+        if not block:
+            break
+        block += file.readline()  # end the block at a line boundary
+        middle = time.perf_counter()
+        if hasher is not None:
+            hasher.update(block)
+        text = block.decode('latin-1')
+
+        # Parse the block at once; every line must hold exactly n_columns numbers
+        n_lines = text.count('\n') + (0 if text.endswith('\n') else 1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            try:
+                values = np.fromstring(text, dtype=np.float64, sep=' ')
+            except (ValueError, DeprecationWarning):
+                values = None
+        if values is not None and values.size == n_lines * n_columns and fields_per_line_ok(block, n_lines):
+            rows = values.reshape(-1, n_columns)
+        else:
+            rows = parse_lines(text)
+
+        if n_rows + len(rows) > len(matrix):
+            matrix = np.resize(matrix, (max(2 * len(matrix), n_rows + len(rows)), n_columns))
+        matrix[n_rows:n_rows + len(rows)] = rows
+        n_rows += len(rows)
+        times[0] += middle - begin
+        times[1] += time.perf_counter() - middle
+
+    if trace is not None:
+        trace.add_time(FS_READ, times[0])
+        trace.add_time(CPU, times[1])
+    return matrix[:n_rows]
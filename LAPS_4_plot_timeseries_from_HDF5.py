@@ -0,0 +1,162 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+def LAPS_4_plot_timeseries_from_HDF5(hdf5_file, dataset_path, json, os, np, h5py, max_points=2000,
+                                     progress=None, trace_file=None, live=False, derived=None, constants=None):
+    """
+    Interactively plot a time series stored in an HDF5 file created by LAPS_2_HDF5_from_directory,
+    without extracting it.
+
+    Parameters:
+    hdf5_file (str): The path to the HDF5 file.
+    dataset_path (str): The path of the time series file inside the archive
+                        (e.g. 'data/datasets/Time_Series_1/Paterson#5_ExampleData.txt').
+    json (module): The 'json' module to parse the schema stored in the HDF5 file.
+    os (module): The 'os' module for operating system-related functions.
+    np (module): The 'numpy' module for numerical computing.
+    h5py (module): The 'h5py' module for working with HDF5 files.
+    max_points (int, optional): The maximum number of points drawn per column. Defaults to 2000.
+    progress (callable, optional): Called with a dictionary at the start and the end of loading the data
+                                   (see LAPS_instrumentation.LAPSTrace), e.g. LAPS_instrumentation.print_progress.
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
+    live (bool, optional): If True, the HDF5 file is read while LAPS_2_follow_timeseries appends to the time series
+                           (SWMR mode), and a Refresh button redraws the plot with the rows added since.
+                           Defaults to False.
+    derived (dict or list, optional): Derived channels to compute, channel name -> expression over the headers
+                                      and the preamble constants (see LAPS_4_derived_channels), offered in the
+                                      dropdowns after the headers. Defaults to None.
+    constants (dict, optional): Constants added to (or replacing) those of the preamble (e.g. {'Length mm': 19.95}).
+                                Defaults to None.
+
+    Returns:
+    None
+
+    The headers are taken from the 'headers' attribute of the dataset folder group, or for older HDF5 files from
+    the schema embedded in the file (the entry of the dataset folder the file is in).
+    Time series stored as numeric matrices (LAPS_2_HDF5_from_directory with timeseries=True) are read
+    column by column: each plot only reads the x and y columns over the rows being drawn, and the min/max pyramid
+    of a column is built from one read of that column. Time series stored as files are parsed from the archive
+    in memory (see LAPS_3_archive_reader and LAPS_4_load_timeseries).
+    The derived channels saved in the file by LAPS_4_derive_channels are offered too, read from the file while
+    they are up to date and computed again otherwise (e.g. after Refresh in live mode).
+    The HDF5 file stays open while the plot is in use.
+
+    Usage example:
+    LAPS_4_plot_timeseries_from_HDF5('data.h5', 'data/datasets/Time_Series_1/Paterson#5_ExampleData.txt',
+                                     json, os, np, h5py)
+    """
+    from LAPS_0_compile_schema import compile_schema_text
+    from LAPS_metadata import read_schema_json, headers_for_path
+    from LAPS_timeseries_format import TIMESERIES_LAYOUT
+    from LAPS_3_archive_reader import LAPSArchiveReader
+    from LAPS_4_load_timeseries import parse_timeseries_file
+    from LAPS_4_interactively_plot_timeseries import PlotGUI
+    from LAPS_4_derived_channels import read_preamble, derived_matrix
+    from LAPS_instrumentation import LAPSTrace, HDF5_METADATA
+
+    with LAPSTrace('LAPS_4_plot_timeseries_from_HDF5', progress, trace_file, files_total=1,
+                   hdf5_file=hdf5_file, dataset_path=dataset_path) as trace:
+        with trace.timer(HDF5_METADATA):
+            archive = LAPSArchiveReader(hdf5_file, h5py, np, swmr=live)
+        dataset_path = dataset_path.replace(os.sep, '/').strip('/')
+
+        # Get the headers of the dataset folder from its attributes (or from the embedded schema in older files)
+        with trace.timer(HDF5_METADATA):
+            header_array = headers_for_path(archive.file, dataset_path)
+            if header_array is None:
+                schema_json = read_schema_json(archive.file)
+        if header_array is None:
+            schema = compile_schema_text(schema_json, json)
+            header_array = schema.headers_for_path(dataset_path, os)
+        print('Dataset:', dataset_path)
+        for header in header_array:
+            print('      ', header)
+
+        with trace.timer(HDF5_METADATA):
+            item = archive.file[dataset_path]
+            layout = item.attrs.get("LAPS_layout")
+        if layout == TIMESERIES_LAYOUT:
+            if not header_array:
+                header_array = [str(label) for label in item.attrs['headers']]
+            matrix = HDF5ColumnMatrix(item, np)  # columns are read when plotted
+            preamble = item.attrs['preamble']
+            trace.file_done(dataset_path, trace.elapsed())
+        else:
+            with archive.open(dataset_path) as file:
+                preamble = read_preamble(file, len(header_array))
+                matrix = parse_timeseries_file(file, len(header_array), np, trace=trace)
+            trace.file_done(dataset_path, trace.elapsed(), item.id.get_storage_size())
+        trace.finish()
+
+        # Add the derived channels stored in the file and those asked for, computed when plotted
+        preamble = preamble.decode('utf-8') if isinstance(preamble, bytes) else str(preamble)
+        with_channels = derived_matrix(matrix, header_array, derived, preamble, constants, np, json,
+                                       archive.file, dataset_path)
+        if with_channels.channels:
+            matrix, header_array = with_channels, with_channels.header_array
+            for channel in with_channels.channels:
+                print('      ', channel['name'], '=', channel['expression'])
+
+        # Create an instance of PlotGUI to enable interactive plotting
+        plot_gui = PlotGUI(matrix, header_array, max_points, np, live=live and layout == TIMESERIES_LAYOUT)
+
+
+class HDF5ColumnMatrix:
+    """
+    Class giving matrix-style, column-wise access to a time series dataset of an HDF5 file, reading only what is indexed.
+
+    Attributes:
+    dataset (h5py.Dataset): The 2-D time series dataset.
+    shape (tuple): The shape of the dataset.
+
+    Supports m[:, j] (one column), m[a:b, j] (a row range of one column) and m[rows, j] with sorted row indices,
+    which reads the rows between the first and last index only. The last few full columns read are kept in memory.
+    """
+
+    def __init__(self, dataset, np, cached_columns=4):
+        self.dataset = dataset
+        self.shape = dataset.shape
+        self._np = np
+        self._cached_columns = cached_columns
+        self._columns = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def refresh(self):
+        """
+        Reload the shape of a dataset that is still being appended to (HDF5 file opened in SWMR mode).
+
+        Returns:
+        int: The number of rows. The cached columns are dropped if rows were added.
+        """
+        self.dataset.refresh()
+        if self.dataset.shape != self.shape:
+            self.shape = self.dataset.shape
+            self._columns = {}
+        return self.shape[0]
+
+    def _column(self, column):
+        """
+        Read (or reuse) a full column.
+        """
+        if column not in self._columns:
+            if len(self._columns) >= self._cached_columns:
+                self._columns.pop(next(iter(self._columns)))
+            self._columns[column] = self.dataset[:, column]
+        return self._columns[column]
+
+    def __getitem__(self, key):
+        rows, column = key
+        if column in self._columns:
+            return self._columns[column][rows]
+        if isinstance(rows, slice):
+            if rows == slice(None):
+                return self._column(column)
+            return self.dataset[rows, column]
+        rows = self._np.asarray(rows)
+        if rows.size == 0:
+            return self._np.empty(0, dtype=self.dataset.dtype)
+        first, last = int(rows.min()), int(rows.max())
+        return self.dataset[first:last + 1, column][rows - first]
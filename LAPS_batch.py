@@ -0,0 +1,263 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+def LAPS_batch(root, output_dir, json, os, mode='convert', processes=None, retries=1, skip_existing=False,
+               summary_file=None, verbose=True, **options):
+    """
+    Convert (or extract) many experiments at once, one experiment per process.
+
+    Parameters:
+    root (str): The folder holding the experiments. In 'convert' mode every schema file '<name>.json' with a
+                populated directory '<name>' next to it is an experiment; in 'extract' mode every '.h5' file is one.
+                Subfolders are searched too (the experiment folders themselves are not).
+    output_dir (str): The folder for the results, with the same subfolders as root: '<name>.h5' in 'convert' mode,
+                      the directory '<name>' and the recreated schema '<name>.json' in 'extract' mode.
+    json (module): The JSON module to write the summary.
+    os (module): The operating system module for file and directory operations.
+    mode (str, optional): 'convert' (LAPS_2_HDF5_from_directory) or 'extract' (LAPS_3_create_directory_from_HDF5).
+                          Defaults to 'convert'.
+    processes (int, optional): The number of worker processes. Defaults to the number of CPUs.
+    retries (int, optional): The number of times a failed experiment is retried before it is skipped. Defaults to 1.
+    skip_existing (bool, optional): If True, experiments whose output already exists are skipped. Defaults to False.
+    summary_file (str, optional): If given, the summary is also written to this JSON file.
+    verbose (bool, optional): If True, a progress line is printed for every finished experiment. Defaults to True.
+    **options: Passed to LAPS_2_HDF5_from_directory (e.g. timeseries=True, block_size=1048576, update=True, dedup=True)
+               or LAPS_3_create_directory_from_HDF5 (e.g. block_size=1048576).
+
+    Returns:
+    dict: The summary: 'mode', 'processes', 'elapsed' (seconds), 'bytes' (input bytes processed), 'ok', 'failed',
+          'skipped' (counts) and 'jobs' (one dict per experiment with 'name', 'source', 'output', 'status',
+          'attempts', 'bytes', 'seconds', 'error' and, for converted experiments, 'filters').
+
+    Each experiment runs in its own process, so HDF5 (which serializes all calls within a process) is used
+    on every core. A failed experiment does not stop the others; its error is kept in the summary.
+    The output of the LAPS functions is captured and only shown (in 'error') for failed experiments.
+    With trace_file in the options, every experiment traces to a file of its own, appended to trace_file by this
+    process when the experiment is done, so the events of parallel experiments never interleave (appends from
+    several processes are not atomic on network file systems).
+
+    Usage example:
+    summary = LAPS_batch('campaign', 'archives', json, os, processes=8, timeseries=True, update=True)
+    From a shell: python LAPS_batch.py convert campaign archives --processes 8 --timeseries --update
+    """
+    import tempfile
+    import time
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    if mode not in ('convert', 'extract'):
+        raise ValueError("Invalid mode: " + str(mode))
+    processes = processes or os.cpu_count() or 1
+
+    # Make the list of jobs, skipping the experiments already done if asked
+    trace_file = options.pop('trace_file', None)
+    jobs = []
+    skipped = []
+    for name, source, schema in discover_experiments(root, os, mode):
+        if mode == 'convert':
+            output = os.path.join(output_dir, name + '.h5')
+        else:
+            output = os.path.join(output_dir, name)
+        job = {'name': name.replace(os.sep, '/'), 'source': source, 'schema': schema, 'output': output,
+               'mode': mode, 'retries': retries, 'options': options}
+        if skip_existing and os.path.exists(output):
+            skipped.append({'name': job['name'], 'source': source, 'output': output, 'status': 'skipped',
+                            'attempts': 0, 'bytes': 0, 'seconds': 0.0, 'error': None})
+        else:
+            if trace_file:
+                descriptor, job_trace = tempfile.mkstemp(suffix='.part', prefix=os.path.basename(trace_file) + '.',
+                                                         dir=os.path.dirname(os.path.abspath(trace_file)))
+                os.close(descriptor)
+                job['options'] = dict(options, trace_file=job_trace)
+            jobs.append(job)
+
+    # Function to append the trace of a finished job to trace_file (only complete lines: a crashed worker
+    # may have stopped in the middle of one)
+    def merge_trace(job):
+        job_trace = job['options']['trace_file']
+        with open(job_trace, 'rb') as f:
+            events = f.read()
+        with open(trace_file, 'ab') as f:
+            f.write(events[:events.rfind(b'\n') + 1])
+        os.remove(job_trace)
+
+    # Run the jobs in the worker processes, reporting each one as it finishes
+    results = []
+    done_bytes = 0
+    start = time.perf_counter()
+    if verbose:
+        print("LAPS batch:", len(jobs), "experiment(s) to", mode, "with", processes, "process(es),",
+              len(skipped), "skipped")
+    with ProcessPoolExecutor(max_workers=min(processes, max(len(jobs), 1))) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as error:  # e.g. a worker process that crashed
+                result = {'name': job['name'], 'source': job['source'], 'output': job['output'],
+                          'status': 'failed', 'attempts': 1, 'bytes': 0, 'seconds': 0.0,
+                          'error': type(error).__name__ + ': ' + str(error)}
+            if trace_file:
+                merge_trace(job)
+            results.append(result)
+            done_bytes += result['bytes']
+            if verbose:
+                elapsed = time.perf_counter() - start
+                print('[{}/{}] {} {}: {:.1f} MB in {:.1f} s, total {:.1f} MB/s'.format(
+                    len(results), len(jobs), result['status'], result['name'], result['bytes'] / 1e6,
+                    result['seconds'], done_bytes / 1e6 / elapsed if elapsed > 0 else 0.0))
+                if result['error']:
+                    print('      ', result['error'].strip().splitlines()[-1])
+
+    # Summarize, in discovery order
+    order = {job['name']: i for i, job in enumerate(jobs)}
+    results.sort(key=lambda result: order[result['name']])
+    summary = {'mode': mode, 'processes': processes, 'elapsed': time.perf_counter() - start, 'bytes': done_bytes,
+               'ok': sum(result['status'] == 'ok' for result in results),
+               'failed': sum(result['status'] == 'failed' for result in results),
+               'skipped': len(skipped), 'jobs': skipped + results}
+    if summary_file:
+        with open(summary_file, 'w') as f:
+            json.dump(summary, f, indent=4)
+    if verbose:
+        print("LAPS batch done: {} ok, {} failed, {} skipped, {:.1f} MB in {:.1f} s".format(
+            summary['ok'], summary['failed'], summary['skipped'], done_bytes / 1e6, summary['elapsed']))
+    return summary
+
+
+def discover_experiments(root, os, mode='convert'):
+    """
+    Find the experiments under a folder.
+
+    Parameters:
+    root (str): The folder to search (subfolders included).
+    os (module): The operating system module for directory operations.
+    mode (str, optional): 'convert' to find '<name>.json' schema files with a '<name>' directory next to them,
+                          'extract' to find '.h5' files. Defaults to 'convert'.
+
+    Returns:
+    list: Tuples (name, source, schema) in sorted order, where name is the path relative to root without extension,
+          source the experiment directory (or HDF5 file) and schema the schema file (None in 'extract' mode).
+    """
+    experiments = []
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        if mode == 'extract':
+            for file in sorted(files):
+                if file.lower().endswith(('.h5', '.hdf5')):
+                    source = os.path.join(folder, file)
+                    experiments.append((os.path.splitext(os.path.relpath(source, root))[0], source, None))
+            continue
+        for file in sorted(files):
+            name, extension = os.path.splitext(file)
+            if extension.lower() == '.json' and name in dirs:
+                source = os.path.join(folder, name)
+                experiments.append((os.path.relpath(source, root), source, os.path.join(folder, file)))
+                dirs.remove(name)  # the experiment folder holds data, not more experiments
+    return experiments
+
+
+def run_job(job):
+    """
+    Run one experiment of LAPS_batch in a worker process, retrying it if it fails.
+
+    Parameters:
+    job (dict): The job made by LAPS_batch ('name', 'source', 'schema', 'output', 'mode', 'retries', 'options').
+
+    Returns:
+    dict: The job result ('name', 'source', 'output', 'status', 'attempts', 'bytes', 'seconds', 'error', and in
+          'convert' mode 'filters', the statistics per filter spec returned by LAPS_2_HDF5_from_directory).
+    """
+    import contextlib
+    import io
+    import json
+    import os
+    import time
+    import traceback
+    import h5py
+    import numpy as np
+    from LAPS_2_HDF5_from_directory import LAPS_2_HDF5_from_directory
+    from LAPS_3_create_directory_from_HDF5 import LAPS_3_create_directory_from_HDF5
+
+    result = {'name': job['name'], 'source': job['source'], 'output': job['output'], 'status': 'failed',
+              'attempts': 0, 'bytes': 0, 'seconds': 0.0, 'error': None}
+    start = time.perf_counter()
+    for attempt in range(1 + max(job['retries'], 0)):
+        result['attempts'] = attempt + 1
+        log = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(log):
+                os.makedirs(os.path.dirname(os.path.abspath(job['output'])), exist_ok=True)
+                if job['mode'] == 'convert':
+                    result['filters'] = LAPS_2_HDF5_from_directory(job['schema'], job['source'], job['output'],
+                                                                   json, os, np, h5py, **job['options'])
+                else:
+                    LAPS_3_create_directory_from_HDF5(job['source'], job['output'], job['output'] + '.json',
+                                                      json, os, np, h5py, **job['options'])
+        except Exception:
+            result['error'] = log.getvalue() + traceback.format_exc()
+            continue
+        result['status'] = 'ok'
+        result['error'] = None
+        break
+    result['seconds'] = time.perf_counter() - start
+
+    # Count the input bytes for the throughput
+    if result['status'] == 'ok':
+        if job['mode'] == 'convert':
+            for folder, dirs, files in os.walk(job['source']):
+                result['bytes'] += sum(os.path.getsize(os.path.join(folder, file)) for file in files)
+        else:
+            result['bytes'] = os.path.getsize(job['source'])
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+    import contextlib
+    import json
+    import os
+    import sys
+
+    parser = argparse.ArgumentParser(description="Convert (or extract) many LAPS experiments in parallel processes.")
+    parser.add_argument('mode', choices=['convert', 'extract'],
+                        help="'convert': <name>.json + <name>/ to <name>.h5; 'extract': <name>.h5 to <name>/")
+    parser.add_argument('root', help="the folder holding the experiments")
+    parser.add_argument('output_dir', help="the folder for the results")
+    parser.add_argument('--processes', type=int, default=None, help="number of worker processes (default: CPUs)")
+    parser.add_argument('--retries', type=int, default=1, help="retries of a failed experiment (default: 1)")
+    parser.add_argument('--skip-existing', action='store_true', help="skip experiments whose output exists")
+    parser.add_argument('--summary', default=None, help="write the JSON summary to this file (default: stdout)")
+    parser.add_argument('--quiet', action='store_true', help="do not print progress")
+    parser.add_argument('--block-size', type=int, default=None, help="copy files block by block (bytes)")
+    parser.add_argument('--trace', default=None, help="append the per-file events of every experiment to this "
+                                                      "JSON lines file (one experiment after the other)")
+    parser.add_argument('--timeseries', action='store_true', help="convert: store time series as numeric datasets")
+    parser.add_argument('--update', action='store_true', help="convert: update existing HDF5 files in place")
+    parser.add_argument('--dedup', action='store_true', help="convert: store identical files once")
+    parser.add_argument('--workers', type=int, default=1, help="convert: reading threads per experiment")
+    parser.add_argument('--filters', default=None,
+                        help="convert: compression policy, 'default' or JSON (e.g. '{\".txt\": \"gzip:6\"}')")
+    parser.add_argument('--validate', action='store_true',
+                        help="convert: check each experiment JSON against the LAPS schema first")
+    args = parser.parse_args()
+
+    options = {}
+    if args.block_size:
+        options['block_size'] = args.block_size
+    if args.trace:
+        options['trace_file'] = os.path.abspath(args.trace)
+    if args.mode == 'convert':
+        options.update(timeseries=args.timeseries, update=args.update, dedup=args.dedup, workers=args.workers,
+                       filters=args.filters, validate=args.validate)
+
+    # Progress goes to stderr, so stdout only holds the summary
+    with contextlib.redirect_stdout(sys.stderr):
+        summary = LAPS_batch(args.root, args.output_dir, json, os, mode=args.mode, processes=args.processes,
+                             retries=args.retries, skip_existing=args.skip_existing, summary_file=args.summary,
+                             verbose=not args.quiet, **options)
+    if not args.summary:
+        json.dump(summary, sys.stdout, indent=4)
+        print()
+    sys.exit(1 if summary['failed'] else 0)
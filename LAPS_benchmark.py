@@ -0,0 +1,343 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+# Tunable sizes of the synthetic experiment and their defaults
+DEFAULT_SIZES = {
+    'datasets': 4,          # dataset folders (the first one is a time series)
+    'devices': 1,           # DAQ devices (each with a documents folder)
+    'files': 3,             # files per dataset and documents folder
+    'file_size': 1048576,   # bytes per file (half text, half incompressible binary)
+    'rows': 100000,         # time series rows
+    'columns': 8,           # time series columns (headers)
+}
+
+
+def generate_experiment_schema(laps_schema, schema_path, json, os, datasets=4, devices=1, columns=8, **unused):
+    """
+    Write a synthetic experiment schema file, with the sections and dataset types of a LAPS schema.
+
+    Parameters:
+    laps_schema (str): The path to the LAPS schema (e.g. 'Schema/laps.schema_new5.json'); the header types are
+                       taken from 'definitions.schema.json' in the same folder if it exists.
+    schema_path (str): The path of the experiment schema file to write.
+    json (module): The JSON module to load and write JSON files.
+    os (module): The operating system module for file operations.
+    datasets (int, optional): The number of datasets. The first is a 'Time_Series', the others cycle through
+                              the other dataset types of the LAPS schema. Defaults to 4.
+    devices (int, optional): The number of DAQ devices. Defaults to 1.
+    columns (int, optional): The number of headers of the time series. Defaults to 8.
+
+    Returns:
+    dict: The experiment schema.
+    """
+    with open(laps_schema) as f:
+        sections = json.load(f)['properties']
+
+    # Header types (Time, Temperature, ...) with their first specifiers and unit
+    header_types = [{'type': 'Time', 'spec_a': 'Relative', 'spec_b': 'Differential', 'spec_c': '', 'unit': 'sec'}]
+    definitions_path = os.path.join(os.path.dirname(laps_schema), 'definitions.schema.json')
+    if os.path.exists(definitions_path):
+        with open(definitions_path) as f:
+            options = json.load(f)['definitions']['header']['oneOf']
+        header_types = []
+        for option in options:
+            properties = option['properties']
+            first = lambda key: (properties.get(key, {}).get('enum') or [''])[0]
+            header_types.append({'type': first('type') or option.get('title', ''), 'spec_a': first('spec_a'),
+                                 'spec_b': first('spec_b'), 'spec_c': '', 'unit': first('unit')})
+
+    dataset_types = sections['data']['properties']['datasets']['items']['properties']['data']['enum']
+    other_types = [item for item in dataset_types if item and item != 'Time_Series']
+
+    schema = {}
+    for key, section in sections.items():
+        value = {'name': 'Synthetic ' + key}
+        if 'documents' in section.get('properties', {}):
+            value['documents'] = []
+        schema[key] = value
+
+    # Time series first, then the other types, numbered per type
+    items = []
+    counts = {}
+    for i in range(datasets):
+        data_type = 'Time_Series' if i == 0 else other_types[(i - 1) % len(other_types)]
+        counts[data_type] = counts.get(data_type, 0) + 1
+        item = {'data': data_type, 'index': str(counts[data_type]), 'type': 'Data', 'format': 'text',
+                'description': 'Synthetic ' + data_type}
+        if data_type == 'Time_Series':
+            item['headers'] = []
+            for column in range(columns):
+                header = dict(header_types[column % len(header_types)])
+                header['spec_c'] = 'Channel ' + str(column)
+                item['headers'].append({'header': header, 'type': 'Analog Input', 'number': str(column)})
+        items.append(item)
+    schema['data'] = {'keys': {}, 'datasets': items}
+    schema['daq'] = {'name': 'Synthetic DAQ',
+                     'devices': [{'name': 'Device ' + str(i + 1), 'channels': []} for i in range(devices)]}
+
+    with open(schema_path, 'w') as f:
+        json.dump(schema, f, indent=4)
+    return schema
+
+
+def populate_experiment(schema, target_dir, os, np, files=3, file_size=1048576, rows=100000, columns=8, seed=0,
+                        **unused):
+    """
+    Fill the empty directory structure of a synthetic experiment (created by LAPS_1) with synthetic files.
+
+    Parameters:
+    schema (CompiledSchema): The compiled experiment schema.
+    target_dir (str): The directory created by LAPS_1.
+    os (module): The operating system module for file operations.
+    np (module): The NumPy module for numerical operations.
+    files (int, optional): The number of files per dataset and documents folder. Defaults to 3.
+    file_size (int, optional): The size of each file in bytes. Defaults to 1048576.
+    rows (int, optional): The number of rows of the time series. Defaults to 100000.
+    columns (int, optional): The number of columns of the time series. Defaults to 8.
+    seed (int, optional): The random seed, so the same sizes always give the same files. Defaults to 0.
+
+    Returns:
+    str: The path of the time series file.
+
+    Text files ('.txt', compressible) and binary files ('.jpg', random bytes, incompressible) alternate.
+    The time series has a short preamble followed by tab-separated rows, like the files of the Paterson apparatus.
+    """
+    rng = np.random.default_rng(seed)
+    leaves = [path for path in schema.directories if path.endswith('/documents')] + \
+             ['data/datasets/' + name for name in schema.dataset_directories]
+
+    for path in leaves:
+        folder = os.path.join(target_dir, *path.split('/'))
+        for i in range(files):
+            if i % 2 == 0:
+                line = ' '.join('{:.6f}'.format(value) for value in rng.random(8)) + '\n'
+                data = (line * (file_size // len(line) + 1)).encode('ascii')[:file_size]
+                name = 'file_{}.txt'.format(i)
+            else:
+                data = rng.integers(0, 256, file_size, dtype=np.uint8).tobytes()
+                name = 'file_{}.jpg'.format(i)
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(data)
+
+    # The time series of the first dataset
+    ts_folder = os.path.join(target_dir, 'data', 'datasets', next(iter(schema.dataset_directories)))
+    ts_path = os.path.join(ts_folder, 'timeseries.txt')
+    matrix = np.cumsum(rng.standard_normal((rows, columns)), axis=0)
+    matrix[:, 0] = np.arange(rows) * 0.001
+    with open(ts_path, 'w') as f:
+        f.write('Synthetic experiment\nSample: synthetic\n')
+        np.savetxt(f, matrix, fmt='%.6f', delimiter='\t')
+    return ts_path
+
+
+def LAPS_benchmark(work_dir, json, os, np, laps_schema='Schema/laps.schema_new5.json', repeat=1,
+                   output=None, ingest_options=None, **sizes):
+    """
+    Time the LAPS stages on a synthetic experiment: tree creation (LAPS_1), ingest (LAPS_2),
+    extraction (LAPS_3) and time series loading and plot preparation (LAPS_4).
+
+    Parameters:
+    work_dir (str): The folder in which the synthetic experiment and the stage outputs are made, in a new
+                    subfolder removed at the end (nothing else in work_dir is touched).
+    json (module): The JSON module.
+    os (module): The operating system module.
+    np (module): The NumPy module, to generate the synthetic data.
+    laps_schema (str, optional): The LAPS schema the experiment is generated from.
+                                 Defaults to 'Schema/laps.schema_new5.json'.
+    repeat (int, optional): The number of runs of each stage (all runs are recorded). Defaults to 1.
+    output (str, optional): If given, the results are written to this JSON file.
+    ingest_options (dict, optional): Options of LAPS_2_HDF5_from_directory (e.g. {'timeseries': True,
+                                     'filters': 'default'}). Defaults to None.
+    **sizes: The sizes of the experiment (see DEFAULT_SIZES): datasets, devices, files, file_size, rows, columns.
+
+    Returns:
+    dict: The results: 'commit' (git commit of the code, if known), 'machine', 'versions', 'sizes',
+          'ingest_options', 'data_bytes' and 'stages', a list of {'stage', 'run', 'seconds', 'bytes',
+          'mb_per_s', 'peak_rss_mb'} ('peak_rss_mb' is None where it cannot be measured).
+
+    Every stage run is a fresh process, so its peak RSS (resident memory) is its own and its timing
+    includes neither the data generation nor the other stages. The time of a stage does not include
+    starting its process and importing the modules.
+
+    Usage example:
+    results = LAPS_benchmark('/tmp/laps_bench', json, os, np, rows=1000000, output='bench.json')
+    From a shell: python LAPS_benchmark.py /tmp/laps_bench --rows 1000000 --output bench.json
+    """
+    import contextlib
+    import io
+    import multiprocessing
+    import platform
+    import shutil
+    import subprocess
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from LAPS_0_compile_schema import LAPS_0_compile_schema
+    from LAPS_1_empty_dir_create_update import LAPS_1_empty_dir_create_update
+
+    sizes = dict(DEFAULT_SIZES, **sizes)
+    ingest_options = dict(ingest_options or {})
+    here = os.path.dirname(os.path.abspath(__file__))
+    if not os.path.isabs(laps_schema) and not os.path.exists(laps_schema):
+        laps_schema = os.path.join(here, laps_schema)
+
+    # Generate the experiment (not timed) in a subfolder of its own, removed at the end
+    os.makedirs(work_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='laps_benchmark_', dir=work_dir)
+    try:
+        schema_path = os.path.join(work_dir, 'experiment.json')
+        generate_experiment_schema(laps_schema, schema_path, json, os, **sizes)
+        tree = os.path.join(work_dir, 'experiment')
+        with contextlib.redirect_stdout(io.StringIO()):
+            LAPS_1_empty_dir_create_update(schema_path, tree, json, os)
+        ts_path = populate_experiment(LAPS_0_compile_schema(schema_path, json, os, cache=False), tree, os, np, **sizes)
+        data_bytes = sum(os.path.getsize(os.path.join(folder, file))
+                         for folder, dirs, files in os.walk(tree) for file in files)
+        ts_bytes = os.path.getsize(ts_path)
+        empty_tree = os.path.join(work_dir, 'empty')
+        hdf5_file = os.path.join(work_dir, 'experiment.h5')
+        extracted = os.path.join(work_dir, 'extracted')
+        cache_dir = os.path.join(work_dir, 'cache')
+
+        # Function to run one stage in a fresh process
+        def run(stage, data_bytes, **arguments):
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                seconds, peak_rss = pool.submit(run_stage, stage, arguments).result()
+            return {'stage': stage, 'run': run_index, 'seconds': seconds, 'bytes': data_bytes,
+                    'mb_per_s': data_bytes / 1e6 / seconds if seconds and data_bytes else None,
+                    'peak_rss_mb': peak_rss / 1e6 if peak_rss is not None else None}
+
+        stages = []
+        for run_index in range(repeat):
+            shutil.rmtree(empty_tree, ignore_errors=True)
+            stages.append(run('LAPS_1', 0, schema_path=schema_path, target_dir=empty_tree))
+            stages.append(run('LAPS_2', data_bytes, schema_path=schema_path, data_folder=tree, hdf5_file=hdf5_file,
+                              options=ingest_options))
+            shutil.rmtree(extracted, ignore_errors=True)
+            stages.append(run('LAPS_3', data_bytes, hdf5_file=hdf5_file, output_directory=extracted,
+                              schema_file_path=extracted + '.json'))
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            for stage in ('LAPS_4_load', 'LAPS_4_load_cached', 'LAPS_4_plot_prepare'):
+                stages.append(run(stage, ts_bytes, ts_path=ts_path, n_columns=sizes['columns'], cache_dir=cache_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Describe the code and the machine, so results can be compared across commits
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import h5py
+    results = {'commit': commit,
+               'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                           'cpus': os.cpu_count()},
+               'versions': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'h5py': h5py.version.version, 'hdf5': h5py.version.hdf5_version},
+               'sizes': sizes, 'ingest_options': ingest_options, 'data_bytes': data_bytes, 'stages': stages}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+    return results
+
+
+def run_stage(stage, arguments):
+    """
+    Run one stage of LAPS_benchmark in the current (fresh) process.
+
+    Parameters:
+    stage (str): 'LAPS_1', 'LAPS_2', 'LAPS_3', 'LAPS_4_load', 'LAPS_4_load_cached' or 'LAPS_4_plot_prepare'.
+    arguments (dict): The paths and options of the stage.
+
+    Returns:
+    tuple: The wall time of the stage in seconds and the peak RSS of the process in bytes (None where it cannot be
+           measured, e.g. on Windows).
+    """
+    import contextlib
+    import io
+    import json
+    import os
+    import sys
+    import time
+    import h5py
+    import numpy as np
+    from LAPS_1_empty_dir_create_update import LAPS_1_empty_dir_create_update
+    from LAPS_2_HDF5_from_directory import LAPS_2_HDF5_from_directory
+    from LAPS_3_create_directory_from_HDF5 import LAPS_3_create_directory_from_HDF5
+    from LAPS_4_load_timeseries import LAPS_4_load_timeseries
+    from LAPS_4_decimate_timeseries import TimeseriesPyramid
+
+    a = arguments
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        if stage == 'LAPS_1':
+            LAPS_1_empty_dir_create_update(a['schema_path'], a['target_dir'], json, os)
+        elif stage == 'LAPS_2':
+            LAPS_2_HDF5_from_directory(a['schema_path'], a['data_folder'], a['hdf5_file'], json, os, np, h5py,
+                                       **a['options'])
+        elif stage == 'LAPS_3':
+            LAPS_3_create_directory_from_HDF5(a['hdf5_file'], a['output_directory'], a['schema_file_path'],
+                                              json, os, np, h5py)
+        elif stage == 'LAPS_4_load':
+            LAPS_4_load_timeseries(a['ts_path'], a['n_columns'], json, os, np, cache=False)
+        elif stage == 'LAPS_4_load_cached':
+            # The first call builds the cache, only the second one is timed
+            LAPS_4_load_timeseries(a['ts_path'], a['n_columns'], json, os, np, cache_dir=a['cache_dir'])
+            start = time.perf_counter()
+            LAPS_4_load_timeseries(a['ts_path'], a['n_columns'], json, os, np, cache_dir=a['cache_dir'])
+        elif stage == 'LAPS_4_plot_prepare':
+            # What PlotGUI does before drawing: load, build the pyramid of two columns and pick the rows to draw
+            matrix = LAPS_4_load_timeseries(a['ts_path'], a['n_columns'], json, os, np, cache_dir=a['cache_dir'])
+            rows = TimeseriesPyramid(matrix, np).select([0, 1])
+            np.asarray(matrix[rows, 0]), np.asarray(matrix[rows, 1])
+        else:
+            raise ValueError("Invalid stage: " + str(stage))
+        seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS; the resource module only exists on Unix
+    try:
+        import resource
+    except ImportError:
+        return seconds, None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return seconds, peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import os
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description="Benchmark the LAPS stages on a synthetic experiment.")
+    parser.add_argument('work_dir', help="folder for the synthetic experiment (made in a temporary subfolder)")
+    parser.add_argument('--laps-schema', default='Schema/laps.schema_new5.json', help="LAPS schema to generate from")
+    parser.add_argument('--datasets', type=int, default=DEFAULT_SIZES['datasets'])
+    parser.add_argument('--devices', type=int, default=DEFAULT_SIZES['devices'])
+    parser.add_argument('--files', type=int, default=DEFAULT_SIZES['files'], help="files per folder")
+    parser.add_argument('--file-size', type=int, default=DEFAULT_SIZES['file_size'], help="bytes per file")
+    parser.add_argument('--rows', type=int, default=DEFAULT_SIZES['rows'], help="time series rows")
+    parser.add_argument('--columns', type=int, default=DEFAULT_SIZES['columns'], help="time series columns")
+    parser.add_argument('--repeat', type=int, default=1, help="runs of each stage")
+    parser.add_argument('--output', default=None, help="write the JSON results to this file (default: stdout)")
+    parser.add_argument('--timeseries', action='store_true', help="LAPS_2: store time series as numeric datasets")
+    parser.add_argument('--block-size', type=int, default=None, help="LAPS_2: copy files block by block")
+    parser.add_argument('--workers', type=int, default=1, help="LAPS_2: reading threads")
+    parser.add_argument('--dedup', action='store_true', help="LAPS_2: store identical files once")
+    parser.add_argument('--filters', default=None, help="LAPS_2: compression policy, 'default' or JSON")
+    args = parser.parse_args()
+
+    ingest_options = {'timeseries': args.timeseries, 'block_size': args.block_size, 'workers': args.workers,
+                      'dedup': args.dedup, 'filters': args.filters}
+    results = LAPS_benchmark(args.work_dir, json, os, np, laps_schema=args.laps_schema, repeat=args.repeat,
+                             output=args.output, ingest_options=ingest_options, datasets=args.datasets,
+                             devices=args.devices, files=args.files, file_size=args.file_size, rows=args.rows,
+                             columns=args.columns)
+    for item in results['stages']:
+        print('{:<20} run {}  {:>8.3f} s  {:>9} MB/s  peak RSS {:>8} MB'.format(
+            item['stage'], item['run'], item['seconds'],
+            '{:.1f}'.format(item['mb_per_s']) if item['mb_per_s'] else '-',
+            '{:.1f}'.format(item['peak_rss_mb']) if item['peak_rss_mb'] is not None else '-'))
+    if not args.output:
+        print(json.dumps(results, indent=4))
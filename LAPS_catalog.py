@@ -0,0 +1,395 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+# Tables of the catalog. Every row of the other tables belongs to one archive (an HDF5 file or an experiment folder).
+CATALOG_TABLES = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, kind TEXT NOT NULL, mtime_ns INTEGER, size INTEGER,
+    schema_sha256 TEXT, experiment_title TEXT, experiment_project TEXT, experiment_id TEXT,
+    apparatus_name TEXT, apparatus_type TEXT, sample_name TEXT, sample_id TEXT, facility_name TEXT);
+CREATE TABLE IF NOT EXISTS datasets (
+    archive_id INTEGER NOT NULL, directory TEXT, data TEXT, data_index TEXT, type TEXT, format TEXT);
+CREATE TABLE IF NOT EXISTS headers (
+    archive_id INTEGER NOT NULL, directory TEXT, number INTEGER, label TEXT, header_type TEXT,
+    spec_a TEXT, spec_b TEXT, spec_c TEXT, unit TEXT, channel_type TEXT);
+CREATE TABLE IF NOT EXISTS devices (archive_id INTEGER NOT NULL, name TEXT);
+CREATE TABLE IF NOT EXISTS files (archive_id INTEGER NOT NULL, path TEXT, size INTEGER);
+CREATE INDEX IF NOT EXISTS datasets_archive ON datasets (archive_id);
+CREATE INDEX IF NOT EXISTS headers_archive ON headers (archive_id);
+CREATE INDEX IF NOT EXISTS devices_archive ON devices (archive_id);
+CREATE INDEX IF NOT EXISTS files_archive ON files (archive_id);
+"""
+
+# Query keywords of query_catalog -> (table, column)
+QUERY_FIELDS = {
+    'project': ('archives', 'experiment_project'),
+    'title': ('archives', 'experiment_title'),
+    'experiment_id': ('archives', 'experiment_id'),
+    'apparatus': ('archives', 'apparatus_name'),
+    'apparatus_type': ('archives', 'apparatus_type'),
+    'sample': ('archives', 'sample_name'),
+    'facility': ('archives', 'facility_name'),
+    'data_type': ('datasets', 'data'),
+    'index': ('datasets', 'data_index'),
+    'header': ('headers', 'label'),
+    'header_type': ('headers', 'header_type'),
+    'unit': ('headers', 'unit'),
+    'device': ('devices', 'name'),
+    'file': ('files', 'path'),
+}
+
+
+def LAPS_catalog(root, catalog_file, json, os, h5py, verbose=True):
+    """
+    Index the LAPS archives of a folder into an SQLite catalog, so they can be searched without opening them.
+
+    Parameters:
+    root (str): The folder to scan (subfolders included): every '.h5' / '.hdf5' file, and every experiment folder
+                '<name>' with its schema '<name>.json' next to it (as in LAPS_batch).
+    catalog_file (str): The SQLite file of the catalog. It is created if it does not exist.
+    json (module): The JSON module to parse the schemas.
+    os (module): The operating system module for file and directory operations.
+    h5py (module): The h5py module for reading HDF5 files.
+    verbose (bool, optional): If True, every archive indexed (or failing) and a summary are printed. Defaults to True.
+
+    Returns:
+    dict: The counts 'indexed', 'unchanged' (skipped), 'removed' (no longer under root) and 'failed',
+          and 'errors' (archive path -> error message).
+
+    For each archive the catalog holds the experiment project, title and id, the apparatus, sample and facility,
+    the dataset folders (data type, index, type, format), their headers (type, specs, unit), the DAQ devices,
+    and every file with its size. Archives are keyed by path: an HDF5 file whose size and modification time did not
+    change is skipped, and so is an experiment folder whose schema file, directories and files did not change
+    (the latest modification time of them all and the total size of the files are compared; adding, removing
+    or renaming a file changes the modification time of its directory, rewriting it changes its own).
+    Archives of the catalog that are under root but no longer exist are removed from it.
+
+    Usage example:
+    LAPS_catalog('archives', 'laps_catalog.sqlite', json, os, h5py)
+    query_catalog('laps_catalog.sqlite', sample='Carr*', apparatus='Paterson*', header_type='*Acoustic*')
+    From a shell: python LAPS_catalog.py index archives laps_catalog.sqlite
+    """
+    import sqlite3
+    from LAPS_batch import discover_experiments
+
+    root = os.path.abspath(root)
+    summary = {'indexed': 0, 'unchanged': 0, 'removed': 0, 'failed': 0, 'errors': {}}
+    connection = sqlite3.connect(catalog_file)
+    try:
+        connection.executescript(CATALOG_TABLES)
+        known = {path: (mtime_ns, size) for path, mtime_ns, size
+                 in connection.execute("SELECT path, mtime_ns, size FROM archives")}
+
+        # The archives under root, with the signature that tells whether they changed
+        found = []
+        for name, source, schema in discover_experiments(root, os, 'extract'):
+            stat = os.stat(source)
+            found.append((source, 'hdf5', None, stat.st_mtime_ns, stat.st_size))
+        for name, source, schema in discover_experiments(root, os, 'convert'):
+            mtime_ns = os.stat(schema).st_mtime_ns
+            size = 0
+            for folder, dirs, files in os.walk(source):
+                mtime_ns = max(mtime_ns, os.stat(folder).st_mtime_ns)
+                for file in files:
+                    file_path = os.path.join(folder, file)
+                    if os.path.isfile(file_path):
+                        stat = os.stat(file_path)
+                        mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+                        size += stat.st_size
+            found.append((source, 'folder', schema, mtime_ns, size))
+
+        for path, kind, schema_path, mtime_ns, size in found:
+            if known.get(path) == (mtime_ns, size):
+                summary['unchanged'] += 1
+                continue
+            try:
+                if kind == 'hdf5':
+                    schema, files = read_hdf5_archive(path, json, h5py)
+                else:
+                    schema, files = read_folder_archive(path, schema_path, json, os)
+            except Exception as error:  # e.g. an HDF5 file that is not a LAPS archive
+                summary['failed'] += 1
+                summary['errors'][path] = type(error).__name__ + ': ' + str(error)
+                if verbose:
+                    print('   failed   ', path, '-', summary['errors'][path])
+                continue
+            with connection:
+                remove_archive(connection, path)
+                store_archive(connection, path, kind, mtime_ns, size, schema, files)
+            summary['indexed'] += 1
+            if verbose:
+                print('   indexed  ', path)
+
+        # Forget the archives under root that are gone
+        found_paths = {item[0] for item in found}
+        with connection:
+            for path in known:
+                if path not in found_paths and (path + os.sep).startswith(root + os.sep):
+                    remove_archive(connection, path)
+                    summary['removed'] += 1
+    finally:
+        connection.close()
+
+    if verbose:
+        print("Catalog updated: {} indexed, {} unchanged, {} removed, {} failed".format(
+            summary['indexed'], summary['unchanged'], summary['removed'], summary['failed']))
+        print(catalog_file)
+    return summary
+
+
+def read_hdf5_archive(hdf5_file, json, h5py):
+    """
+    Read the schema and the file list of a LAPS HDF5 file, without reading any file data.
+
+    Parameters:
+    hdf5_file (str): The path to the HDF5 file.
+    json (module): The JSON module to parse the schema.
+    h5py (module): The h5py module for reading HDF5 files.
+
+    Returns:
+    tuple: (CompiledSchema, list of (path, size)) with '/'-separated paths relative to the directory root.
+    """
+    from LAPS_dedup import INTERNAL_GROUP
+    from LAPS_metadata import read_schema_json
+    from LAPS_0_compile_schema import compile_schema_text
+    from LAPS_3_create_directory_from_HDF5 import dataset_file_size
+
+    files = []
+
+    # Function to list the datasets of a group, following every link (deduplicated files are listed at each path)
+    def visit_group(group, group_path):
+        for name, item in group.items():
+            item_path = group_path + '/' + name if group_path else name
+            if item_path == INTERNAL_GROUP:
+                continue
+            if isinstance(item, h5py.Dataset):
+                files.append((item_path, dataset_file_size(item)))
+            elif isinstance(item, h5py.Group):
+                visit_group(item, item_path)
+
+    with h5py.File(hdf5_file, 'r') as f:
+        text = read_schema_json(f)
+        if not text:
+            raise ValueError("No LAPS schema in the HDF5 file")
+        schema = compile_schema_text(text, json)
+        visit_group(f, '')
+    return schema, files
+
+
+def read_folder_archive(data_folder, schema_path, json, os):
+    """
+    Read the schema and the file list of an experiment folder.
+
+    Parameters:
+    data_folder (str): The path to the populated directory.
+    schema_path (str): The path to its JSON schema file.
+    json (module): The JSON module to parse the schema.
+    os (module): The operating system module for file and directory operations.
+
+    Returns:
+    tuple: (CompiledSchema, list of (path, size)) with '/'-separated paths relative to data_folder.
+    """
+    from LAPS_0_compile_schema import LAPS_0_compile_schema
+
+    schema = LAPS_0_compile_schema(schema_path, json, os)
+    files = []
+    for folder, dirs, names in os.walk(data_folder):
+        dirs.sort()
+        for name in sorted(names):
+            file_path = os.path.join(folder, name)
+            if os.path.isfile(file_path):
+                files.append((os.path.relpath(file_path, data_folder).replace(os.sep, '/'),
+                              os.path.getsize(file_path)))
+    return schema, files
+
+
+def store_archive(connection, path, kind, mtime_ns, size, schema, files):
+    """
+    Insert one archive and its datasets, headers, devices and files into the catalog.
+
+    Parameters:
+    connection (sqlite3.Connection): The open catalog.
+    path (str): The absolute path of the archive.
+    kind (str): 'hdf5' or 'folder'.
+    mtime_ns (int): The modification time signature of the archive.
+    size (int): The size of the HDF5 file, or the total size of the files of a folder.
+    schema (CompiledSchema): The schema of the archive.
+    files (list): (path, size) of every file of the archive.
+
+    Returns:
+    None
+    """
+    metadata = schema.metadata if isinstance(schema.metadata, dict) else {}
+
+    # Function to read a scalar field of a schema section as text
+    def field(section, name):
+        values = metadata.get(section)
+        value = values.get(name) if isinstance(values, dict) else None
+        return None if value is None or isinstance(value, (dict, list)) else str(value)
+
+    archive_id = connection.execute(
+        "INSERT INTO archives (path, kind, mtime_ns, size, schema_sha256, experiment_title, experiment_project, "
+        "experiment_id, apparatus_name, apparatus_type, sample_name, sample_id, facility_name) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (path, kind, mtime_ns, size, schema.digest, field('experiment', 'title'), field('experiment', 'project'),
+         field('experiment', 'id'), field('apparatus', 'name'), field('apparatus', 'type'),
+         field('sample', 'name'), field('sample', 'id'), field('facility', 'name'))).lastrowid
+
+    for directory, entry in schema.dataset_directories.items():
+        connection.execute("INSERT INTO datasets VALUES (?, ?, ?, ?, ?, ?)",
+                           (archive_id, directory, entry.get('data'), entry.get('index'), entry.get('type'),
+                            entry.get('format')))
+        labels = iter(schema.header_arrays.get(directory, []))
+        number = 0
+        for item in entry.get('headers', []):
+            if 'header' not in item:
+                continue
+            header = item['header']
+            connection.execute("INSERT INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (archive_id, directory, number, next(labels, None), header.get('type'),
+                                header.get('spec_a'), header.get('spec_b'), header.get('spec_c'),
+                                header.get('unit'), item.get('type')))
+            number += 1
+    connection.executemany("INSERT INTO devices VALUES (?, ?)", [(archive_id, name) for name in schema.devices])
+    connection.executemany("INSERT INTO files VALUES (?, ?, ?)",
+                           [(archive_id, file_path, file_size) for file_path, file_size in files])
+
+
+def remove_archive(connection, path):
+    """
+    Delete one archive and all its rows from the catalog.
+
+    Parameters:
+    connection (sqlite3.Connection): The open catalog.
+    path (str): The absolute path of the archive.
+
+    Returns:
+    None
+    """
+    row = connection.execute("SELECT id FROM archives WHERE path = ?", (path,)).fetchone()
+    if row is None:
+        return
+    for table in ('datasets', 'headers', 'devices', 'files'):
+        connection.execute("DELETE FROM " + table + " WHERE archive_id = ?", row)
+    connection.execute("DELETE FROM archives WHERE id = ?", row)
+
+
+def query_catalog(catalog_file, **filters):
+    """
+    Find the archives (and their dataset folders and files) matching all the given filters.
+
+    Parameters:
+    catalog_file (str): The SQLite file written by LAPS_catalog.
+    **filters: Patterns matched case-insensitively, with '*' and '?' as wildcards (e.g. sample='Carr*'):
+               project, title, experiment_id, apparatus, apparatus_type, sample, facility (archive fields),
+               data_type, index, header, header_type, unit (dataset folder fields), device, file (file path).
+
+    Returns:
+    list: One dictionary per matching archive, sorted by path, with the keys 'path', 'kind', 'project', 'title',
+          'apparatus', 'sample', 'datasets' (the matching 'data/datasets/<folder>' paths) and 'files'
+          (the paths of the matching files: inside the matching dataset folders when dataset filters are given).
+
+    The dataset filters (data_type, index, header, header_type, unit) must all hold for the same dataset folder.
+
+    Usage example:
+    for archive in query_catalog('laps_catalog.sqlite', sample='Carr*', apparatus='Paterson*', header_type='*AE*'):
+        print(archive['path'], archive['datasets'])
+    """
+    import sqlite3
+
+    unknown = set(filters) - set(QUERY_FIELDS)
+    if unknown:
+        raise ValueError("Unknown catalog filter: " + ', '.join(sorted(unknown)))
+
+    # Function to turn a wildcard pattern into an SQL LIKE pattern
+    def like(pattern):
+        escaped = str(pattern).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return escaped.replace('*', '%').replace('?', '_')
+
+    conditions = {'archives': [], 'datasets': [], 'headers': [], 'devices': [], 'files': []}
+    values = {table: [] for table in conditions}
+    for name, pattern in filters.items():
+        if pattern is None:
+            continue
+        table, column = QUERY_FIELDS[name]
+        conditions[table].append(column + " LIKE ? ESCAPE '\\'")
+        values[table].append(like(pattern))
+
+    # Archive-level conditions, with EXISTS for the devices and the dataset folders
+    where = ['archives.' + condition for condition in conditions['archives']]
+    arguments = list(values['archives'])
+    if conditions['devices']:
+        where.append("EXISTS (SELECT 1 FROM devices WHERE devices.archive_id = archives.id AND " +
+                     " AND ".join(conditions['devices']) + ")")
+        arguments += values['devices']
+    dataset_where = ['datasets.' + condition for condition in conditions['datasets']]
+    dataset_arguments = list(values['datasets'])
+    if conditions['headers']:
+        dataset_where.append("EXISTS (SELECT 1 FROM headers WHERE headers.archive_id = datasets.archive_id "
+                             "AND headers.directory = datasets.directory AND " +
+                             " AND ".join(conditions['headers']) + ")")
+        dataset_arguments += values['headers']
+    if dataset_where:
+        where.append("EXISTS (SELECT 1 FROM datasets WHERE datasets.archive_id = archives.id AND " +
+                     " AND ".join(dataset_where) + ")")
+        arguments += dataset_arguments
+
+    results = []
+    connection = sqlite3.connect(catalog_file)
+    try:
+        rows = connection.execute(
+            "SELECT id, path, kind, experiment_project, experiment_title, apparatus_name, sample_name "
+            "FROM archives" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY path", arguments)
+        for archive_id, path, kind, project, title, apparatus, sample in rows.fetchall():
+            datasets = [row[0] for row in connection.execute(
+                "SELECT directory FROM datasets WHERE datasets.archive_id = ?" +
+                "".join(" AND " + condition for condition in dataset_where) + " ORDER BY directory",
+                [archive_id] + dataset_arguments)]
+            datasets = ['data/datasets/' + directory for directory in datasets]
+            file_where = ['files.' + condition for condition in conditions['files']]
+            file_arguments = [archive_id] + values['files']
+            if dataset_where:
+                file_where.append("(" + " OR ".join(["files.path LIKE ? ESCAPE '\\'"] * len(datasets)) + ")"
+                                  if datasets else "0")
+                file_arguments += [like(directory) + '/%' for directory in datasets]
+            files = [row[0] for row in connection.execute(
+                "SELECT path FROM files WHERE archive_id = ?" +
+                "".join(" AND " + condition for condition in file_where) + " ORDER BY path", file_arguments)]
+            if conditions['files'] and not files:
+                continue
+            results.append({'path': path, 'kind': kind, 'project': project, 'title': title,
+                            'apparatus': apparatus, 'sample': sample, 'datasets': datasets, 'files': files})
+    finally:
+        connection.close()
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import os
+    import sys
+    import h5py
+
+    parser = argparse.ArgumentParser(description="Index LAPS archives into an SQLite catalog, or search it.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    index = commands.add_parser('index', help="scan a folder of HDF5 files and experiment folders")
+    index.add_argument('root', help="the folder to scan")
+    index.add_argument('catalog', help="the SQLite catalog file")
+    index.add_argument('--quiet', action='store_true', help="only print the summary")
+    query = commands.add_parser('query', help="print the matching archives as JSON")
+    query.add_argument('catalog', help="the SQLite catalog file")
+    for name in QUERY_FIELDS:
+        query.add_argument('--' + name.replace('_', '-'), dest=name, default=None,
+                           help="pattern for " + '.'.join(QUERY_FIELDS[name]) + " ('*' and '?' wildcards)")
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        summary = LAPS_catalog(args.root, args.catalog, json, os, h5py, verbose=not args.quiet)
+        if args.quiet:
+            print(json.dumps(summary, indent=4))
+        sys.exit(1 if summary['failed'] else 0)
+    results = query_catalog(args.catalog, **{name: getattr(args, name) for name in QUERY_FIELDS})
+    json.dump(results, sys.stdout, indent=4)
+    print()
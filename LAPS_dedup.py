@@ -0,0 +1,59 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+# Root group for LAPS bookkeeping; it is not a directory of the experiment and is skipped on extraction
+INTERNAL_GROUP = '.LAPS'
+
+# Group holding one dataset per unique file content, named by its SHA-256 hex digest
+BLOB_GROUP = INTERNAL_GROUP + '/blobs'
+
+
+def find_blob(f, digest):
+    """
+    Return the blob dataset stored for a content hash.
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+    digest (str): The SHA-256 hex digest of the file content.
+
+    Returns:
+    h5py.Dataset or None: The blob dataset, or None if this content is not stored yet.
+    """
+    name = BLOB_GROUP + '/' + digest
+    return f[name] if name in f else None
+
+
+def blob_group(f):
+    """
+    Return the blob group of the HDF5 file, creating it if needed.
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+
+    Returns:
+    h5py.Group: The blob group.
+    """
+    return f.require_group(BLOB_GROUP)
+
+
+def remove_unreferenced_blobs(f, h5py):
+    """
+    Delete the blobs that are no longer linked from any file path.
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+    h5py (module): The h5py module for working with HDF5 files.
+
+    Returns:
+    int: The number of blobs removed.
+
+    A blob is unreferenced when its hard link count is 1 (the link in the blob group itself).
+    """
+    if BLOB_GROUP not in f:
+        return 0
+    blobs = f[BLOB_GROUP]
+    unreferenced = [name for name in blobs if h5py.h5o.get_info(blobs[name].id).rc <= 1]
+    for name in unreferenced:
+        del blobs[name]
+    return len(unreferenced)
@@ -0,0 +1,124 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+# Default filter policy: key -> filter spec. Keys are 'numeric' (time series stored as numeric matrices),
+# a file extension ('.txt') or a dataset type of the schema ('Time_Series'), and '*' for all other files.
+# Specs are 'none', 'lzf', 'gzip' (level 4) or 'gzip:<level>', optionally prefixed with 'shuffle+'.
+DEFAULT_POLICY = {
+    'numeric': 'shuffle+gzip:4',
+    # Text and uncompressed office formats compress well
+    '.txt': 'gzip:6', '.csv': 'gzip:6', '.tsv': 'gzip:6', '.dat': 'gzip:6', '.log': 'gzip:6',
+    '.json': 'gzip:6', '.xml': 'gzip:6', '.xls': 'gzip:6', '.doc': 'gzip:6',
+    # Already compressed media and containers gain nothing
+    '.jpg': 'none', '.jpeg': 'none', '.png': 'none', '.gif': 'none', '.mp4': 'none', '.avi': 'none',
+    '.xlsx': 'none', '.docx': 'none', '.pptx': 'none', '.pdf': 'none', '.zip': 'none', '.gz': 'none',
+    # Raw images and anything else: a fast filter
+    '.tif': 'lzf', '.tiff': 'lzf', '.bmp': 'lzf',
+    '*': 'lzf',
+}
+
+# Smallest and largest automatic chunk sizes (bytes) of files stored as 1-D uint8 datasets
+MIN_CHUNK_SIZE = 65536
+MAX_CHUNK_SIZE = 1048576
+
+
+def load_policy(filters):
+    """
+    Return the filter policy dictionary for the 'filters' option of LAPS_2_HDF5_from_directory.
+
+    Parameters:
+    filters (str or dict): 'default' for DEFAULT_POLICY, a policy dictionary, or its JSON text.
+
+    Returns:
+    dict: The policy (key -> filter spec), with every spec checked.
+    """
+    import json
+
+    if isinstance(filters, str):
+        filters = DEFAULT_POLICY if filters == 'default' else json.loads(filters)
+    for spec in filters.values():
+        filter_options(spec)  # raise ValueError early for an invalid spec
+    return dict(filters)
+
+
+def policy_spec(policy, extension, dataset_type=None, numeric=False):
+    """
+    Return the filter spec of a file.
+
+    Parameters:
+    policy (dict): The filter policy.
+    extension (str): The file extension, including the dot.
+    dataset_type (str, optional): The dataset type of the schema entry owning the file (e.g. 'Imaging').
+    numeric (bool, optional): True for a time series stored as a numeric matrix.
+
+    Returns:
+    str: The first spec found for 'numeric' (numeric matrices only), the extension, the dataset type and '*',
+         or 'none'.
+    """
+    keys = (['numeric'] if numeric else []) + [extension.lower(), dataset_type, '*']
+    for key in keys:
+        if key is not None and key in policy:
+            return policy[key]
+    return 'none'
+
+
+def filter_options(spec):
+    """
+    Convert a filter spec into the filter arguments of h5py's create_dataset.
+
+    Parameters:
+    spec (str): 'none', 'lzf', 'gzip', 'gzip:<level>' (0-9), optionally prefixed with 'shuffle+'.
+
+    Returns:
+    dict or None: The keys 'compression', 'compression_opts' and 'shuffle', or None for 'none'.
+    """
+    text = spec.strip().lower()
+    shuffle = text.startswith('shuffle+')
+    if shuffle:
+        text = text[len('shuffle+'):]
+    name, _, level = text.partition(':')
+    if name == 'none' and not shuffle and not level:
+        return None
+    if name == 'lzf' and not level:
+        return {'compression': 'lzf', 'compression_opts': None, 'shuffle': shuffle}
+    if name == 'gzip' and (not level or (level.isdigit() and int(level) <= 9)):
+        return {'compression': 'gzip', 'compression_opts': int(level) if level else 4, 'shuffle': shuffle}
+    raise ValueError("Invalid filter spec: " + str(spec))
+
+
+def auto_chunk_size(size):
+    """
+    Return the chunk size (bytes) of a file of the given size stored as a compressed 1-D uint8 dataset.
+
+    Parameters:
+    size (int): The file size in bytes.
+
+    Returns:
+    int: About a sixteenth of the file, between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE (the whole file if smaller).
+
+    Small chunks compress less well; chunks above 1 MiB no longer fit in h5py's default chunk cache
+    and make range reads (LAPS_3_archive_reader) decompress more than they need.
+    """
+    chunk = min(max(size // 16, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+    return int(max(min(chunk, size), 1))
+
+
+def print_filter_report(stats):
+    """
+    Print the compression ratio and write time of each filter spec.
+
+    Parameters:
+    stats (dict): Filter spec -> {'files', 'bytes', 'stored_bytes', 'seconds'}, as returned by
+                  LAPS_2_HDF5_from_directory.
+
+    Returns:
+    None
+    """
+    print('{:<18} {:>7} {:>11} {:>11} {:>7} {:>9} {:>9}'.format(
+        'Filter', 'Files', 'Input MB', 'Stored MB', 'Ratio', 'Seconds', 'MB/s'))
+    for spec, item in sorted(stats.items()):
+        ratio = item['bytes'] / item['stored_bytes'] if item['stored_bytes'] else float('inf')
+        speed = item['bytes'] / 1e6 / item['seconds'] if item['seconds'] else float('inf')
+        print('{:<18} {:>7} {:>11.2f} {:>11.2f} {:>7.2f} {:>9.3f} {:>9.1f}'.format(
+            spec, item['files'], item['bytes'] / 1e6, item['stored_bytes'] / 1e6, ratio, item['seconds'], speed))
@@ -0,0 +1,200 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+# Time categories: where the time of a stage goes
+FS_READ = 'fs_read'               # reading source files
+FS_WRITE = 'fs_write'             # writing extracted files
+FS_METADATA = 'fs_metadata'       # listing, stat, mkdir, rmdir
+HDF5_READ = 'hdf5_read'           # reading dataset data (including decompression)
+HDF5_WRITE = 'hdf5_write'         # writing dataset data (including compression)
+HDF5_METADATA = 'hdf5_metadata'   # groups, links, attributes, deletions
+CPU = 'cpu'                       # parsing, formatting and hashing
+CATEGORIES = (FS_READ, FS_WRITE, FS_METADATA, HDF5_READ, HDF5_WRITE, HDF5_METADATA, CPU)
+
+
+class LAPSTrace:
+    """
+    Class collecting the timing and counters of one LAPS stage, and reporting them as events.
+
+    Attributes:
+    stage (str): The stage name (e.g. 'LAPS_2_HDF5_from_directory').
+    files (int): The number of files processed so far.
+    files_total (int or None): The number of files to process, if known.
+    bytes_read (int): The bytes read so far (source files, or dataset storage when extracting).
+    bytes_written (int): The bytes written so far (dataset storage, or extracted files).
+    timers (dict): Seconds spent per time category (see CATEGORIES).
+
+    Methods:
+    with LAPSTrace(...) as trace: End the stage when the block is left, also on an error (see __exit__).
+    timer(category): Context manager adding the time of its block to a category.
+    file_done(path, seconds, bytes_read, bytes_written): Count a processed file.
+    step(bytes_read, bytes_written, **info): Count the bytes of a long-running file as it is processed.
+    finish(**info): End the stage and return the summary.
+    summary(): Return the counters and timers as a dictionary.
+    report(): Return a one-line summary of the stage.
+
+    Every event is a dictionary with the keys 'event' ('start', 'file', 'step' or 'end'), 'stage', 'time' (Unix time),
+    'elapsed' (seconds since the start), 'files', 'files_total', 'bytes_read' and 'bytes_written';
+    'file' events add 'path', 'seconds', 'file_bytes_read' and 'file_bytes_written', and the 'end' event adds
+    'timers', 'report' (see report()) and 'error' if the stage failed. Events are passed to the progress callback
+    and written as JSON lines to the trace file.
+    Time spent in worker threads is added up, so the timers can exceed the elapsed time.
+    """
+
+    def __init__(self, stage, progress=None, trace_file=None, files_total=None, **info):
+        self.stage = stage
+        self.files = 0
+        self.files_total = files_total
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.timers = dict.fromkeys(CATEGORIES, 0.0)
+        self._progress = progress
+        # Each event is appended with one write, so the lines of processes tracing to the same file do not mix
+        self._trace = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0),
+                              0o666) if trace_file else None
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._end = None
+        self._emit('start', **info)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        End the stage if finish was not called, so a failed run is not taken for a running one: the 'end' event
+        then holds the error (e.g. 'error': 'OSError: [Errno 28] No space left on device').
+        """
+        if self._end is None:
+            if exc_type is None:
+                self.finish()
+            else:
+                self.finish(error='{}: {}'.format(exc_type.__name__, exc_value))
+        return False
+
+    def _emit(self, event, **info):
+        """
+        Send an event to the progress callback and the trace file.
+        """
+        if self._progress is None and self._trace is None:
+            return
+        record = {'event': event, 'stage': self.stage, 'time': time.time(),
+                  'elapsed': self.elapsed(), 'files': self.files,
+                  'files_total': self.files_total, 'bytes_read': self.bytes_read,
+                  'bytes_written': self.bytes_written}
+        record.update(info)
+        if self._trace is not None:
+            import json
+            os.write(self._trace, (json.dumps(record) + '\n').encode('utf-8'))
+        if self._progress is not None:
+            self._progress(record)
+
+    @contextmanager
+    def timer(self, category):
+        """
+        Add the time spent in the with-block to a time category.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(category, time.perf_counter() - start)
+
+    def add_time(self, category, seconds):
+        with self._lock:
+            self.timers[category] += seconds
+
+    def file_done(self, path, seconds, bytes_read=0, bytes_written=0):
+        """
+        Count a processed file and report it.
+
+        Parameters:
+        path (str): The path of the file (relative to the directory root).
+        seconds (float): The time spent on the file.
+        bytes_read (int, optional): The bytes read for the file.
+        bytes_written (int, optional): The bytes written for the file.
+        """
+        with self._lock:
+            self.files += 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+        self._emit('file', path=path, seconds=seconds, file_bytes_read=bytes_read, file_bytes_written=bytes_written)
+
+    def step(self, bytes_read=0, bytes_written=0, **info):
+        """
+        Count the bytes of a file still being processed (e.g. a followed time series) and report them.
+
+        Parameters:
+        bytes_read (int, optional): The bytes read since the last step.
+        bytes_written (int, optional): The bytes written since the last step.
+        **info: Added to the 'step' event (e.g. rows=1000).
+        """
+        with self._lock:
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+        self._emit('step', **info)
+
+    def elapsed(self):
+        """
+        Return the seconds since the start of the stage (until its end, once finished).
+        """
+        return (self._end if self._end is not None else time.perf_counter()) - self._start
+
+    def summary(self):
+        """
+        Return the counters and timers of the stage as a dictionary.
+        """
+        return {'stage': self.stage, 'elapsed': self.elapsed(), 'files': self.files,
+                'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written, 'timers': dict(self.timers)}
+
+    def finish(self, **info):
+        """
+        End the stage: send the 'end' event, close the trace file and return the summary.
+        """
+        self._end = time.perf_counter()
+        summary = self.summary()
+        self._emit('end', timers=summary['timers'], report=self.report(), **info)
+        if self._trace is not None:
+            os.close(self._trace)
+            self._trace = None
+        return summary
+
+    def report(self):
+        """
+        Return a one-line summary of the stage: files, bytes, elapsed time and the main time categories.
+        """
+        timers = ', '.join('{} {:.2f} s'.format(category, seconds)
+                           for category, seconds in sorted(self.timers.items(), key=lambda item: -item[1])
+                           if seconds >= 0.005)
+        return '{} files, {:.1f} MB read, {:.1f} MB written in {:.2f} s ({})'.format(
+            self.files, self.bytes_read / 1e6, self.bytes_written / 1e6, self.elapsed(), timers or 'no timed work')
+
+
+def print_progress(event):
+    """
+    Progress callback printing one updating line per stage, and its report at the end (e.g. progress=print_progress).
+
+    Parameters:
+    event (dict): An event of LAPSTrace.
+
+    Returns:
+    None
+    """
+    import sys
+
+    if event['event'] == 'start':
+        return
+    total = '/' + str(event['files_total']) if event['files_total'] is not None else ''
+    speed = event['bytes_read'] / 1e6 / event['elapsed'] if event['elapsed'] > 0 else 0.0
+    line = '{}: {}{} files, {:.1f} MB read, {:.1f} MB written, {:.1f} s, {:.1f} MB/s'.format(
+        event['stage'], event['files'], total, event['bytes_read'] / 1e6, event['bytes_written'] / 1e6,
+        event['elapsed'], speed)
+    end = '\n' + event['stage'] + ': ' + event['report'] + '\n' if event['event'] == 'end' else ''
+    sys.stdout.write('\r' + line + end)
+    sys.stdout.flush()
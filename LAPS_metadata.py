@@ -0,0 +1,171 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+from LAPS_dedup import INTERNAL_GROUP
+
+# Dataset holding the full schema JSON (UTF-8, gzip-compressed 1-D uint8, read like any stored file)
+METADATA_DATASET = INTERNAL_GROUP + '/schema_json'
+
+# Root attribute holding the schema JSON in files written before METADATA_DATASET existed. It is still written
+# for older readers while the schema fits in an HDF5 attribute (64 KB in the default file format).
+LEGACY_ATTRIBUTE = 'Schema_json'
+LEGACY_ATTRIBUTE_LIMIT = 60000
+
+# Schema sections whose scalar fields are copied to the attributes of the matching root group
+# (e.g. experiment.project -> f['experiment'].attrs['project']) and of the root as '<section>_<field>'
+SECTION_FIELDS = {
+    'facility': ('name', 'id', 'institute'),
+    'apparatus': ('name', 'type', 'id'),
+    'daq': ('name', 'type'),
+    'sample': ('name', 'id', 'igsn'),
+    'experiment': ('title', 'project', 'id', 'start_date', 'end_date'),
+}
+
+# Fields of data.datasets[] copied to the attributes of their 'data/datasets/<directory>' group
+DATASET_FIELDS = ('data', 'index', 'type', 'format', 'description')
+
+
+def write_metadata(f, schema, np, h5py):
+    """
+    Store the schema in an HDF5 file: the full JSON as a compressed dataset, and its key fields as attributes.
+
+    Parameters:
+    f (h5py.File): The HDF5 file open for writing.
+    schema (CompiledSchema): The schema compiled by LAPS_0_compile_schema.
+    np (module): The NumPy module for numerical operations.
+    h5py (module): The h5py module for working with HDF5 files.
+
+    Returns:
+    None
+
+    Attributes written (only for the fields present in the schema, and only on groups that exist):
+    root: '<section>_<field>' for SECTION_FIELDS (e.g. 'experiment_project', 'apparatus_name', 'sample_name'),
+          'device_names' and 'dataset_directories';
+    '<section>' groups: '<field>' for SECTION_FIELDS;
+    'data/datasets/<directory>' groups: DATASET_FIELDS, 'headers' (the header labels) and 'units';
+    'daq/devices/<name>' groups: 'name'.
+    Call it after the directory groups are created, so their attributes can be set.
+    """
+    from LAPS_stream_copy import write_bytes_to_dataset
+    from LAPS_filter_policy import auto_chunk_size
+
+    string_dtype = h5py.string_dtype()
+    metadata = schema.metadata if isinstance(schema.metadata, dict) else {}
+
+    # Function to set (or clear) one attribute, leaving it alone if unchanged: HDF5 does not reuse
+    # the space of a rewritten attribute, so update runs would otherwise grow the file
+    def set_attribute(attrs, name, value):
+        if isinstance(value, list):
+            if name in attrs and [str(item) for item in attrs[name]] == value:
+                return
+            attrs[name] = np.array(value, dtype=string_dtype)
+        elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+            if name not in attrs or attrs[name] != value:
+                attrs[name] = value
+        elif name in attrs:
+            del attrs[name]
+
+    # Full JSON: compressed dataset, plus the legacy attribute while it fits
+    text = schema.schema_json.encode('utf-8')
+    group = f.require_group(INTERNAL_GROUP)
+    name = METADATA_DATASET.split('/', 1)[1]
+    if name in group and group[name].attrs.get('source_sha256') != schema.digest:
+        del group[name]
+    if name not in group:
+        dataset = write_bytes_to_dataset(group, name, text, np, auto_chunk_size(len(text)),
+                                         {'compression': 'gzip', 'compression_opts': 9, 'shuffle': False})
+        dataset.attrs['source_sha256'] = schema.digest
+    set_attribute(f.attrs, LEGACY_ATTRIBUTE, schema.schema_json if len(text) <= LEGACY_ATTRIBUTE_LIMIT else None)
+
+    # Sections: experiment, apparatus, sample, ...
+    for section, fields in SECTION_FIELDS.items():
+        values = metadata.get(section)
+        values = values if isinstance(values, dict) else {}
+        for field in fields:
+            set_attribute(f.attrs, section + '_' + field, values.get(field))
+            if section in f and isinstance(f[section], h5py.Group):
+                set_attribute(f[section].attrs, field, values.get(field))
+
+    # Datasets: the fields, headers and units of each dataset folder
+    for directory, entry in schema.dataset_directories.items():
+        path = 'data/datasets/' + directory
+        if path not in f or not isinstance(f[path], h5py.Group):
+            continue
+        attrs = f[path].attrs
+        for field in DATASET_FIELDS:
+            set_attribute(attrs, field, entry.get(field))
+        units = [item['header'].get('unit', '') for item in entry.get('headers', []) if 'header' in item]
+        set_attribute(attrs, 'headers', schema.header_arrays.get(directory, []))
+        set_attribute(attrs, 'units', units)
+
+    # Devices
+    for device in schema.devices:
+        path = 'daq/devices/' + device
+        if path in f and isinstance(f[path], h5py.Group):
+            set_attribute(f[path].attrs, 'name', device)
+
+    set_attribute(f.attrs, 'device_names', list(schema.devices))
+    set_attribute(f.attrs, 'dataset_directories', list(schema.dataset_directories))
+
+
+def read_schema_json(f):
+    """
+    Return the schema JSON stored in an HDF5 file, from METADATA_DATASET or, in older files, the root attribute.
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+
+    Returns:
+    str: The schema JSON text ('' if the file holds no schema).
+    """
+    if METADATA_DATASET in f:
+        return f[METADATA_DATASET][()].tobytes().decode('utf-8')
+    text = f.attrs.get(LEGACY_ATTRIBUTE, '')
+    return text.decode('utf-8') if isinstance(text, bytes) else text
+
+
+def read_metadata(f):
+    """
+    Return the key schema fields of an HDF5 file from its attributes, without reading the schema JSON.
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+
+    Returns:
+    dict: The root attributes written by write_metadata ('experiment_project', 'apparatus_name', 'sample_name',
+          'device_names', 'dataset_directories', ...), with lists for the array attributes.
+          Empty for files written before write_metadata existed.
+    """
+    fields = {}
+    for name, value in f.attrs.items():
+        if name == LEGACY_ATTRIBUTE:
+            continue
+        if hasattr(value, 'tolist'):
+            value = value.tolist()
+        if isinstance(value, list):
+            value = [item.decode('utf-8') if isinstance(item, bytes) else item for item in value]
+        elif isinstance(value, bytes):
+            value = value.decode('utf-8')
+        fields[name] = value
+    return fields
+
+
+def headers_for_path(f, relative_path):
+    """
+    Return the header labels of the dataset folder a stored file is in, from the attributes of the folder group.
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+    relative_path (str): The '/'-separated path of the file (e.g. 'data/datasets/Time_Series_1/test_1/file.txt').
+
+    Returns:
+    list or None: The header labels, or None if the folder has no 'headers' attribute (e.g. an older file).
+    """
+    parts = relative_path.strip('/').split('/')
+    if len(parts) < 4 or parts[0] != 'data' or parts[1] != 'datasets':
+        return None
+    path = '/'.join(parts[:3])
+    if path not in f or 'headers' not in f[path].attrs:
+        return None
+    return [label.decode('utf-8') if isinstance(label, bytes) else str(label) for label in f[path].attrs['headers']]
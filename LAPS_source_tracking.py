@@ -0,0 +1,105 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+import hashlib
+
+# Dataset attributes describing the source file a dataset was created from
+SIZE_ATTR = 'source_size'
+MTIME_ATTR = 'source_mtime_ns'
+HASH_ATTR = 'source_sha256'
+
+# Attribute of a time series stored as a numeric matrix: the hash of its values (see update_matrix_hash),
+# so the stored data can be checked without formatting the file back to text
+DATA_HASH_ATTR = 'data_sha256'
+
+
+def new_hasher():
+    """
+    Return a new hash object of the kind used for the HASH_ATTR attribute.
+    """
+    return hashlib.sha256()
+
+
+def file_sha256(file_path, block_size=1048576):
+    """
+    Compute the SHA-256 hex digest of a file, reading it block by block.
+
+    Parameters:
+    file_path (str): The path of the file.
+    block_size (int, optional): The number of bytes read at a time. Defaults to 1048576.
+
+    Returns:
+    str: The hex digest.
+    """
+    hasher = new_hasher()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def update_matrix_hash(hasher, rows, np):
+    """
+    Add rows of a time series matrix to a hash, as little-endian float64 values row by row.
+
+    Parameters:
+    hasher (hashlib object): The hash object (see new_hasher).
+    rows (numpy.array): A 2-D block of consecutive rows.
+    np (module): The NumPy module for numerical operations.
+
+    Returns:
+    None
+
+    Hashing the blocks of a matrix in order gives the same digest as hashing the whole matrix at once.
+    """
+    hasher.update(np.ascontiguousarray(rows, dtype='<f8'))
+
+
+def record_source(dataset, stat, digest, data_digest=None):
+    """
+    Store the size, modification time and content hash of the source file as attributes of its dataset.
+
+    Parameters:
+    dataset (h5py.Dataset): The dataset created from the file.
+    stat (os.stat_result): The stat of the source file taken before it was read.
+    digest (str): The SHA-256 hex digest of the file content.
+    data_digest (str, optional): For a time series stored as a numeric matrix, the SHA-256 hex digest of its values
+                                 (see update_matrix_hash). Defaults to None.
+
+    Returns:
+    None
+    """
+    dataset.attrs[SIZE_ATTR] = stat.st_size
+    dataset.attrs[MTIME_ATTR] = stat.st_mtime_ns
+    dataset.attrs[HASH_ATTR] = digest
+    if data_digest is not None:
+        dataset.attrs[DATA_HASH_ATTR] = data_digest
+
+
+def source_unchanged(dataset, stat, file_path, block_size=1048576):
+    """
+    Check whether a dataset is still up to date with its source file.
+
+    Parameters:
+    dataset (h5py.Dataset): The dataset created from the file in a previous run.
+    stat (os.stat_result): The current stat of the source file.
+    file_path (str): The path of the source file.
+    block_size (int, optional): The number of bytes read at a time when hashing. Defaults to 1048576.
+
+    Returns:
+    bool: True if the dataset does not need to be rewritten.
+
+    Size and modification time are compared first. The file is only hashed when the size matches
+    but the modification time does not (e.g. a file that was copied or touched); if the content is the same
+    the stored modification time is refreshed.
+    """
+    attrs = dataset.attrs
+    if HASH_ATTR not in attrs or int(attrs.get(SIZE_ATTR, -1)) != stat.st_size:
+        return False
+    if int(attrs.get(MTIME_ATTR, -1)) == stat.st_mtime_ns:
+        return True
+    if file_sha256(file_path, block_size) != attrs[HASH_ATTR]:
+        return False
+    attrs[MTIME_ATTR] = stat.st_mtime_ns
+    return True
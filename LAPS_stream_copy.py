@@ -0,0 +1,220 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+import time
+
+# Value of the 'LAPS_layout' attribute marking a file stored as a 1-D uint8 dataset
+# (contiguous if uncompressed, chunked if compressed)
+BYTES_LAYOUT = 'bytes'
+
+# HDF5 file drivers that keep the file as one ordinary file on disk, so dataset offsets are file offsets
+RAW_DRIVERS = ('sec2', 'stdio')
+
+# Default block size (bytes) for streamed reads and writes
+DEFAULT_BLOCK_SIZE = 1048576
+
+
+def write_file_to_dataset(group, name, file_path, block_size, os, np, hasher=None, filters=None, chunk_size=None,
+                          trace=None):
+    """
+    Copy a file into a 1-D uint8 dataset, one block at a time.
+
+    Parameters:
+    group (h5py.Group): The group the dataset is created in.
+    name (str): The dataset name (the original file name).
+    file_path (str): The path of the file to copy.
+    block_size (int): The number of bytes read and written at a time (also the chunk size if compressed).
+    os (module): The operating system module for file operations.
+    np (module): The NumPy module for numerical operations.
+    hasher (hashlib object, optional): If given, it is updated with every block copied.
+    filters (dict, optional): The compression arguments of create_dataset (see LAPS_filter_policy.filter_options).
+    chunk_size (int, optional): The chunk size in bytes of a compressed dataset. Defaults to block_size.
+    trace (LAPSTrace, optional): If given, the time spent reading the file, writing the dataset and hashing
+                                 is added to its timers.
+
+    Returns:
+    h5py.Dataset: The created dataset.
+
+    Only one block buffer is allocated, so the peak memory does not depend on the file size.
+    The buffer holds a whole number of chunks, so every chunk is compressed once, when it is complete.
+    Without filters the dataset is contiguous, so it can be extracted by byte offset (see copy_raw_bytes).
+    """
+    size = os.path.getsize(file_path)
+    chunk_size = int(min(chunk_size or block_size, max(size, 1)))
+    chunks = (chunk_size,) if size and filters else None
+    dataset = group.create_dataset(name, shape=(size,), dtype=np.uint8, chunks=chunks,
+                                   **(filters if size and filters else {}))
+    dataset.attrs['LAPS_layout'] = BYTES_LAYOUT
+
+    buffer = np.empty(int(min(max(block_size // chunk_size, 1) * chunk_size, max(size, 1))), dtype=np.uint8)
+    offset = 0
+    times = [0.0, 0.0, 0.0]  # reading, writing, hashing
+    with open(file_path, "rb") as file:
+        while offset < size:
+            start = time.perf_counter()
+            n = file.readinto(memoryview(buffer))
+            if not n:
+                break
+            times[0] += time.perf_counter() - start
+            start = time.perf_counter()
+            dataset[offset:offset + n] = buffer[:n]
+            times[1] += time.perf_counter() - start
+            if hasher is not None:
+                start = time.perf_counter()
+                hasher.update(memoryview(buffer)[:n])
+                times[2] += time.perf_counter() - start
+            offset += n
+    if trace is not None:
+        from LAPS_instrumentation import FS_READ, HDF5_WRITE, CPU
+        trace.add_time(FS_READ, times[0])
+        trace.add_time(HDF5_WRITE, times[1])
+        trace.add_time(CPU, times[2])
+    if offset != size:
+        raise IOError("File changed while copying: " + file_path)
+    return dataset
+
+
+def write_bytes_to_dataset(group, name, binary_data, np, chunk_size=None, filters=None):
+    """
+    Store a file already read into memory as a 1-D uint8 dataset.
+
+    Parameters:
+    group (h5py.Group): The group the dataset is created in.
+    name (str): The dataset name (the original file name).
+    binary_data (bytes): The file content.
+    np (module): The NumPy module for numerical operations.
+    chunk_size (int, optional): The chunk size in bytes. Defaults to None (a contiguous dataset, without filters).
+    filters (dict, optional): The compression arguments of create_dataset (see LAPS_filter_policy.filter_options).
+
+    Returns:
+    h5py.Dataset: The created dataset, read back like the datasets of write_file_to_dataset.
+    """
+    data = np.frombuffer(binary_data, dtype=np.uint8)
+    if not len(data) or chunk_size is None:
+        dataset = group.create_dataset(name, data=data, dtype=np.uint8)
+    else:
+        dataset = group.create_dataset(name, data=data, chunks=(int(min(chunk_size, len(data))),),
+                                       **(filters or {}))
+    dataset.attrs['LAPS_layout'] = BYTES_LAYOUT
+    return dataset
+
+
+def write_dataset_to_file(dataset, file, block_size, np, trace=None):
+    """
+    Copy a 1-D uint8 dataset to a binary file object, one block at a time.
+
+    Parameters:
+    dataset (h5py.Dataset): A dataset created by write_file_to_dataset.
+    file (file object): A binary file object to write to.
+    block_size (int): The number of bytes read and written at a time.
+    np (module): The NumPy module for numerical operations.
+    trace (LAPSTrace, optional): If given, the time spent reading the dataset and writing the file
+                                 is added to its timers.
+
+    Returns:
+    None
+    """
+    size = dataset.shape[0]
+    buffer = np.empty(int(min(block_size, max(size, 1))), dtype=np.uint8)
+    times = [0.0, 0.0]  # reading, writing
+    for start in range(0, size, len(buffer)):
+        n = min(len(buffer), size - start)
+        begin = time.perf_counter()
+        dataset.read_direct(buffer, np.s_[start:start + n], np.s_[0:n])
+        middle = time.perf_counter()
+        file.write(memoryview(buffer)[:n])
+        times[0] += middle - begin
+        times[1] += time.perf_counter() - middle
+    if trace is not None:
+        from LAPS_instrumentation import HDF5_READ, FS_WRITE
+        trace.add_time(HDF5_READ, times[0])
+        trace.add_time(FS_WRITE, times[1])
+
+
+def raw_byte_range(dataset):
+    """
+    Return where the bytes of a stored file are in the HDF5 file, if they are stored there as they are.
+
+    Parameters:
+    dataset (h5py.Dataset): A dataset holding a file: a 1-D uint8 dataset (BYTES_LAYOUT),
+                            or one binary scalar (the layout of older LAPS versions).
+
+    Returns:
+    tuple or None: (offset, size) in bytes from the start of the HDF5 file, or None if the dataset is chunked,
+                   compressed, external, empty or in a file that is not one ordinary file on disk.
+    """
+    if dataset.chunks is not None or dataset.external or dataset.file.driver not in RAW_DRIVERS:
+        return None
+    if dataset.attrs.get('LAPS_layout') == BYTES_LAYOUT:
+        if dataset.ndim != 1 or dataset.dtype.itemsize != 1:
+            return None
+        size = dataset.shape[0]
+    elif dataset.shape == () and dataset.dtype.kind in 'SV':
+        size = dataset.dtype.itemsize
+    else:
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.id.get_storage_size() != size:
+        return None
+    return offset, size
+
+
+def copy_raw_bytes(source_path, offset, size, file, os, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Copy a byte range of a file to the end of an open binary file without reading it into Python.
+
+    Parameters:
+    source_path (str): The path of the file to copy from (the HDF5 file).
+    offset (int): The offset of the first byte to copy.
+    size (int): The number of bytes to copy.
+    file (file object): The binary file object to write to (written through its file descriptor).
+    os (module): The operating system module for file operations.
+    block_size (int, optional): The number of bytes written at a time by the mmap fallback. Defaults to 1 MiB.
+
+    Returns:
+    str: The method used: 'copy_file_range', 'sendfile' or 'mmap'.
+
+    os.copy_file_range copies inside the kernel (and shares the blocks on file systems with reflinks),
+    os.sendfile also copies inside the kernel; where neither is available (or the file systems refuse them)
+    the range is memory-mapped and written in slices, which still avoids copies into Python objects.
+    """
+    import mmap
+
+    file.flush()
+    target = file.fileno()
+    source = os.open(source_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    done = 0
+    try:
+        for method in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, method):
+                continue
+            try:
+                while done < size:
+                    count = min(size - done, 1 << 30)
+                    if method == 'copy_file_range':
+                        n = os.copy_file_range(source, target, count, offset + done)
+                    else:
+                        n = os.sendfile(target, source, offset + done, count)
+                    if not n:
+                        raise EOFError("Unexpected end of file: " + source_path)
+                    done += n
+                return method
+            except OSError:
+                continue  # not supported here: go on with the next method from where it stopped
+
+        # Memory-map the range (the map must start at a multiple of the allocation granularity)
+        start = (offset + done) // mmap.ALLOCATIONGRANULARITY * mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(source, offset + size - start, access=mmap.ACCESS_READ, offset=start) as view:
+            data = memoryview(view)
+            try:
+                position = offset + done - start
+                while done < size:
+                    n = os.write(target, data[position:position + min(block_size, size - done)])
+                    position += n
+                    done += n
+            finally:
+                data.release()
+        return 'mmap'
+    finally:
+        os.close(source)
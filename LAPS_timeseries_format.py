@@ -0,0 +1,231 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+# Value of the 'LAPS_layout' attribute marking a time series stored as a numeric matrix
+TIMESERIES_LAYOUT = 'timeseries'
+
+
+def header_labels(dataset_entry):
+    """
+    Build the column labels of a dataset entry of the JSON schema.
+
+    Parameters:
+    dataset_entry (dict): One item of data['data']['datasets'].
+
+    Returns:
+    list: Labels in the form 'type spec_a spec_b spec_c, unit', one per header.
+    """
+    labels = []
+    for item in dataset_entry.get('headers', []):
+        if 'header' in item:
+            header = item['header']
+            labels.append(header['type'] + ' ' + header['spec_a'] + ' ' + header['spec_b'] +
+                          ' ' + header['spec_c'] + ', ' + header['unit'])
+    return labels
+
+
+def dataset_directory_name(dataset_entry):
+    """
+    Return the directory name LAPS_1 creates for a dataset entry of the JSON schema.
+
+    Parameters:
+    dataset_entry (dict): One item of data['data']['datasets'].
+
+    Returns:
+    str: The directory name (e.g. 'Time_Series_1'), or '' if the entry has no 'data' field.
+    """
+    data_value = dataset_entry.get('data', '')
+    dataset_id = dataset_entry.get('index', '')
+    if not data_value:
+        return ''
+    if dataset_id:
+        return data_value.replace(" ", "_") + "_" + dataset_id
+    return data_value
+
+
+def parse_timeseries_text(raw_bytes, n_columns, np):
+    """
+    Split a time series text file into preamble, numeric block and trailer.
+
+    Parameters:
+    raw_bytes (bytes): The full content of the time series file.
+    n_columns (int): The number of data columns (the number of headers in the schema).
+    np (module): The NumPy module for numerical operations.
+
+    Returns:
+    dict or None: A dictionary with keys 'matrix', 'preamble', 'trailer', 'delimiter', 'newline', 'formats'
+                  and 'final_newline',
+                  or None if the file cannot be stored as a matrix and rewritten byte-for-byte.
+
+    The numeric block is the longest run of lines that hold exactly n_columns numbers, starting at the first such line.
+    A column format (number of decimals) is taken from the first data row, and the whole block is formatted again
+    and compared with the original, so a None result is returned rather than a lossy conversion.
+    """
+    if n_columns < 1 or not raw_bytes:
+        return None
+    text = raw_bytes.decode('latin-1')
+    lines = text.splitlines(True)
+
+    def numeric_tokens(line):
+        tokens = line.split()
+        if len(tokens) != n_columns:
+            return None
+        try:
+            return [float(token) for token in tokens]
+        except ValueError:
+            return None
+
+    # Locate the first data row
+    start = None
+    for i, line in enumerate(lines):
+        if numeric_tokens(line) is not None:
+            start = i
+            break
+    if start is None:
+        return None
+
+    # Detect the delimiter and line ending from the first data row
+    first = lines[start]
+    newline = first[len(first.rstrip('\r\n')):]
+    delimiter = '\t' if '\t' in first else ' '
+    tokens = first.rstrip('\r\n').split(delimiter)
+    if len(tokens) != n_columns:
+        return None
+    formats = []
+    for token in tokens:
+        if 'e' in token.lower() or token.strip() != token:
+            return None
+        if '.' in token:
+            formats.append('%.' + str(len(token) - token.index('.') - 1) + 'f')
+        else:
+            formats.append('%d')
+
+    # The numeric block ends at the first line with a different shape
+    stop = start
+    while stop < len(lines) and lines[stop].count(delimiter) == n_columns - 1 and lines[stop].endswith(newline) \
+            and numeric_tokens(lines[stop]) is not None:
+        stop += 1
+    # A last row without line ending still belongs to the block
+    if stop == len(lines) - 1 and not lines[stop].endswith(('\r', '\n')) and numeric_tokens(lines[stop]) is not None:
+        stop += 1
+
+    block = ''.join(lines[start:stop])
+    try:
+        matrix = np.array(block.split(), dtype=np.float64).reshape(-1, n_columns)
+    except ValueError:
+        return None
+
+    parsed = {
+        'matrix': matrix,
+        'preamble': ''.join(lines[:start]),
+        'trailer': ''.join(lines[stop:]),
+        'delimiter': delimiter,
+        'newline': newline,
+        'formats': formats,
+        'final_newline': block.endswith(newline),
+    }
+
+    # Only accept the matrix if it reproduces the original text exactly
+    # (a nan or inf in a '%d' column cannot be formatted at all)
+    try:
+        formatted = format_timeseries_rows(matrix, formats, delimiter, newline, parsed['final_newline'])
+    except (ValueError, OverflowError):
+        return None
+    if formatted != block.encode('latin-1'):
+        return None
+    return parsed
+
+
+def format_timeseries_rows(rows, formats, delimiter, newline, final_newline=True):
+    """
+    Format rows of a time series matrix back to text.
+
+    Parameters:
+    rows (numpy.array): A 2-D block of the time series matrix.
+    formats (list): One printf-style format per column.
+    delimiter (str): The column delimiter.
+    newline (str): The line ending.
+    final_newline (bool, optional): Whether the last row ends with a line ending. Defaults to True.
+
+    Returns:
+    bytes: The formatted rows.
+    """
+    row_format = delimiter.join(formats)
+    text = newline.join(row_format % tuple(row) for row in rows.tolist())
+    if final_newline and len(rows):
+        text += newline
+    return text.encode('latin-1')
+
+
+def write_timeseries_dataset(group, name, parsed, labels, compression='gzip', compression_opts=4, shuffle=True,
+                             resizable=False):
+    """
+    Store a parsed time series as a chunked, compressed 2-D float dataset.
+
+    Parameters:
+    group (h5py.Group): The group the dataset is created in.
+    name (str): The dataset name (the original file name).
+    parsed (dict): The result of parse_timeseries_text.
+    labels (list): The column labels from the schema headers.
+    compression (str, optional): The HDF5 compression filter. Defaults to 'gzip'.
+    compression_opts (int, optional): The compression level. Defaults to 4.
+    shuffle (bool, optional): If True, the shuffle filter is applied before compression. Defaults to True.
+    resizable (bool, optional): If True, rows can be appended later (unlimited first dimension, full-size chunks),
+                                as done by LAPS_2_follow_timeseries. Defaults to False.
+
+    Returns:
+    h5py.Dataset: The created dataset.
+
+    Chunks span a block of rows of a single column, so reading one column over a row range
+    only decompresses the chunks of that column.
+    """
+    matrix = parsed['matrix']
+    chunk_rows = 16384 if resizable else int(min(max(len(matrix), 1), 16384))
+    dataset = group.create_dataset(name, data=matrix, chunks=(chunk_rows, 1), shuffle=shuffle,
+                                   compression=compression, compression_opts=compression_opts,
+                                   maxshape=(None, matrix.shape[1]) if resizable else None)
+    dataset.attrs['LAPS_layout'] = TIMESERIES_LAYOUT
+    dataset.attrs['preamble'] = parsed['preamble']
+    dataset.attrs['trailer'] = parsed['trailer']
+    dataset.attrs['delimiter'] = parsed['delimiter']
+    dataset.attrs['newline'] = parsed['newline']
+    dataset.attrs['formats'] = parsed['formats']
+    dataset.attrs['final_newline'] = parsed['final_newline']
+    dataset.attrs['headers'] = labels
+    return dataset
+
+
+def _attr_str(value):
+    """
+    Return an HDF5 string attribute as str.
+    """
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+
+def write_timeseries_file(dataset, file, block_rows=65536):
+    """
+    Write a time series dataset back to its original text, block by block.
+
+    Parameters:
+    dataset (h5py.Dataset): A dataset created by write_timeseries_dataset.
+    file (file object): A binary file object to write to.
+    block_rows (int, optional): The number of rows formatted at a time. Defaults to 65536.
+
+    Returns:
+    None
+    """
+    attrs = dataset.attrs
+    formats = [_attr_str(fmt) for fmt in attrs['formats']]
+    delimiter = _attr_str(attrs['delimiter'])
+    newline = _attr_str(attrs['newline'])
+    trailer = _attr_str(attrs['trailer'])
+    n_rows = dataset.shape[0]
+
+    file.write(_attr_str(attrs['preamble']).encode('latin-1'))
+    for start in range(0, n_rows, block_rows):
+        stop = min(start + block_rows, n_rows)
+        # The last row only lacks its line ending if the file ended right after it
+        final_newline = stop < n_rows or bool(attrs['final_newline'])
+        file.write(format_timeseries_rows(dataset[start:stop], formats, delimiter, newline, final_newline))
+    file.write(trailer.encode('latin-1'))
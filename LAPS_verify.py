@@ -0,0 +1,396 @@
+## LAPS project data convertion, storage, and plotting based on the .json schema file
+# Ekaterina Bolotskaya
+# 07/17/2023
+
+from LAPS_dedup import INTERNAL_GROUP
+
+# Dataset holding the tree manifest (UTF-8 JSON, gzip-compressed 1-D uint8, read like any stored file):
+# {"format": 1, "files": {path: {"size": ..., "sha256": ...}}, "directories": [path, ...]}
+MANIFEST_DATASET = INTERNAL_GROUP + '/manifest'
+MANIFEST_FORMAT = 1
+
+
+def walk_archive(f, h5py):
+    """
+    List the files and directories of a LAPS HDF5 file, following links (every hard-linked path is listed).
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+    h5py (module): The h5py module for working with HDF5 files.
+
+    Returns:
+    tuple: (files, directories): the '/'-separated paths of the datasets and of the groups, in storage order,
+           without the INTERNAL_GROUP.
+    """
+    files = []
+    directories = []
+
+    def visit(group, path):
+        for name, item in group.items():
+            item_path = path + '/' + name if path else name
+            if item_path == INTERNAL_GROUP:
+                continue
+            if isinstance(item, h5py.Group):
+                directories.append(item_path)
+                visit(item, item_path)
+            else:
+                files.append(item_path)
+
+    visit(f, '')
+    return files, directories
+
+
+def write_manifest(f, json, np, h5py):
+    """
+    Store the tree manifest of a LAPS HDF5 file: every file with its size and SHA-256 hash, and every directory.
+
+    Parameters:
+    f (h5py.File): The HDF5 file open for writing.
+    json (module): The JSON module to write the manifest.
+    np (module): The NumPy module for numerical operations.
+    h5py (module): The h5py module for working with HDF5 files.
+
+    Returns:
+    dict: The manifest.
+
+    The sizes and hashes are those of the source files, recorded on their datasets by LAPS_2 (see
+    LAPS_source_tracking.record_source); files without them are listed with null values. The manifest
+    dataset is only rewritten when its content changes, so update runs do not grow the file.
+    """
+    import hashlib
+    from LAPS_stream_copy import write_bytes_to_dataset
+    from LAPS_filter_policy import auto_chunk_size
+    from LAPS_source_tracking import SIZE_ATTR, HASH_ATTR
+
+    files, directories = walk_archive(f, h5py)
+    manifest = {'format': MANIFEST_FORMAT, 'files': {}, 'directories': directories}
+    for path in files:
+        attrs = f[path].attrs
+        size = attrs.get(SIZE_ATTR)
+        digest = attrs.get(HASH_ATTR)
+        manifest['files'][path] = {'size': int(size) if size is not None else None,
+                                   'sha256': digest.decode('utf-8') if isinstance(digest, bytes) else digest}
+
+    text = json.dumps(manifest, sort_keys=True).encode('utf-8')
+    digest = hashlib.sha256(text).hexdigest()
+    group = f.require_group(INTERNAL_GROUP)
+    name = MANIFEST_DATASET.split('/', 1)[1]
+    if name in group and group[name].attrs.get('manifest_sha256') != digest:
+        del group[name]
+    if name not in group:
+        dataset = write_bytes_to_dataset(group, name, text, np, auto_chunk_size(len(text)),
+                                         {'compression': 'gzip', 'compression_opts': 9, 'shuffle': False})
+        dataset.attrs['manifest_sha256'] = digest
+    return manifest
+
+
+def read_manifest(f, json):
+    """
+    Return the tree manifest of a LAPS HDF5 file.
+
+    Parameters:
+    f (h5py.File): The open HDF5 file.
+    json (module): The JSON module to parse the manifest.
+
+    Returns:
+    dict or None: The manifest (see MANIFEST_DATASET), or None for files written before manifests existed.
+    """
+    if MANIFEST_DATASET not in f:
+        return None
+    return json.loads(f[MANIFEST_DATASET][()].tobytes().decode('utf-8'))
+
+
+class _HashWriter:
+    """
+    Binary file-like object hashing what is written to it (for write_timeseries_file).
+    """
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return len(data)
+
+
+def LAPS_verify(hdf5_file, json, os, np, h5py, source_dir=None, workers=None, block_size=8388608, deep=False,
+                progress=None, trace_file=None, verbose=True):
+    """
+    Check a LAPS HDF5 file against the checksums stored in it, or against its source directory, without extracting it.
+
+    Parameters:
+    hdf5_file (str): The path to the HDF5 file created by LAPS_2_HDF5_from_directory.
+    json (module): The JSON module to read the manifest.
+    os (module): The operating system module for file operations.
+    np (module): The NumPy module for numerical operations.
+    h5py (module): The h5py module for working with HDF5 files.
+    source_dir (str, optional): If given, the files are also compared with this directory (e.g. the populated
+                                directory the HDF5 file was made from), whose files are hashed too.
+                                Defaults to None (only the stored checksums and the manifest are used).
+    workers (int, optional): The number of threads reading and hashing. Defaults to the number of CPUs.
+    block_size (int, optional): The number of bytes read (and hashed) at a time. Defaults to 8388608.
+    deep (bool, optional): If True, time series stored as numeric matrices are formatted back to text and checked
+                           against the hash of the source file, instead of the hash of their values. Defaults to False.
+    progress (callable, optional): Called with a dictionary for the start, every file checked and the end
+                                   (see LAPS_instrumentation.LAPSTrace), e.g. LAPS_instrumentation.print_progress.
+    trace_file (str, optional): If given, the same events are appended to this file as JSON lines.
+    verbose (bool, optional): If True, the problems and a summary are printed. Defaults to True.
+
+    Returns:
+    dict: 'hdf5_file', 'ok' (True if no problem was found), 'checked' (files whose content was verified),
+          'bytes' (bytes read from the HDF5 file), 'seconds', 'manifest' (whether the file has one), and the lists
+          'missing' (in the manifest or the source directory but not in the HDF5 file), 'extra' (in the HDF5 file
+          only), 'corrupt' (stored data not matching its checksum), 'changed' (stored data intact, but the source
+          file differs) and 'unchecked' (no checksum stored and no source file to compare with).
+          Directories are reported as missing or extra too, with a trailing '/'.
+
+    Files stored uncompressed are hashed straight from their byte range in the HDF5 file (os.pread, or a file
+    handle per thread where os.pread is missing, e.g. on Windows; outside of HDF5, so the threads read in
+    parallel); compressed files are read through HDF5. Time series stored as
+    numeric matrices are checked against the hash of their values recorded by LAPS_2 ('data_sha256'); their source
+    file hash still covers them, since LAPS_2 only stores a matrix that formats back to the exact file.
+    Nothing is written to disk, so a check is limited by the read bandwidth rather than by extraction.
+
+    Usage example:
+    report = LAPS_verify('data.h5', json, os, np, h5py, source_dir='Paterson_Carrara_Test')
+    From a shell: python LAPS_verify.py archives/*.h5 --workers 16
+    """
+    import time
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from LAPS_stream_copy import BYTES_LAYOUT, raw_byte_range
+    from LAPS_timeseries_format import TIMESERIES_LAYOUT, write_timeseries_file
+    from LAPS_source_tracking import SIZE_ATTR, HASH_ATTR, DATA_HASH_ATTR, new_hasher, update_matrix_hash, file_sha256
+    from LAPS_instrumentation import LAPSTrace, FS_READ, FS_METADATA, HDF5_READ, HDF5_METADATA, CPU
+
+    with LAPSTrace('LAPS_verify', progress, trace_file, hdf5_file=hdf5_file, source_dir=source_dir) as trace:
+        workers = workers or os.cpu_count() or 1
+        report = {'hdf5_file': hdf5_file, 'ok': False, 'checked': 0, 'bytes': 0, 'seconds': 0.0, 'manifest': False,
+                  'missing': [], 'extra': [], 'corrupt': [], 'changed': [], 'unchecked': []}
+
+        # Function to read bytes at an offset of the HDF5 file, from any thread
+        handles = []  # file objects opened by read_at, one per thread
+        local = threading.local()
+
+        def read_at(position, count):
+            if hasattr(os, 'pread'):
+                return os.pread(fd, count, position)
+            if not hasattr(local, 'file'):
+                local.file = open(hdf5_file, 'rb')
+                handles.append(local.file)
+            local.file.seek(position)
+            return local.file.read(count)
+
+        # Function to hash a byte range of the HDF5 file (no HDF5 call, so threads read in parallel)
+        def hash_raw(offset, size):
+            hasher = new_hasher()
+            position, end = offset, offset + size
+            while position < end:
+                start = time.perf_counter()
+                block = read_at(position, min(block_size, end - position))
+                middle = time.perf_counter()
+                if not block:
+                    break  # truncated HDF5 file: the digest will not match
+                hasher.update(block)
+                trace.add_time(FS_READ, middle - start)
+                trace.add_time(CPU, time.perf_counter() - middle)
+                position += len(block)
+            return hasher.hexdigest(), position - offset
+
+        # Function to hash a dataset through HDF5, block by block
+        def hash_dataset(dataset, method):
+            hasher = new_hasher()
+            if method == 'text':
+                writer = _HashWriter(hasher)
+                with trace.timer(HDF5_READ):
+                    write_timeseries_file(dataset, writer)
+                return hasher.hexdigest(), writer.size
+            size = 0
+            if method == 'matrix':
+                step = max(1, block_size // (8 * max(dataset.shape[1], 1)))
+                blocks = ((start, min(start + step, dataset.shape[0])) for start in range(0, dataset.shape[0], step))
+            elif dataset.shape == ():
+                blocks = [None]
+            else:
+                blocks = ((start, min(start + block_size, dataset.shape[0]))
+                          for start in range(0, dataset.shape[0], block_size))
+            for block in blocks:
+                with trace.timer(HDF5_READ):
+                    data = dataset[()] if block is None else dataset[block[0]:block[1]]
+                with trace.timer(CPU):
+                    if method == 'matrix':
+                        update_matrix_hash(hasher, data, np)
+                        size += data.nbytes
+                    else:
+                        data = data.tobytes() if hasattr(data, 'tobytes') else bytes(data)
+                        hasher.update(data)
+                        size += len(data)
+            return hasher.hexdigest(), size
+
+        start = time.perf_counter()
+        with h5py.File(hdf5_file, 'r') as f:
+            with trace.timer(HDF5_METADATA):
+                files, directories = walk_archive(f, h5py)
+                manifest = read_manifest(f, json)
+            report['manifest'] = manifest is not None
+
+            # Expected tree: the source directory, or else the manifest
+            expected_files = expected_directories = None
+            if source_dir is not None:
+                expected_files, expected_directories = {}, []
+                with trace.timer(FS_METADATA):
+                    for root, dirs, names in os.walk(source_dir):
+                        dirs.sort()
+                        relative = os.path.relpath(root, source_dir)
+                        prefix = '' if relative == '.' else relative.replace(os.sep, '/') + '/'
+                        expected_directories.extend(prefix + name for name in dirs)
+                        for name in sorted(names):
+                            if os.path.isfile(os.path.join(root, name)):
+                                expected_files[prefix + name] = os.path.join(root, name)
+            elif manifest is not None:
+                expected_files = dict.fromkeys(manifest['files'])
+                expected_directories = manifest['directories']
+            if expected_files is not None:
+                stored = set(files)
+                report['missing'] = [path for path in expected_files if path not in stored]
+                report['extra'] = [path for path in files if path not in expected_files]
+                stored_directories, expected_set = set(directories), set(expected_directories)
+                report['missing'] += [path + '/' for path in expected_directories if path not in stored_directories]
+                report['extra'] += [path + '/' for path in directories if path not in expected_set]
+
+            # Plan the check of each file: how its stored data is read and which checksum it must match.
+            # Paths linked to the same dataset (LAPS_2 with dedup) share one content task.
+            plan = []
+            contents = {}  # object address -> (first path, method, raw byte range, expected size)
+            with trace.timer(HDF5_METADATA):
+                for path in files:
+                    dataset = f[path]
+                    attrs = dataset.attrs
+                    layout = attrs.get('LAPS_layout')
+                    source_hash = attrs.get(HASH_ATTR)
+                    size = attrs.get(SIZE_ATTR)
+                    raw = None
+                    if layout == TIMESERIES_LAYOUT:
+                        if DATA_HASH_ATTR in attrs and not deep:
+                            method, expected = 'matrix', attrs[DATA_HASH_ATTR]
+                        else:
+                            method, expected = 'text', source_hash
+                    else:
+                        method, expected = 'bytes', source_hash
+                        raw = raw_byte_range(dataset) if layout == BYTES_LAYOUT or dataset.shape == () else None
+                        if raw is not None:
+                            method = 'raw'
+                    live = expected_files.get(path) if source_dir is not None else None
+                    if expected is None and live is None:
+                        report['unchecked'].append(path)
+                        continue
+                    if expected is None and method == 'matrix':
+                        method = 'text'  # compared with the source file itself
+                    key = h5py.h5o.get_info(dataset.id).addr
+                    contents.setdefault(key, (path, method, raw, int(size) if size is not None and method in
+                                              ('raw', 'bytes', 'text') else None))
+                    plan.append((path, key, expected, source_hash, live))
+            tasks = [('content', key) for key in contents] + [('live', item[4]) for item in plan if item[4] is not None]
+            trace.files_total = len(tasks)
+
+            # Function to hash the stored data of a dataset, or a source file (runs in the worker threads)
+            def run(task):
+                kind, key = task
+                begin = time.perf_counter()
+                if kind == 'live':
+                    with trace.timer(FS_READ):
+                        digest = file_sha256(key, block_size)
+                    trace.file_done(key, time.perf_counter() - begin)
+                    return task, digest, 0
+                path, method, raw, size = contents[key]
+                try:
+                    if method == 'raw':
+                        digest, n_bytes = hash_raw(raw[0], raw[1])
+                    else:
+                        digest, n_bytes = hash_dataset(f[path], method)
+                except (OSError, ValueError, RuntimeError):
+                    digest, n_bytes = None, 0  # unreadable data (e.g. a damaged compressed chunk)
+                if size is not None and n_bytes != size:
+                    digest = None  # truncated or grown data
+                trace.file_done(path, time.perf_counter() - begin, n_bytes)
+                return task, digest, n_bytes
+
+            digests = {}
+            fd = os.open(hdf5_file, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    for task, digest, n_bytes in pool.map(run, tasks):
+                        digests[task] = digest
+                        report['bytes'] += n_bytes
+            finally:
+                os.close(fd)
+                for handle in handles:
+                    handle.close()
+
+            # Compare: the stored data with its checksum, and the checksum of the source with the live file
+            for path, key, expected, source_hash, live in plan:
+                digest = digests[('content', key)]
+                report['checked'] += 1
+                if live is None:
+                    status = 'ok' if expected is not None and digest == expected else 'corrupt'
+                elif expected is None:
+                    status = 'ok' if digest == digests[('live', live)] else 'changed'
+                elif digest != expected:
+                    status = 'corrupt'
+                else:
+                    status = 'ok' if source_hash == digests[('live', live)] else 'changed'
+                if status != 'ok':
+                    report[status].append(path)
+
+        report['seconds'] = time.perf_counter() - start
+        report['ok'] = not (report['missing'] or report['extra'] or report['corrupt'] or report['changed'])
+        trace.finish(ok=report['ok'])
+        if verbose:
+            for name in ('missing', 'extra', 'corrupt', 'changed', 'unchecked'):
+                for path in report[name]:
+                    print('      ', name + ':', path)
+            print("{}: {} ({} files checked, {:.1f} MB read in {:.2f} s{})".format(
+                hdf5_file, 'OK' if report['ok'] else 'PROBLEMS FOUND', report['checked'], report['bytes'] / 1e6,
+                report['seconds'],
+                '' if report['manifest'] or source_dir else ', no manifest: missing files not checked'))
+        return report
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import os
+    import sys
+    import h5py
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description="Verify LAPS HDF5 files against their stored checksums, "
+                                                 "or against their source directory, without extracting them.")
+    parser.add_argument('hdf5_files', nargs='+', help="HDF5 files, or folders searched for '.h5' files")
+    parser.add_argument('--source', default=None, help="compare with this source directory (one HDF5 file only)")
+    parser.add_argument('--workers', type=int, default=None, help="reading threads per file (default: CPUs)")
+    parser.add_argument('--block-size', type=int, default=8388608, help="bytes read at a time (default: 8 MiB)")
+    parser.add_argument('--deep', action='store_true', help="check time series matrices as text, against the "
+                                                            "hash of the source file")
+    parser.add_argument('--summary', default=None, help="write the reports to this JSON file")
+    args = parser.parse_args()
+
+    hdf5_files = []
+    for path in args.hdf5_files:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                hdf5_files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith('.h5'))
+        else:
+            hdf5_files.append(path)
+    if args.source and len(hdf5_files) != 1:
+        parser.error("--source needs exactly one HDF5 file")
+
+    reports = [LAPS_verify(path, json, os, np, h5py, source_dir=args.source, workers=args.workers,
+                           block_size=args.block_size, deep=args.deep) for path in hdf5_files]
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(reports, f, indent=4)
+    sys.exit(0 if all(report['ok'] for report in reports) else 1)